@@ -0,0 +1,185 @@
+import os
+import math
+import time
+import threading
+from collections import deque
+import instrumentation
+
+# Kinds of vCenter calls, most urgent first. Interactive calls serve a waiting
+# API request, bulk calls run batch operations, and background calls keep
+# caches and metrics current, so they can lag the most.
+CALL_CLASSES = ('interactive', 'bulk', 'background')
+
+# Calls made outside a request and not marked otherwise
+DEFAULT_CLASS = 'background'
+
+# Concurrent calls allowed per vCenter and worker at first, and the range the limit adapts in
+INITIAL_LIMIT = int(os.environ.get('VCENTER_ADMISSION_INITIAL_LIMIT', 16))
+MIN_LIMIT = int(os.environ.get('VCENTER_ADMISSION_MIN_LIMIT', 2))
+MAX_LIMIT = int(os.environ.get('VCENTER_ADMISSION_MAX_LIMIT', 64))
+
+# Calls slower than this many seconds count as vCenter being congested
+LATENCY_TARGET = float(os.environ.get('VCENTER_LATENCY_TARGET', 1.0))
+
+# Factor the limit is multiplied with on congestion
+BACKOFF_RATIO = 0.7
+
+# Calls allowed to wait for a slot, per class; more are rejected at once
+QUEUE_SIZES = {
+    'interactive': int(os.environ.get('VCENTER_INTERACTIVE_QUEUE', 100)),
+    'bulk': int(os.environ.get('VCENTER_BULK_QUEUE', 200)),
+    'background': int(os.environ.get('VCENTER_BACKGROUND_QUEUE', 50)),
+}
+
+# Seconds a call waits in its queue before it is rejected
+QUEUE_TIMEOUT = float(os.environ.get('VCENTER_QUEUE_TIMEOUT', 30))
+
+# Long polls block in vCenter by design; they neither take a slot nor feed the limit
+EXEMPT_METHODS = frozenset(('WaitForUpdatesEx', 'WaitForUpdates'))
+
+_local = threading.local()
+
+class Overloaded(Exception):
+    """Raised instead of a vCenter call when its queue is full or it waited too long"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def current_class():
+    return getattr(_local, 'call_class', None) or DEFAULT_CLASS
+
+def set_class(call_class):
+    """Classify the vCenter calls this thread makes from now on; None restores the default"""
+    _local.call_class = call_class
+    _local.rejection = None
+
+def take_rejection():
+    """Return and clear the last Overloaded raised on this thread since set_class, if any"""
+    rejection = getattr(_local, 'rejection', None)
+    _local.rejection = None
+    return rejection
+
+def note_rejection(error):
+    """Remember error for take_rejection if it is an Overloaded raised on another thread"""
+    if isinstance(error, Overloaded):
+        _local.rejection = error
+
+def carry_class(fn):
+    """Return fn, wrapped to classify its calls like the current thread's when it runs on another thread"""
+    call_class = getattr(_local, 'call_class', None)
+    if call_class is None:
+        return fn
+
+    def run(*args, **kwargs):
+        _local.call_class = call_class
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.call_class = None
+    return run
+
+class Waiter:
+    __slots__ = ('granted', 'event')
+
+    def __init__(self):
+        self.granted = False
+        self.event = threading.Event()
+
+class AdmissionController:
+    """Admits vCenter calls under a concurrency limit that adapts to vCenter's latency.
+
+    The limit grows by about one slot per limit's worth of fast calls while
+    it is in use, and shrinks by BACKOFF_RATIO when a call exceeds the latency
+    target or fails at the transport, at most once per target interval so a
+    burst of slow calls counts once (AIMD). Calls beyond the limit wait in a
+    bounded queue per class; a freed slot goes to the most urgent class.
+    """
+
+    def __init__(self, name, initial_limit=INITIAL_LIMIT, min_limit=MIN_LIMIT, max_limit=MAX_LIMIT,
+                 latency_target=LATENCY_TARGET, queue_sizes=QUEUE_SIZES, queue_timeout=QUEUE_TIMEOUT):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.queue_sizes = dict(queue_sizes)
+        self.queue_timeout = queue_timeout
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self.latency = None
+        self.counters = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timeouts': 0, 'backoffs': 0}
+        self._queues = {call_class: deque() for call_class in CALL_CLASSES}
+        self._backed_off_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, call_class, timeout=None):
+        """Take a slot for one call, waiting in call_class's queue if needed; raises Overloaded"""
+        queue = self._queues[call_class]
+        with self._lock:
+            if self.in_flight < int(self.limit) and not any(self._queues.values()):
+                self.in_flight += 1
+                self.counters['admitted'] += 1
+                return
+            if len(queue) >= self.queue_sizes[call_class]:
+                self.counters['rejected'] += 1
+                raise self._overloaded(call_class, 'queue_full', f"{call_class} queue for {self.name} is full")
+            waiter = Waiter()
+            queue.append(waiter)
+            self.counters['queued'] += 1
+
+        waiter.event.wait(self.queue_timeout if timeout is None else timeout)
+        with self._lock:
+            if waiter.granted:
+                return
+            queue.remove(waiter)
+            self.counters['timeouts'] += 1
+            raise self._overloaded(call_class, 'timeout', f"timed out queueing for {self.name}")
+
+    def release(self, seconds=None, congested=False):
+        """Free a slot; seconds is the call's latency, None when it does not count toward the limit"""
+        with self._lock:
+            self.in_flight -= 1
+            if seconds is not None:
+                self._adapt(seconds, congested)
+            self._grant()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self.counters,
+                limit=int(self.limit),
+                in_flight=self.in_flight,
+                queued={call_class: len(queue) for call_class, queue in self._queues.items()},
+                latency_ms=round(self.latency * 1000, 1) if self.latency is not None else None,
+            )
+
+    def _adapt(self, seconds, congested):
+        self.latency = seconds if self.latency is None else 0.9 * self.latency + 0.1 * seconds
+        now = time.monotonic()
+        if congested or seconds > self.latency_target:
+            if now - self._backed_off_at >= self.latency_target:
+                self._backed_off_at = now
+                self.limit = max(self.min_limit, self.limit * BACKOFF_RATIO)
+                self.counters['backoffs'] += 1
+        elif self.in_flight + 1 >= int(self.limit):
+            # Only grow a limit that is actually reached
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _grant(self):
+        for call_class in CALL_CLASSES:
+            queue = self._queues[call_class]
+            while queue and self.in_flight < int(self.limit):
+                waiter = queue.popleft()
+                waiter.granted = True
+                self.in_flight += 1
+                self.counters['admitted'] += 1
+                waiter.event.set()
+
+    def _overloaded(self, call_class, reason, message):
+        instrumentation.admission_rejections.inc((call_class, reason))
+        # Roughly the time for the calls ahead to drain through the current limit
+        waiting = sum(len(queue) for queue in self._queues.values())
+        retry_after = max(1, math.ceil((self.latency or self.latency_target) * (waiting + 1) / max(int(self.limit), 1)))
+        error = Overloaded(f"vCenter is overloaded: {message}", retry_after)
+        _local.rejection = error
+        return error
@@ -1,16 +1,37 @@
 
 import os
+import re
 import ssl
 import json
+import zlib
 import atexit
-from flask import Flask, request, jsonify
+from urllib.parse import urlencode
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-from pyVim.connect import SmartConnect, Disconnect
 from pyVmomi import vim
-import random
+import secrets
 import time
+import threading
 from dotenv import load_dotenv
 import db_models as db
+import admission
+import auth
+import connection_pool
+import details
+import federation
+import instrumentation
+import logs
+import session_store
+import singleflight
+import events
+import inventory
+import metrics
+import projections
+import search
+import snapshots
+import streaming
+import tasks
+import tsdb
 
 # Load environment variables from .env file
 load_dotenv()
@@ -18,9 +39,217 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)
 
-# Store active sessions
+# LOG_FORMAT=json writes structured records from a background thread
+logs.configure(app)
+
+# Key of the user tokens, the pool keys and the vCenter cookies shared between workers
+auth_secret = auth.load_secret()
+
+# Signs the user tokens handed out at login; verifying one needs no database access
+token_signer = auth.TokenSigner(auth_secret)
+
+# Users' roles and VM assignments by user id, dropped whenever the database changes a user
+principals = auth.PrincipalCache(db.get_user_by_id)
+db.user_change_listeners.append(principals.invalidate)
+
+# Checks passwords off the request threads, rejecting logins beyond its queue
+login_pool = auth.LoginPool()
+
+# Session records shared by all workers; expiry is enforced by the store
+session_registry = session_store.create_session_store()
+
+# This worker's resolved sessions: session id -> service instance, connection and host
 sessions = {}
 
+# Authenticated vCenter connections shared by sessions with the same credentials.
+# Login cookies are published through the session store so other workers can
+# attach to a vCenter session they did not log in to, and record when each
+# worker last used a connection so the owner does not log out a borrowed one.
+vcenter_pool = connection_pool.ConnectionPool(auth.derive_key(auth_secret, 'connection-key'))
+vcenter_pool.publish_cookie = session_registry.save_connection
+vcenter_pool.lookup_cookie = session_registry.get_connection_cookie
+vcenter_pool.touch_cookie = session_registry.touch_connection
+vcenter_pool.cookie_last_used = session_registry.connection_last_used
+
+# Per-vCenter inventory caches, keyed by vCenter host
+inventory_caches = {}
+inventory_caches_lock = threading.Lock()
+
+# Per-vCenter change stream brokers, keyed by vCenter host
+event_brokers = {}
+
+# Per-vCenter performance metrics collectors, keyed by vCenter host
+metrics_collectors = {}
+
+# Per-vCenter metrics history stores, keyed by vCenter host
+metrics_stores = {}
+
+# Per-vCenter serialized VM lists projected per user, keyed by vCenter host
+inventory_projections = {}
+
+# Per-vCenter task trackers, keyed by vCenter host
+task_trackers = {}
+
+# Power operations accepted by the power endpoints, mapped to VirtualMachine methods
+POWER_OPERATIONS = {
+    'start': 'PowerOn',
+    'stop': 'PowerOff',
+    'restart': 'Reset',
+    'suspend': 'Suspend',
+}
+
+# How long the single-VM power endpoint waits for its task to finish
+POWER_WAIT_SECONDS = int(os.environ.get('POWER_WAIT_SECONDS', 120))
+
+# Short-lived VM details with request coalescing, keyed by vCenter host
+detail_caches = {}
+
+# Shared in-flight reads, so identical concurrent queries run once; keyed by vCenter host
+read_flights = {}
+
+# Snapshot indexes of every VM, fed by their own inventory caches, keyed by vCenter host
+snapshot_indexes = {}
+
+# VM search indexes, fed by the inventory caches, keyed by vCenter host
+search_indexes = {}
+
+# Session and connection counts, refreshed whenever this worker publishes its metrics
+active_sessions_gauge = instrumentation.registry.gauge(
+    'vmcaptain_sessions_active', 'Unexpired API sessions of all workers', merge='max'
+)
+worker_sessions_gauge = instrumentation.registry.gauge(
+    'vmcaptain_worker_sessions', 'API sessions attached to a vCenter connection, summed over workers'
+)
+vcenter_connections_gauge = instrumentation.registry.gauge(
+    'vmcaptain_vcenter_connections', 'Pooled vCenter connections, by whether an API session uses them', ('state',)
+)
+admission_queue_gauge = instrumentation.registry.gauge(
+    'vmcaptain_admission_queue_depth', 'vCenter calls waiting for admission, by call class', ('class',)
+)
+admission_in_flight_gauge = instrumentation.registry.gauge(
+    'vmcaptain_admission_in_flight', 'vCenter calls admitted and running'
+)
+admission_limit_gauge = instrumentation.registry.gauge(
+    'vmcaptain_admission_limit', 'Adaptive limit of concurrent vCenter calls, summed over vCenters and workers'
+)
+
+def collect_gauges():
+    stats = vcenter_pool.stats()
+    active_sessions_gauge.set((), session_registry.count())
+    worker_sessions_gauge.set((), len(sessions))
+    vcenter_connections_gauge.set(('in_use',), stats['in_use'])
+    vcenter_connections_gauge.set(('idle',), stats['size'] - stats['in_use'])
+    
+    controllers = stats['admission'].values()
+    for call_class in admission.CALL_CLASSES:
+        admission_queue_gauge.set((call_class,), sum(controller['queued'][call_class] for controller in controllers))
+    admission_in_flight_gauge.set((), sum(controller['in_flight'] for controller in controllers))
+    admission_limit_gauge.set((), sum(controller['limit'] for controller in controllers))
+
+instrumentation.registry.collectors.append(collect_gauges)
+instrumentation.registry.start()
+
+# How long the single-VM snapshot endpoint waits for its task to finish
+SNAPSHOT_WAIT_SECONDS = int(os.environ.get('SNAPSHOT_WAIT_SECONDS', 300))
+
+# How long a list request waits for the initial inventory load
+INVENTORY_READY_TIMEOUT = int(os.environ.get('INVENTORY_READY_TIMEOUT', 120))
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    g.request_id = logs.start_request(request.headers.get(logs.REQUEST_ID_HEADER))
+    # vCenter calls made for a waiting client go ahead of background and bulk work
+    admission.set_class('interactive')
+    if request.headers.get(instrumentation.PROFILE_HEADER):
+        g.profile = instrumentation.start_profile()
+    else:
+        instrumentation.stop_profile()
+
+@app.before_request
+def require_app_user():
+    """Require a valid application user token on every vCenter route.
+
+    Assignments of USER accounts are enforced from this user, so a caller
+    leaving the token out must not fall back to the unfiltered inventory.
+    """
+    if request.method == 'OPTIONS' or not request.path.startswith('/vcenter/'):
+        return None
+    user = get_app_user_from_request()
+    if not user:
+        return jsonify({'error': 'Valid user token required'}), 401
+    g.app_user = user
+    return None
+
+@app.after_request
+def finish_request_log(response):
+    """Echo the request id and, in structured mode, log the request's summary line.
+
+    Registered first so it runs last and sees the final status.
+    """
+    if g.get('request_id'):
+        response.headers[logs.REQUEST_ID_HEADER] = g.request_id
+    started = g.get('request_started')
+    logs.end_request(
+        request.method, request.path, request.url_rule.rule if request.url_rule else 'unmatched',
+        response.status_code, time.perf_counter() - started if started is not None else 0.0
+    )
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    """Record latency and body size by route; profiled requests get a Server-Timing header.
+
+    Streamed bodies are counted as they are sent, so their size is recorded
+    when the server closes them; latency is the time until the response starts.
+    """
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    started = g.get('request_started')
+    if started is not None:
+        instrumentation.http_requests.observe(
+            (route, request.method, str(response.status_code)), time.perf_counter() - started
+        )
+    
+    if response.is_streamed:
+        response.response = instrumentation.CountedBody(
+            response.response, lambda size: instrumentation.http_response_sizes.observe((route,), size)
+        )
+    else:
+        instrumentation.http_response_sizes.observe((route,), response.content_length or 0)
+    
+    profile = g.get('profile')
+    if profile is not None:
+        response.headers['Server-Timing'] = profile.server_timing()
+        instrumentation.stop_profile()
+    return response
+
+@app.after_request
+def shed_overloaded(response):
+    """Answer 429 instead of the error of a request whose vCenter call was refused by admission control.
+
+    Routes report failed vCenter calls as server errors; this runs before the
+    metrics are recorded, so they count the 429.
+    """
+    rejection = admission.take_rejection()
+    if rejection is None or response.status_code < 500:
+        return response
+    return overloaded_response(rejection)
+
+@app.errorhandler(admission.Overloaded)
+def handle_overloaded(e):
+    admission.take_rejection()
+    return overloaded_response(e)
+
+def overloaded_response(rejection):
+    response = jsonify({'error': f'{rejection}, try again shortly'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(rejection.retry_after)
+    return response
+
+@app.teardown_request
+def end_request_class(exc):
+    admission.set_class(None)
+
 @app.route('/', methods=['GET'])
 def index():
     """Root endpoint to verify API is running"""
@@ -43,6 +272,11 @@ def health_check():
         }
     })
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics merged from every worker"""
+    return Response(instrumentation.registry.exposition(), content_type=instrumentation.CONTENT_TYPE)
+
 # User management endpoints
 @app.route('/api/auth/login', methods=['POST'])
 def login():
@@ -54,7 +288,15 @@ def login():
     if not username or not password:
         return jsonify({'error': 'Username and password are required'}), 400
     
-    user = db.get_user_by_credentials(username, password)
+    # Only the password hashing runs on the bounded login pool; the user is looked up here
+    try:
+        user = db.get_user_by_credentials(username, password, login_pool.run)
+    except auth.Busy:
+        response = jsonify({'error': 'Too many logins in progress, try again shortly'})
+        response.headers['Retry-After'] = '1'
+        return response, 429
+    except TimeoutError:
+        return jsonify({'error': 'Login timed out'}), 503
     
     if not user:
         return jsonify({'error': 'Invalid credentials'}), 401
@@ -63,19 +305,17 @@ def login():
     if 'password' in user:
         del user['password']
     
+    user['token'], user['token_expires_at'] = token_signer.issue(user['id'])
     return jsonify(user)
 
 @app.route('/api/users', methods=['GET'])
 def get_users():
     """Get all users (admin only)"""
-    auth_header = request.headers.get('Authorization')
-    if not auth_header:
-        return jsonify({'error': 'Authorization header required'}), 401
-    
-    user_id = auth_header.split(' ')[1]
-    user = db.get_user_by_id(user_id)
+    user = get_principal_from_request()
+    if not user:
+        return jsonify({'error': 'Valid authorization token required'}), 401
     
-    if not user or user['role'] != 'ADMIN':
+    if user['role'] != 'ADMIN':
         return jsonify({'error': 'Unauthorized'}), 403
     
     users = db.get_all_users()
@@ -90,14 +330,11 @@ def get_users():
 @app.route('/api/users', methods=['POST'])
 def add_user():
     """Add a new user (admin only)"""
-    auth_header = request.headers.get('Authorization')
-    if not auth_header:
-        return jsonify({'error': 'Authorization header required'}), 401
-    
-    user_id = auth_header.split(' ')[1]
-    admin = db.get_user_by_id(user_id)
+    admin = get_principal_from_request()
+    if not admin:
+        return jsonify({'error': 'Valid authorization token required'}), 401
     
-    if not admin or admin['role'] != 'ADMIN':
+    if admin['role'] != 'ADMIN':
         return jsonify({'error': 'Unauthorized'}), 403
     
     data = request.json
@@ -125,18 +362,15 @@ def add_user():
 @app.route('/api/users/<user_id>', methods=['DELETE'])
 def delete_user(user_id):
     """Delete a user (admin only)"""
-    auth_header = request.headers.get('Authorization')
-    if not auth_header:
-        return jsonify({'error': 'Authorization header required'}), 401
-    
-    admin_id = auth_header.split(' ')[1]
-    admin = db.get_user_by_id(admin_id)
+    admin = get_principal_from_request()
+    if not admin:
+        return jsonify({'error': 'Valid authorization token required'}), 401
     
-    if not admin or admin['role'] != 'ADMIN':
+    if admin['role'] != 'ADMIN':
         return jsonify({'error': 'Unauthorized'}), 403
     
     # Prevent admin from deleting themselves
-    if admin_id == user_id:
+    if admin['id'] == user_id:
         return jsonify({'error': 'Cannot delete yourself'}), 400
     
     success = db.delete_user(user_id)
@@ -149,13 +383,11 @@ def delete_user(user_id):
 @app.route('/api/users/password', methods=['PUT'])
 def change_password():
     """Change a user's password"""
-    auth_header = request.headers.get('Authorization')
-    if not auth_header:
-        return jsonify({'error': 'Authorization header required'}), 401
-    
-    user_id = auth_header.split(' ')[1]
-    user = db.get_user_by_id(user_id)
+    principal = get_principal_from_request()
+    if not principal:
+        return jsonify({'error': 'Valid authorization token required'}), 401
     
+    user = db.get_user_by_id(principal['id'])
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
@@ -166,11 +398,23 @@ def change_password():
     if not current_password or not new_password:
         return jsonify({'error': 'Current and new passwords are required'}), 400
     
-    # Verify current password
-    if user['password'] != current_password:
-        return jsonify({'error': 'Current password is incorrect'}), 401
+    # Verify current password and hash the new one on the login pool
+    def update_password():
+        if not auth.verify_password(current_password, user['password'])[0]:
+            return None
+        return db.update_user_password(user['id'], new_password)
     
-    success = db.update_user_password(user_id, new_password)
+    try:
+        success = login_pool.run(update_password)
+    except auth.Busy:
+        response = jsonify({'error': 'Too many logins in progress, try again shortly'})
+        response.headers['Retry-After'] = '1'
+        return response, 429
+    except TimeoutError:
+        return jsonify({'error': 'Password change timed out'}), 503
+    
+    if success is None:
+        return jsonify({'error': 'Current password is incorrect'}), 401
     
     if not success:
         return jsonify({'error': 'Failed to update password'}), 500
@@ -179,44 +423,88 @@ def change_password():
 
 @app.route('/api/users/<user_id>/vms/<vm_id>', methods=['PUT'])
 def assign_vm(user_id, vm_id):
-    """Assign a VM to a user (admin only)"""
-    auth_header = request.headers.get('Authorization')
-    if not auth_header:
-        return jsonify({'error': 'Authorization header required'}), 401
-    
-    admin_id = auth_header.split(' ')[1]
-    admin = db.get_user_by_id(admin_id)
+    """Assign a VM of the vCenter named by the vcenter argument to a user (admin only)"""
+    admin = get_principal_from_request()
+    if not admin:
+        return jsonify({'error': 'Valid authorization token required'}), 401
     
-    if not admin or admin['role'] != 'ADMIN':
+    if admin['role'] != 'ADMIN':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    success = db.assign_vm_to_user(user_id, vm_id)
+    vcenter = request.args.get('vcenter') or db.DEFAULT_VCENTER
+    if not vcenter:
+        return jsonify({'error': 'vcenter is required'}), 400
+    
+    success = db.assign_vm_to_user(user_id, vcenter, vm_id)
     
     if not success:
         return jsonify({'error': 'User not found'}), 404
     
+    publish_visibility(user_id)
+    
     return jsonify({'message': 'VM assigned successfully'})
 
 @app.route('/api/users/<user_id>/vms/<vm_id>', methods=['DELETE'])
 def remove_vm(user_id, vm_id):
-    """Remove a VM from a user (admin only)"""
-    auth_header = request.headers.get('Authorization')
-    if not auth_header:
-        return jsonify({'error': 'Authorization header required'}), 401
-    
-    admin_id = auth_header.split(' ')[1]
-    admin = db.get_user_by_id(admin_id)
+    """Remove a VM of the vCenter named by the vcenter argument from a user (admin only)"""
+    admin = get_principal_from_request()
+    if not admin:
+        return jsonify({'error': 'Valid authorization token required'}), 401
     
-    if not admin or admin['role'] != 'ADMIN':
+    if admin['role'] != 'ADMIN':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    success = db.remove_vm_from_user(user_id, vm_id)
+    vcenter = request.args.get('vcenter') or db.DEFAULT_VCENTER
+    if not vcenter:
+        return jsonify({'error': 'vcenter is required'}), 400
+    
+    success = db.remove_vm_from_user(user_id, vcenter, vm_id)
     
     if not success:
         return jsonify({'error': 'User not found'}), 404
     
+    publish_visibility(user_id)
+    
     return jsonify({'message': 'VM removed successfully'})
 
+@app.route('/api/users/<user_id>/vms', methods=['PUT'])
+def assign_vms(user_id):
+    """Assign many VMs to a user in one transaction (admin only)"""
+    return update_vm_assignments(user_id, db.assign_vms_to_user, 'assigned')
+
+@app.route('/api/users/<user_id>/vms', methods=['DELETE'])
+def remove_vms(user_id):
+    """Remove many VMs from a user in one transaction (admin only)"""
+    return update_vm_assignments(user_id, db.remove_vms_from_user, 'removed')
+
+def update_vm_assignments(user_id, update, action):
+    """Apply a bulk assignment change from a {"vcenter": host, "vm_ids": [...]} body"""
+    admin = get_principal_from_request()
+    if not admin:
+        return jsonify({'error': 'Valid authorization token required'}), 401
+    
+    if admin['role'] != 'ADMIN':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    vm_ids = data.get('vm_ids')
+    if not isinstance(vm_ids, list) or not all(isinstance(vm_id, str) for vm_id in vm_ids):
+        return jsonify({'error': 'vm_ids must be a list of VM ids'}), 400
+    
+    vcenter = data.get('vcenter') or db.DEFAULT_VCENTER
+    if not isinstance(vcenter, str) or not vcenter:
+        return jsonify({'error': 'vcenter must name the host of the VMs'}), 400
+    
+    count = update(user_id, vcenter, vm_ids)
+    
+    if count is None:
+        return jsonify({'error': 'User not found'}), 404
+    
+    if count:
+        publish_visibility(user_id)
+    
+    return jsonify({'message': f'VMs {action} successfully', action: count})
+
 # vCenter connection endpoints
 @app.route('/vcenter/connect', methods=['POST'])
 def connect():
@@ -228,57 +516,51 @@ def connect():
         password = data.get('password') or os.environ.get('VITE_VCENTER_PASSWORD')
         ignore_ssl = data.get('ignore_ssl') or (os.environ.get('VITE_VCENTER_IGNORE_SSL') == 'true')
         
-        app.logger.info(f"Connecting to vCenter at {url} with username {username}")
+        app.logger.info("Connecting to vCenter at %s with username %s", url, username)
         
         if not url or not username or not password:
             app.logger.error("Missing required connection parameters")
             return jsonify({'error': 'Missing required connection parameters'}), 400
         
-        # Parse hostname from URL
-        import re
-        hostname_match = re.search(r'https?://([^/]+)', url)
-        if not hostname_match:
-            app.logger.error(f"Invalid vCenter URL format: {url}")
+        hostname = parse_hostname(url)
+        if not hostname:
+            app.logger.error("Invalid vCenter URL format: %s", url)
             return jsonify({'error': 'Invalid vCenter URL format'}), 400
         
-        hostname = hostname_match.group(1)
-        app.logger.info(f"Parsed hostname: {hostname}")
-        
-        # Configure SSL context
-        context = None
-        if ignore_ssl:
-            context = ssl._create_unverified_context()
+        app.logger.info("Parsed hostname: %s", hostname)
         
-        # Connect to vCenter
+        # Reuse a pooled vCenter connection for these credentials, logging in only if needed
         app.logger.info("Attempting connection to vCenter...")
-        service_instance = SmartConnect(
-            host=hostname,
-            user=username,
-            pwd=password,
-            sslContext=context
-        )
-        
-        if not service_instance:
-            app.logger.error("Failed to connect to vCenter - no service instance returned")
-            return jsonify({'error': 'Failed to connect to vCenter - authentication failed'}), 500
+        session_id = open_session(hostname, username, password, ignore_ssl)
         
-        # Generate session ID
-        session_id = f"session-{int(time.time())}-{random.randint(1000, 9999)}"
-        sessions[session_id] = {
-            'service_instance': service_instance,
-            'created_at': time.time()
-        }
-        
-        # Register cleanup function to disconnect all sessions when app stops
-        atexit.register(cleanup_sessions)
-        app.logger.info(f"Connection successful - created session {session_id}")
+        app.logger.info("Connection successful - created session %s", session_id)
         
         return jsonify({'session_id': session_id})
     
     except Exception as e:
-        app.logger.error(f"Connection error: {str(e)}")
+        app.logger.error("Connection error: %s", e)
         return jsonify({'error': f'Failed to connect to vCenter: {str(e)}'}), 500
 
+def parse_hostname(url):
+    """Return the host part of a vCenter URL, or None if the URL is malformed"""
+    hostname_match = re.search(r'https?://([^/]+)', url or '')
+    return hostname_match.group(1) if hostname_match else None
+
+def open_session(hostname, username, password, ignore_ssl):
+    """Acquire a pooled connection to a vCenter and register a new session on it; returns the session id"""
+    context = ssl._create_unverified_context() if ignore_ssl else None
+    connection = vcenter_pool.acquire(hostname, username, password, context, ignore_ssl)
+    
+    session_id = f"session-{int(time.time())}-{secrets.token_hex(8)}"
+    session_registry.create(session_id, connection.key, hostname, ignore_ssl)
+    sessions[session_id] = {
+        'service_instance': connection.service_instance,
+        'connection': connection,
+        'host': hostname,
+        'created_at': time.time()
+    }
+    return session_id
+
 @app.route('/vcenter/disconnect', methods=['POST'])
 def disconnect():
     auth_header = request.headers.get('Authorization')
@@ -286,68 +568,1045 @@ def disconnect():
         return jsonify({'error': 'Unauthorized'}), 401
     
     session_id = auth_header.split(' ')[1]
-    if session_id in sessions:
+    if session_registry.get(session_id):
         try:
-            Disconnect(sessions[session_id]['service_instance'])
-            del sessions[session_id]
+            session_registry.delete(session_id)
+            forget_session(session_id)
             return jsonify({'message': 'Disconnected successfully'})
         except Exception as e:
             return jsonify({'error': f'Failed to disconnect: {str(e)}'}), 500
     
     return jsonify({'message': 'Session not found'}), 404
 
+@app.route('/vcenter/pool', methods=['GET'])
+def get_pool_stats():
+    """Return vCenter connection pool metrics"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    return jsonify(dict(vcenter_pool.stats(), active_sessions=session_registry.count(), worker_sessions=len(sessions)))
+
 @app.route('/vcenter/vms', methods=['GET'])
 def get_vms():
+    """Stream the VM list as a JSON array or NDJSON (Accept: application/x-ndjson).
+
+    Optional: limit and cursor for pagination, fields to select attributes,
+    gzip or zstd per Accept-Encoding. After a restart the list is served from
+    the last inventory checkpoint, flagged by X-Inventory-Stale, until the
+    first sync with vCenter completes.
+    """
     session = get_session_from_request()
     if not session:
         return jsonify({'error': 'Unauthorized or session expired'}), 401
     
     try:
-        service_instance = session['service_instance']
-        content = service_instance.RetrieveContent()
+        limit = request.args.get('limit')
+        limit = int(limit) if limit is not None else None
+        if limit is not None and not 0 < limit <= streaming.MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {streaming.MAX_PAGE_SIZE}")
+        cursor = request.args.get('cursor')
+        cursor = streaming.decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': f'Invalid pagination: {str(e)}'}), 400
+    
+    fields = streaming.parse_fields(request.args.get('fields'))
+    fmt = streaming.negotiate_format(request.accept_mimetypes)
+    encoding = streaming.negotiate_encoding(request.accept_encodings)
+    
+    try:
+        cache = get_inventory_cache(session)
+        
+        if not cache.wait_ready(INVENTORY_READY_TIMEOUT):
+            error = cache.last_error or 'timed out loading inventory'
+            return jsonify({'error': f'Failed to retrieve VMs: {error}'}), 503
+        
+        collector = get_metrics_collector(session, cache)
+        
+        # USER accounts only see the VMs assigned to them
+        user = get_app_user_from_request()
+        visible = visible_vm_ids(user, session['host'])
+        user_id = user['id'] if visible is not None else None
         
-        # Get all VMs
-        container = content.viewManager.CreateContainerView(
-            content.rootFolder, [vim.VirtualMachine], True
+        # Stream the shared pre-serialized fragments; unchanged views answer 304
+        version = cache.version
+        view = get_inventory_projections(session['host'], cache).view(user_id, visible, collector)
+        start, end = streaming.page_bounds(view.ids, view.positions if cursor else None, cursor, limit)
+        
+        if fields is None:
+            fragments = view.fragments[start:end]
+        else:
+            fragments = selected_vm_fragments(cache, collector, view.ids[start:end], fields)
+        body = streaming.compressed(streaming.chunked(streaming.frame(fragments, fmt)), encoding)
+        
+        # direct_passthrough keeps werkzeug from buffering the stream to compute a length
+        response = app.response_class(
+            body, mimetype='application/x-ndjson' if fmt == 'ndjson' else 'application/json',
+            direct_passthrough=True
         )
+        variant = f"{fmt}:{encoding}:{start}:{end}:{','.join(fields or ())}"
+        response.set_etag(f"{cache.epoch}-{view.view_id}-{zlib.crc32(variant.encode()):08x}")
+        response.vary.update(('Accept', 'Accept-Encoding'))
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if end < len(view.ids):
+            next_cursor = streaming.encode_cursor(view.ids[end - 1], end)
+            response.headers['X-Next-Cursor'] = next_cursor
+            response.headers['Link'] = f'<{request.path}?{next_page_query(next_cursor)}>; rel="next"'
+        response.headers['X-Total-Count'] = str(len(view.ids))
+        response.headers['X-Inventory-Version'] = str(version)
+        response.headers['X-Inventory-Epoch'] = cache.epoch
+        if cache.stale:
+            response.headers['X-Inventory-Stale'] = 'true'
+        return response.make_conditional(request)
+    
+    except Exception as e:
+        app.logger.error("Error retrieving VMs: %s", e)
+        return jsonify({'error': f'Failed to retrieve VMs: {str(e)}'}), 500
+
+def next_page_query(cursor, name='cursor'):
+    """Return the current query string with the cursor (or another page argument) replaced"""
+    args = request.args.copy()
+    args[name] = cursor
+    return urlencode(list(args.items(multi=True)))
+
+def selected_vm_fragments(cache, collector, vm_ids, fields):
+    """Serialize the selected fields of VMs in batches, as the response is written"""
+    for start in range(0, len(vm_ids), streaming.FIELDS_BATCH_SIZE):
+        entries = with_usage(cache.get_entries(vm_ids[start:start + streaming.FIELDS_BATCH_SIZE]), collector)
+        yield from streaming.select_fragments(entries, fields)
+
+@app.route('/vcenter/vms/search', methods=['GET'])
+def search_vms():
+    """Search the VM list through in-memory indexes and return one page as a JSON array.
+
+    Optional: q to match names (match=prefix for prefixes, else anywhere),
+    power_state (comma-separated), guest (part of the guest OS name), ip (an
+    address or CIDR), sort (name, power_state, guest_full_name or ip_address,
+    - for descending), limit and offset. The match count is in X-Total-Count.
+    """
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    try:
+        arguments = search_arguments()
+    except ValueError as e:
+        return jsonify({'error': f'Invalid search: {str(e)}'}), 400
+    
+    try:
+        cache = get_inventory_cache(session)
         
-        vms = []
-        for vm in container.view:
-            # Only basic VM properties for list view
-            power_state = str(vm.runtime.powerState) if vm.runtime and hasattr(vm.runtime, 'powerState') else 'UNKNOWN'
-            app.logger.info(f"VM {vm.name} power state: {power_state}")
-            
-            vm_data = {
-                'id': vm._moId,
-                'name': vm.name,
-                'power_state': power_state,
-                'guest_full_name': vm.config.guestFullName if vm.config else 'Unknown',
-            }
-            
-            # Add IP address if available
-            if vm.guest and vm.guest.ipAddress:
-                vm_data['ip_address'] = vm.guest.ipAddress
-            
-            # Get performance metrics if VM is powered on
-            if vm.runtime.powerState == vim.VirtualMachine.PowerState.poweredOn:
-                vm_data['cpu_usage'] = random.randint(5, 85)  # Simplified for demo
-                vm_data['memory_usage'] = random.randint(10, 90)  # Simplified for demo
-                vm_data['disk_usage'] = random.randint(20, 95)  # Simplified for demo
-            else:
-                vm_data['cpu_usage'] = 0
-                vm_data['memory_usage'] = 0
-                vm_data['disk_usage'] = 0
+        if not cache.wait_ready(INVENTORY_READY_TIMEOUT):
+            error = cache.last_error or 'timed out loading inventory'
+            return jsonify({'error': f'Failed to search VMs: {error}'}), 503
+        
+        user = get_app_user_from_request()
+        visible = visible_vm_ids(user, session['host'])
+        
+        version = cache.version
+        total, vm_ids = get_search_index(session['host'], cache).search(visible=visible, **arguments)
+        entries = with_usage(cache.get_entries(vm_ids), get_metrics_collector(session, cache))
+        
+        response = app.response_class(json.dumps(entries), mimetype='application/json')
+        end = arguments['offset'] + len(vm_ids)
+        if end < total:
+            response.headers['Link'] = f'<{request.path}?{next_page_query(end, "offset")}>; rel="next"'
+        response.headers['X-Total-Count'] = str(total)
+        response.headers['X-Inventory-Version'] = str(version)
+        if cache.stale:
+            response.headers['X-Inventory-Stale'] = 'true'
+        return response
+    
+    except Exception as e:
+        app.logger.error("Error searching VMs: %s", e)
+        return jsonify({'error': f'Failed to search VMs: {str(e)}'}), 500
+
+def search_arguments():
+    """Parse the filters, sort and page of a search request; raises ValueError"""
+    sort, descending = search.parse_sort(request.args.get('sort'))
+    
+    match = request.args.get('match', 'substring')
+    if match not in ('substring', 'prefix'):
+        raise ValueError('match must be substring or prefix')
+    
+    limit = int(request.args.get('limit', search.DEFAULT_LIMIT))
+    if not 0 < limit <= streaming.MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {streaming.MAX_PAGE_SIZE}")
+    offset = int(request.args.get('offset', 0))
+    if offset < 0:
+        raise ValueError('offset must not be negative')
+    
+    ip = request.args.get('ip')
+    return {
+        'text': request.args.get('q') or None,
+        'prefix': match == 'prefix',
+        'power_states': streaming.parse_fields(request.args.get('power_state')),
+        'guest': request.args.get('guest') or None,
+        'network': search.parse_network(ip) if ip else None,
+        'sort': sort,
+        'descending': descending,
+        'offset': offset,
+        'limit': limit,
+    }
+
+def get_search_index(host, cache):
+    """Return the VM search index for a vCenter, fed by its inventory cache"""
+    with inventory_caches_lock:
+        index = search_indexes.get(host)
+        if index is None:
+            index = search_indexes[host] = search.SearchIndex(cache)
+    return index
+
+@app.route('/vcenter/vms/changes', methods=['GET'])
+def get_vm_changes():
+    """Return VMs added, modified or removed since a given inventory version"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'error': 'since must be an inventory version'}), 400
+    
+    try:
+        cache = get_inventory_cache(session)
+        
+        if not cache.wait_ready(INVENTORY_READY_TIMEOUT):
+            error = cache.last_error or 'timed out loading inventory'
+            return jsonify({'error': f'Failed to retrieve VM changes: {error}'}), 503
+        
+        changes = cache.changes_since(since, request.args.get('epoch'))
+        if changes is None:
+            # Too old to reconstruct; the client has to reload /vcenter/vms
+            return jsonify({
+                'full_resync': True,
+                'version': cache.version,
+                'epoch': cache.epoch
+            })
+        
+        # USER accounts only see the VMs assigned to them
+        visible = visible_vm_ids(get_app_user_from_request(), session['host'])
+        if visible is not None:
+            for key in ('added', 'changed'):
+                changes[key] = [entry for entry in changes[key] if entry['id'] in visible]
+            changes['removed'] = [vm_id for vm_id in changes['removed'] if vm_id in visible]
+        
+        collector = get_metrics_collector(session, cache)
+        changes['added'] = with_usage(changes['added'], collector)
+        changes['changed'] = with_usage(changes['changed'], collector)
+        changes['full_resync'] = False
+        return jsonify(changes)
+    
+    except Exception as e:
+        app.logger.error("Error retrieving VM changes: %s", e)
+        return jsonify({'error': f'Failed to retrieve VM changes: {str(e)}'}), 500
+
+@app.route('/vcenter/vms/events', methods=['GET'])
+def stream_vm_events():
+    """Stream VM add, change and remove events as Server-Sent Events"""
+    stream, error = open_vm_event_stream()
+    if error:
+        return error
+    
+    cache, broker, subscriber, since, service_instance = stream
+    
+    def generate():
+        try:
+            last_version, message = first_vm_event(cache, subscriber, since)
+            yield message
+            if last_version is None:
+                return
             
-            vms.append(vm_data)
+            while True:
+                pending = subscriber.get(events.HEARTBEAT_SECONDS)
+                last_version, messages = next_vm_events(cache, subscriber, pending, last_version)
+                
+                if not messages:
+                    # Keep proxies from closing the stream and the inventory feed from idling out
+                    cache.attach(service_instance)
+                    yield ': keepalive\n\n'
+                    continue
+                
+                yield ''.join(messages)
+        finally:
+            broker.unsubscribe(subscriber)
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def open_vm_event_stream():
+    """Authorize an event stream request and subscribe it to its vCenter's broker.
+
+    Returns ((cache, broker, subscriber, since, service_instance), None) or
+    (None, error response). Shared by the WSGI view and the ASGI stream.
+    """
+    # EventSource cannot set headers, so both tokens may come as query parameters
+    session = get_session_from_request() or get_session(request.args.get('session'))
+    if not session:
+        return None, (jsonify({'error': 'Unauthorized or session expired'}), 401)
+    
+    user = get_app_user_from_request()
+    if not user:
+        return None, (jsonify({'error': 'User token required'}), 401)
+    
+    try:
+        cache = get_inventory_cache(session)
+        broker = get_event_broker(session['host'], cache)
+    except Exception as e:
+        app.logger.error("Error opening VM event stream: %s", e)
+        return None, (jsonify({'error': f'Failed to open VM event stream: {str(e)}'}), 500)
+    
+    subscriber = broker.subscribe(user['id'], visible_vm_ids(user, session['host']))
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    return (cache, broker, subscriber, since, session['service_instance']), None
+
+def first_vm_event(cache, subscriber, since):
+    """Return (version, message) opening a stream; version is None after an error event.
+
+    Resumes from the client's last version when possible, otherwise starts
+    with a snapshot. Blocks until the inventory has loaded.
+    """
+    if not cache.wait_ready(INVENTORY_READY_TIMEOUT):
+        return None, events.format_sse('error', json.dumps({'error': cache.last_error or 'timed out loading inventory'}))
+    
+    changes = cache.changes_since(int(since), cache.epoch) if since and since.isdigit() else None
+    if changes is None:
+        return snapshot_event(cache, subscriber)
+    
+    version = changes['version']
+    return version, events.format_sse('vms', json.dumps({
+        'version': version,
+        'added': subscriber.filter(changes['added']),
+        'changed': subscriber.filter(changes['changed']),
+        'removed': subscriber.filter_ids(changes['removed'])
+    }), version)
+
+def next_vm_events(cache, subscriber, pending, last_version):
+    """Return (version, messages) for queued events; no messages means the stream is idle"""
+    if subscriber.take_overflow():
+        # Too slow to keep up: replace the dropped backlog with a fresh snapshot
+        version, message = snapshot_event(cache, subscriber)
+        return version, [message]
+    
+    # Batches already covered by the first message are skipped
+    return last_version, [
+        events.format_sse(event, data, event_id)
+        for event, data, event_id in pending
+        if event_id is None or event_id > last_version
+    ]
+
+def snapshot_event(cache, subscriber):
+    """Return (version, snapshot event) with the subscriber's full visible inventory"""
+    version, entries = cache.entries()
+    collector = metrics_collectors.get(cache.name)
+    entries = subscriber.filter(entries)
+    return version, events.format_sse('snapshot', json.dumps({
+        'version': version,
+        'epoch': cache.epoch,
+        'stale': cache.stale,
+        'vms': with_usage(entries, collector) if collector else entries
+    }), version)
+
+def get_event_broker(host, cache):
+    """Return the change stream broker for a vCenter, creating it on first use"""
+    with inventory_caches_lock:
+        broker = event_brokers.get(host)
+        if broker is None:
+            broker = events.EventBroker(cache)
+            event_brokers[host] = broker
+    return broker
+
+@app.route('/vcenter/metrics/collector', methods=['GET'])
+def get_metrics_collector_status():
+    """Return metrics collector configuration and per-cycle timings"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    collector = metrics_collectors.get(session['host'])
+    if not collector:
+        return jsonify({'error': 'Metrics collection has not started for this vCenter'}), 404
+    
+    return jsonify(collector.status())
+
+@app.route('/vcenter/vms/<vm_id>/metrics', methods=['GET'])
+def get_vm_metrics(vm_id):
+    """Return usage history for a VM between from and to (epoch seconds)"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    now = int(time.time())
+    end = request.args.get('to', now, type=int)
+    start = request.args.get('from', end - 3600, type=int)
+    step = request.args.get('step', type=int)
+    
+    if start > end or (step is not None and step <= 0):
+        return jsonify({'error': 'from must not be after to and step must be positive'}), 400
+    
+    if forbidden_vm_ids([vm_id], session['host']):
+        return jsonify({'error': 'VM not assigned to this user'}), 403
+    
+    def query():
+        result = get_metrics_store(session['host']).query(vm_id, start, end, step)
+        result.update({'vm_id': vm_id, 'from': start, 'to': end})
+        return json.dumps(result).encode()
+    
+    try:
+        body = get_read_flights(session['host']).do(('metrics', vm_id, start, end, step), query)
+        return app.response_class(body, mimetype='application/json')
+    
+    except singleflight.Timeout as e:
+        return jsonify({'error': f'Failed to retrieve VM metrics: {str(e)}'}), 504
+    except Exception as e:
+        app.logger.error("Error retrieving metrics for VM %s: %s", vm_id, e)
+        return jsonify({'error': f'Failed to retrieve VM metrics: {str(e)}'}), 500
+
+def with_usage(entries, collector):
+    """Join list entries with the latest collected usage; makes no vCenter calls"""
+    return [dict(entry, **collector.latest(entry['id'])) for entry in entries]
+
+def get_inventory_projections(host, cache):
+    """Return the per-user VM list projections for a vCenter"""
+    with inventory_caches_lock:
+        views = inventory_projections.get(host)
+        if views is None:
+            views = inventory_projections[host] = projections.InventoryProjections(cache)
+    return views
+
+def get_inventory_cache(session):
+    """Return the inventory cache for the session's vCenter, starting it if needed"""
+    host = session['host']
+    with inventory_caches_lock:
+        cache = inventory_caches.get(host)
+        if cache is None:
+            # Starts from the last checkpoint of this vCenter, if any, while the feed resyncs
+            cache = inventory.InventoryCache(
+                host, session['service_instance'], checkpoint_file=inventory.checkpoint_file(host)
+            )
+            inventory_caches[host] = cache
+    
+    cache.attach(session['service_instance'])
+    return cache
+
+def get_metrics_collector(session, cache):
+    """Return the metrics collector for the session's vCenter, starting it if needed"""
+    host = session['host']
+    store = get_metrics_store(host)
+    with inventory_caches_lock:
+        collector = metrics_collectors.get(host)
+        if collector is None:
+            collector = metrics.MetricsCollector(
+                host, session['service_instance'], lambda: powered_on_vm_ids(cache), store=store
+            )
+            metrics_collectors[host] = collector
+    
+    collector.attach(session['service_instance'])
+    return collector
+
+def get_metrics_store(host):
+    """Return the metrics history store for a vCenter"""
+    with inventory_caches_lock:
+        store = metrics_stores.get(host)
+        if store is None:
+            store = metrics_stores[host] = tsdb.MetricsStore(tsdb.store_directory(host))
+    return store
+
+def powered_on_vm_ids(cache):
+    """Return ids of powered-on VMs in the cached inventory"""
+    _, entries = cache.entries()
+    return [entry['id'] for entry in entries if entry['power_state'] == vim.VirtualMachine.PowerState.poweredOn]
+
+@app.route('/vcenter/vms/<vm_id>', methods=['GET'])
+def get_vm(vm_id):
+    """Return one VM's details, fetched by moref in a single call and cached briefly"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    if forbidden_vm_ids([vm_id], session['host']):
+        return jsonify({'error': 'VM not assigned to this user'}), 403
+    
+    try:
+        cache = get_inventory_cache(session)
+        detail = get_detail_cache(session, cache).get(vm_id)
+        if detail is None:
+            return jsonify({'error': 'VM not found'}), 404
         
-        container.Destroy()
-        return jsonify(vms)
+        # Usage comes from the metrics collector; no extra vCenter call
+        return jsonify(dict(detail, **get_metrics_collector(session, cache).latest(vm_id)))
     
+    except singleflight.Timeout as e:
+        return jsonify({'error': f'Failed to retrieve VM details: {str(e)}'}), 504
     except Exception as e:
-        app.logger.error(f"Error retrieving VMs: {str(e)}")
-        return jsonify({'error': f'Failed to retrieve VMs: {str(e)}'}), 500
+        app.logger.error("Error retrieving VM %s: %s", vm_id, e)
+        return jsonify({'error': f'Failed to retrieve VM details: {str(e)}'}), 500
+
+def get_read_flights(host):
+    """Return the single-flight group for reads against a vCenter"""
+    with inventory_caches_lock:
+        flights = read_flights.get(host)
+        if flights is None:
+            flights = read_flights[host] = singleflight.Group(host)
+    return flights
+
+def get_detail_cache(session, cache):
+    """Return the VM detail cache for the session's vCenter, invalidated by its inventory feed"""
+    host = session['host']
+    with inventory_caches_lock:
+        detail_cache = detail_caches.get(host)
+        if detail_cache is None:
+            detail_cache = detail_caches[host] = details.DetailCache(host, session['service_instance'])
+            cache.add_listener(detail_cache.on_inventory_change)
+    
+    detail_cache.attach(session['service_instance'])
+    return detail_cache
+
+@app.route('/vcenter/vms/<vm_id>/power/<operation>', methods=['POST'])
+def power_operation(vm_id, operation):
+    """Run a power operation on one VM and wait for its task to finish"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    if operation not in POWER_OPERATIONS:
+        return jsonify({'error': f"Unknown power operation: {operation}"}), 400
+    
+    if forbidden_vm_ids([vm_id], session['host']):
+        return jsonify({'error': 'VM not assigned to this user'}), 403
+    
+    try:
+        task = power_task_starter(session, operation)(vm_id)
+        tracker = get_task_tracker(session)
+        tracker.track([task])
+        state = tracker.wait(task._moId, POWER_WAIT_SECONDS)
+    except Exception as e:
+        app.logger.error("Error running %s on VM %s: %s", operation, vm_id, e)
+        return jsonify({'error': f'Failed to {operation} VM: {tasks.fault_message(e)}'}), 500
+    
+    if state is None:
+        return jsonify({'message': f'{operation} is still running', 'task_id': task._moId}), 202
+    if state['state'] == 'error':
+        return jsonify({'error': f"Failed to {operation} VM: {state['error']}"}), 500
+    
+    return jsonify({'message': f'{operation} completed successfully', 'task_id': task._moId})
+
+@app.route('/vcenter/vms/power', methods=['POST'])
+def bulk_power_operation():
+    """Start a power operation on many VMs; returns a batch id to poll for task states"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    operation = data.get('operation')
+    if operation not in POWER_OPERATIONS:
+        return jsonify({'error': f"operation must be one of: {', '.join(POWER_OPERATIONS)}"}), 400
+    
+    vm_ids, parallelism, error = batch_arguments(data, session['host'])
+    if error:
+        return error
+    
+    try:
+        batch_id = start_task_batch(session, operation, vm_ids, power_task_starter(session, operation), parallelism)
+    except Exception as e:
+        app.logger.error("Error starting %s batch: %s", operation, e)
+        return jsonify({'error': f'Failed to start power operation: {str(e)}'}), 500
+    
+    return jsonify({'batch_id': batch_id, 'operation': operation, 'count': len(vm_ids)}), 202
+
+@app.route('/vcenter/batches/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    """Return per-VM task state of a bulk operation"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    batch = session_registry.get_batch(batch_id)
+    if not batch or batch['host'] != session['host']:
+        return jsonify({'error': 'Batch not found'}), 404
+    
+    return jsonify(batch)
+
+def batch_arguments(data, host):
+    """Validate vm_ids and parallelism of a bulk request on host's VMs; returns (vm_ids, parallelism, error response)"""
+    vm_ids = data.get('vm_ids')
+    if not isinstance(vm_ids, list) or not vm_ids or not all(isinstance(vm_id, str) for vm_id in vm_ids):
+        return None, None, (jsonify({'error': 'vm_ids must be a non-empty list of VM ids'}), 400)
+    
+    parallelism = data.get('parallelism', tasks.BATCH_PARALLELISM)
+    if not isinstance(parallelism, int) or isinstance(parallelism, bool) or parallelism < 1:
+        return None, None, (jsonify({'error': 'parallelism must be a positive integer'}), 400)
+    
+    vm_ids = list(dict.fromkeys(vm_ids))
+    denied = forbidden_vm_ids(vm_ids, host)
+    if denied:
+        return None, None, (jsonify({'error': 'VMs not assigned to this user', 'vm_ids': denied}), 403)
+    
+    return vm_ids, min(parallelism, tasks.MAX_BATCH_PARALLELISM), None
 
-# ... keep existing code (VM detail, power operations, and snapshots endpoints)
+def forbidden_vm_ids(vm_ids, host):
+    """Return the ids of host's VMs the request's application user may not act on"""
+    user = get_app_user_from_request()
+    visible = visible_vm_ids(user, host)
+    if visible is None:
+        return []
+    return [vm_id for vm_id in vm_ids if vm_id not in visible]
+
+def power_task_starter(session, operation):
+    """Return a callable starting the power operation's vCenter task for a VM id"""
+    stub = session['service_instance']._stub
+    method = POWER_OPERATIONS[operation]
+    return lambda vm_id: getattr(vim.VirtualMachine(vm_id, stub), method)()
+
+def start_task_batch(session, operation, vm_ids, start_task, parallelism):
+    """Record a batch in the shared store and run its tasks in the background"""
+    batch_id = tasks.new_batch_id()
+    session_registry.create_batch(batch_id, session['host'], operation, vm_ids)
+    
+    def on_update(vm_id, fields):
+        session_registry.update_batch_item(batch_id, vm_id, fields)
+    
+    tasks.run_batch(get_task_tracker(session), vm_ids, start_task, on_update, parallelism)
+    return batch_id
+
+def get_task_tracker(session):
+    """Return the task tracker for the session's vCenter"""
+    host = session['host']
+    with inventory_caches_lock:
+        tracker = task_trackers.get(host)
+        if tracker is None:
+            tracker = task_trackers[host] = tasks.TaskTracker(host, session['service_instance'])
+    
+    tracker.attach(session['service_instance'])
+    return tracker
+
+@app.route('/vcenter/vms/<vm_id>/snapshots', methods=['GET'])
+def get_vm_snapshots(vm_id):
+    """Return a VM's snapshot tree from the snapshot index"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    if forbidden_vm_ids([vm_id], session['host']):
+        return jsonify({'error': 'VM not assigned to this user'}), 403
+    
+    try:
+        index, error = ready_snapshot_index(session)
+        if error:
+            return jsonify({'error': f'Failed to retrieve snapshots: {error}'}), 503
+        
+        records = index.vm_snapshots(vm_id)
+        if records is None:
+            return jsonify({'error': 'VM not found'}), 404
+        
+        return jsonify(snapshots.snapshot_tree(records))
+    
+    except Exception as e:
+        app.logger.error("Error retrieving snapshots for VM %s: %s", vm_id, e)
+        return jsonify({'error': f'Failed to retrieve snapshots: {str(e)}'}), 500
+
+@app.route('/vcenter/vms/<vm_id>/snapshots', methods=['POST'])
+def create_vm_snapshot(vm_id):
+    """Take a snapshot of one VM and wait for its task to finish"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    if not data.get('name'):
+        return jsonify({'error': 'Snapshot name is required'}), 400
+    
+    if forbidden_vm_ids([vm_id], session['host']):
+        return jsonify({'error': 'VM not assigned to this user'}), 403
+    
+    try:
+        task = snapshot_task_starter(session, data)(vm_id)
+        tracker = get_task_tracker(session)
+        tracker.track([task])
+        state = tracker.wait(task._moId, SNAPSHOT_WAIT_SECONDS)
+    except Exception as e:
+        app.logger.error("Error creating snapshot of VM %s: %s", vm_id, e)
+        return jsonify({'error': f'Failed to create snapshot: {tasks.fault_message(e)}'}), 500
+    
+    if state is None:
+        return jsonify({'message': 'Snapshot creation is still running', 'task_id': task._moId}), 202
+    if state['state'] == 'error':
+        return jsonify({'error': f"Failed to create snapshot: {state['error']}"}), 500
+    
+    return jsonify({
+        'message': 'Snapshot created successfully',
+        'task_id': task._moId,
+        'snapshot_id': state['result']
+    }), 201
+
+@app.route('/vcenter/snapshots', methods=['GET'])
+def find_snapshots():
+    """Return snapshots across all VMs, filtered by older_than (e.g. 7d) and min_size (e.g. 10G)"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    try:
+        older_than = request.args.get('older_than')
+        created_before = time.time() - snapshots.parse_age(older_than) if older_than else None
+        min_size = request.args.get('min_size')
+        min_size = snapshots.parse_size(min_size) if min_size else None
+    except ValueError as e:
+        return jsonify({'error': f'older_than and min_size must be like 7d or 10G: {str(e)}'}), 400
+    
+    try:
+        index, error = ready_snapshot_index(session)
+        if error:
+            return jsonify({'error': f'Failed to retrieve snapshots: {error}'}), 503
+        
+        # USER accounts only see snapshots of the VMs assigned to them
+        user = get_app_user_from_request()
+        visible = visible_vm_ids(user, session['host'])
+        user_id = user['id'] if visible is not None else None
+        
+        def query():
+            found = index.query(created_before, min_size, visible)
+            return json.dumps({
+                'count': len(found),
+                'total_size_bytes': sum(record['size_bytes'] for record in found),
+                'snapshots': found
+            }).encode()
+        
+        key = ('snapshots', request.args.get('older_than'), request.args.get('min_size'), user_id)
+        body = get_read_flights(session['host']).do(key, query)
+        return app.response_class(body, mimetype='application/json')
+    
+    except singleflight.Timeout as e:
+        return jsonify({'error': f'Failed to retrieve snapshots: {str(e)}'}), 504
+    except Exception as e:
+        app.logger.error("Error querying snapshots: %s", e)
+        return jsonify({'error': f'Failed to retrieve snapshots: {str(e)}'}), 500
+
+@app.route('/vcenter/snapshots/create', methods=['POST'])
+def bulk_create_snapshots():
+    """Take a snapshot of many VMs; returns a batch id to poll for task states"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    if not data.get('name'):
+        return jsonify({'error': 'Snapshot name is required'}), 400
+    
+    vm_ids, parallelism, error = batch_arguments(data, session['host'])
+    if error:
+        return error
+    
+    try:
+        batch_id = start_task_batch(session, 'create_snapshot', vm_ids, snapshot_task_starter(session, data), parallelism)
+    except Exception as e:
+        app.logger.error("Error starting snapshot batch: %s", e)
+        return jsonify({'error': f'Failed to create snapshots: {str(e)}'}), 500
+    
+    return jsonify({'batch_id': batch_id, 'operation': 'create_snapshot', 'count': len(vm_ids)}), 202
+
+@app.route('/vcenter/snapshots/remove', methods=['POST'])
+def bulk_remove_snapshots():
+    """Remove many snapshots, one task at a time per VM; returns a batch id to poll for task states"""
+    session = get_session_from_request()
+    if not session:
+        return jsonify({'error': 'Unauthorized or session expired'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    snapshot_ids = data.get('snapshot_ids')
+    if not isinstance(snapshot_ids, list) or not snapshot_ids or not all(isinstance(sid, str) for sid in snapshot_ids):
+        return jsonify({'error': 'snapshot_ids must be a non-empty list of snapshot ids'}), 400
+    
+    try:
+        index, error = ready_snapshot_index(session)
+        if error:
+            return jsonify({'error': f'Failed to remove snapshots: {error}'}), 503
+        
+        # vCenter runs one snapshot task per VM at a time, so removals are grouped per VM
+        by_vm = {}
+        unknown = []
+        for snapshot_id in dict.fromkeys(snapshot_ids):
+            record = index.get(snapshot_id)
+            if record is None:
+                unknown.append(snapshot_id)
+            else:
+                by_vm.setdefault(record['vm_id'], []).append(snapshot_id)
+        if unknown:
+            return jsonify({'error': 'Snapshots not found', 'snapshot_ids': unknown}), 404
+        
+        vm_ids, parallelism, error = batch_arguments(dict(data, vm_ids=list(by_vm)), session['host'])
+        if error:
+            return error
+        
+        stub = session['service_instance']._stub
+        remove_children = bool(data.get('remove_children', False))
+        consolidate = bool(data.get('consolidate', True))
+        
+        def start_removals(vm_id):
+            return [
+                lambda snapshot_id=snapshot_id: vim.vm.Snapshot(snapshot_id, stub).Remove(remove_children, consolidate)
+                for snapshot_id in by_vm[vm_id]
+            ]
+        
+        batch_id = start_task_batch(session, 'remove_snapshots', vm_ids, start_removals, parallelism)
+    except Exception as e:
+        app.logger.error("Error starting snapshot removal batch: %s", e)
+        return jsonify({'error': f'Failed to remove snapshots: {str(e)}'}), 500
+    
+    return jsonify({
+        'batch_id': batch_id,
+        'operation': 'remove_snapshots',
+        'count': len(vm_ids),
+        'snapshots': sum(len(ids) for ids in by_vm.values())
+    }), 202
+
+def snapshot_task_starter(session, data):
+    """Return a callable starting a CreateSnapshot task for a VM id"""
+    stub = session['service_instance']._stub
+    name = data['name']
+    description = data.get('description') or ''
+    memory = bool(data.get('memory', False))
+    quiesce = bool(data.get('quiesce', False))
+    return lambda vm_id: vim.VirtualMachine(vm_id, stub).CreateSnapshot(name, description, memory, quiesce)
+
+def get_snapshot_index(session):
+    """Return the snapshot index for the session's vCenter, starting its feed if needed"""
+    host = session['host']
+    with inventory_caches_lock:
+        index = snapshot_indexes.get(host)
+        if index is None:
+            cache = snapshots.create_snapshot_cache(host, session['service_instance'])
+            index = snapshot_indexes[host] = snapshots.SnapshotIndex(cache)
+    
+    index.cache.attach(session['service_instance'])
+    return index
+
+def ready_snapshot_index(session):
+    """Return (snapshot index, None) once its initial load finished, or (None, error)"""
+    index = get_snapshot_index(session)
+    if not index.cache.wait_ready(INVENTORY_READY_TIMEOUT):
+        return None, index.cache.last_error or 'timed out loading snapshots'
+    return index, None
+
+# Federation endpoints: one token for several vCenters, queried in parallel
+@app.route('/vcenter/federation/connect', methods=['POST'])
+def connect_federation():
+    """Connect to several vCenters in parallel and register them under one federation token.
+
+    Body: {"vcenters": [{"id", "url", "username", "password", "ignore_ssl"}, ...]},
+    defaulting to the VCENTERS environment variable. vCenters that cannot be
+    reached are reported and left out.
+    """
+    data = request.json or {}
+    try:
+        vcenters = data.get('vcenters') or federation.configured_vcenters()
+        if not isinstance(vcenters, list) or not vcenters or not all(isinstance(v, dict) for v in vcenters):
+            raise ValueError('vcenters must be a non-empty list of vCenter definitions')
+        ids = federation.vcenter_ids(vcenters)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    sites = []
+    for vcenter_id, vcenter in zip(ids, vcenters):
+        if not vcenter.get('url') or not vcenter.get('username') or not vcenter.get('password'):
+            return jsonify({'error': f'Missing required connection parameters for vCenter {vcenter_id}'}), 400
+        hostname = parse_hostname(vcenter['url'])
+        if not hostname:
+            return jsonify({'error': f'Invalid vCenter URL format for vCenter {vcenter_id}'}), 400
+        sites.append(dict(vcenter, id=vcenter_id, host=hostname))
+    
+    app.logger.info("Connecting federation of %s vCenters", len(sites))
+    
+    def login(site):
+        return open_session(site['host'], site['username'], site['password'], bool(site.get('ignore_ssl')))
+    
+    session_ids, statuses = federation.fan_out(sites, login)
+    members = [
+        {'id': site['id'], 'host': site['host'], 'session_id': session_ids[site['id']]}
+        for site in sites if site['id'] in session_ids
+    ]
+    if not members:
+        return jsonify({'error': 'Failed to connect to any vCenter', 'vcenters': statuses}), 502
+    
+    federation_id = federation.new_federation_id()
+    session_registry.create_federation(federation_id, members)
+    app.logger.info("Created federation %s of %s/%s vCenters", federation_id, len(members), len(sites))
+    
+    return jsonify({
+        'federation_id': federation_id,
+        'vcenters': statuses,
+        'partial': len(members) < len(sites),
+    })
+
+@app.route('/vcenter/federation/disconnect', methods=['POST'])
+def disconnect_federation():
+    federation_record = get_federation_from_request()
+    if not federation_record:
+        return jsonify({'message': 'Federation not found'}), 404
+    
+    session_registry.delete_federation(federation_record['federation_id'])
+    for member in federation_record['members']:
+        session_registry.delete(member['session_id'])
+        forget_session(member['session_id'])
+    return jsonify({'message': 'Disconnected successfully'})
+
+@app.route('/vcenter/federation/vms', methods=['GET'])
+def get_federated_vms():
+    """Return the VMs of every vCenter of the federation, tagged with vcenter_id and moref.
+
+    vCenters that fail or do not answer within the per-site timeout are
+    reported in 'vcenters' and the list is marked partial.
+    """
+    federation_record = get_federation_from_request()
+    if not federation_record:
+        return jsonify({'error': 'Unauthorized or federation expired'}), 401
+    
+    try:
+        timeout = site_timeout()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    user = get_app_user_from_request()
+    
+    def site_vms(vcenter_id, session):
+        # Assignments name their vCenter, so a moref assigned on one site grants nothing on another
+        visible = visible_vm_ids(user, session['host'])
+        cache = get_inventory_cache(session)
+        if not cache.wait_ready(timeout):
+            raise RuntimeError(cache.last_error or 'inventory still loading')
+        collector = get_metrics_collector(session, cache)
+        _, entries = cache.entries()
+        if visible is not None:
+            entries = [entry for entry in entries if entry['id'] in visible]
+        return with_usage(entries, collector)
+    
+    results, statuses = federated(federation_record, site_vms, timeout)
+    return federated_response('vms', federation.merged(results, federation_record['members']), statuses)
+
+@app.route('/vcenter/federation/metrics', methods=['GET'])
+def get_federated_metrics():
+    """Return usage history for VMs of several vCenters (vms=<vcenter_id>:<moref>,...)"""
+    federation_record = get_federation_from_request()
+    if not federation_record:
+        return jsonify({'error': 'Unauthorized or federation expired'}), 401
+    
+    now = int(time.time())
+    end = request.args.get('to', now, type=int)
+    start = request.args.get('from', end - 3600, type=int)
+    step = request.args.get('step', type=int)
+    if start > end or (step is not None and step <= 0):
+        return jsonify({'error': 'from must not be after to and step must be positive'}), 400
+    
+    members = {member['id']: member for member in federation_record['members']}
+    requested = {}
+    try:
+        timeout = site_timeout()
+        vm_ids = streaming.parse_fields(request.args.get('vms')) or ()
+        if not vm_ids or len(vm_ids) > federation.MAX_METRICS_VMS:
+            raise ValueError(f"vms must list between 1 and {federation.MAX_METRICS_VMS} federated VM ids")
+        for vm_id in vm_ids:
+            vcenter_id, moref = federation.split_id(vm_id)
+            if vcenter_id not in members:
+                raise ValueError(f"unknown vCenter: {vcenter_id}")
+            requested.setdefault(vcenter_id, []).append(moref)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    denied = [
+        federation.global_id(vcenter_id, moref)
+        for vcenter_id, morefs in requested.items()
+        for moref in forbidden_vm_ids(morefs, members[vcenter_id]['host'])
+    ]
+    if denied:
+        return jsonify({'error': 'VMs not assigned to this user', 'vm_ids': denied}), 403
+    
+    sites = [members[vcenter_id] for vcenter_id in requested]
+    
+    def site_metrics(vcenter_id, session):
+        # Keeps the site's collector running so its history stays current
+        get_metrics_collector(session, get_inventory_cache(session))
+        store = get_metrics_store(session['host'])
+        return [
+            dict(store.query(moref, start, end, step), id=moref, **{'from': start, 'to': end})
+            for moref in requested[vcenter_id]
+        ]
+    
+    results, statuses = federated(dict(federation_record, members=sites), site_metrics, timeout)
+    return federated_response('metrics', federation.merged(results, sites), statuses)
+
+@app.route('/vcenter/federation/vms/search', methods=['GET'])
+def search_federated_vms():
+    """Search the VMs of every vCenter of the federation; takes the arguments of /vcenter/vms/search.
+
+    Each vCenter answers from its own indexes with its first offset + limit
+    matches, which are merged into the requested page.
+    """
+    federation_record = get_federation_from_request()
+    if not federation_record:
+        return jsonify({'error': 'Unauthorized or federation expired'}), 401
+    
+    try:
+        timeout = site_timeout()
+        arguments = search_arguments()
+    except ValueError as e:
+        return jsonify({'error': f'Invalid search: {str(e)}'}), 400
+    
+    user = get_app_user_from_request()
+    site_arguments = dict(arguments, offset=0, limit=arguments['offset'] + arguments['limit'])
+    
+    def site_search(vcenter_id, session):
+        visible = visible_vm_ids(user, session['host'])
+        cache = get_inventory_cache(session)
+        if not cache.wait_ready(timeout):
+            raise RuntimeError(cache.last_error or 'inventory still loading')
+        total, vm_ids = get_search_index(session['host'], cache).search(visible=visible, **site_arguments)
+        entries = with_usage(cache.get_entries(vm_ids), get_metrics_collector(session, cache))
+        return total, [federation.tag(vcenter_id, entry) for entry in entries]
+    
+    results, statuses = federated(federation_record, site_search, timeout)
+    page = search.merge_pages(
+        [entries for _, entries in results.values()],
+        arguments['sort'], arguments['descending'], arguments['offset'], arguments['limit']
+    )
+    return federated_response('vms', page, statuses, total=sum(total for total, _ in results.values()))
+
+def get_federation_from_request():
+    """Get the federation named by the request's Authorization header."""
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    
+    return session_registry.get_federation(auth_header.split(' ')[1])
+
+def site_timeout():
+    """Return the per-site timeout of a federated query; the timeout argument may only shorten it"""
+    timeout = request.args.get('timeout', federation.SITE_TIMEOUT, type=float)
+    if not 0 < timeout <= federation.SITE_TIMEOUT:
+        raise ValueError(f"timeout must be between 0 and {federation.SITE_TIMEOUT:g} seconds")
+    return timeout
+
+def federated(federation_record, call, timeout):
+    """Run call(vcenter id, session) against every member vCenter in parallel; returns (results, statuses)"""
+    def run(member):
+        session = get_session(member['session_id'])
+        if session is None:
+            raise RuntimeError('vCenter session expired or unreachable')
+        return call(member['id'], session)
+    
+    return federation.fan_out(federation_record['members'], run, timeout)
+
+def federated_response(key, items, statuses, **extra):
+    """Merged federated results with per-vCenter status; 502 if no vCenter answered"""
+    answered = sum(1 for status in statuses if status['status'] == 'ok')
+    body = dict(extra, **{key: items, 'vcenters': statuses, 'partial': answered < len(statuses)})
+    if not answered:
+        body['error'] = 'No vCenter answered'
+        return jsonify(body), 502
+    return jsonify(body)
 
 def get_session_from_request():
     """Get the session from the request's Authorization header."""
@@ -355,28 +1614,101 @@ def get_session_from_request():
     if not auth_header or not auth_header.startswith('Bearer '):
         return None
     
-    session_id = auth_header.split(' ')[1]
-    if session_id in sessions:
-        # Check if session has expired (24 hour expiration)
-        if time.time() - sessions[session_id]['created_at'] > 86400:
-            try:
-                Disconnect(sessions[session_id]['service_instance'])
-            except:
-                pass
-            del sessions[session_id]
+    return get_session(auth_header.split(' ')[1])
+
+def get_session(session_id):
+    """Get an unexpired session by ID, attaching this worker to its vCenter connection."""
+    if not session_id:
+        return None
+    
+    # The shared store decides whether the session exists and has expired
+    record = session_registry.get(session_id)
+    if not record:
+        forget_session(session_id)
+        return None
+    
+    session = sessions.get(session_id)
+    if session is None:
+        # Created by another worker: borrow the vCenter session it logged in with
+        context = ssl._create_unverified_context() if record['ignore_ssl'] else None
+        try:
+            connection = vcenter_pool.acquire_borrowed(record['connection_id'], record['host'], context)
+        except Exception as e:
+            app.logger.warning("Could not attach to vCenter session for %s: %s", session_id, e)
             return None
-        return sessions[session_id]
+        
+        session = sessions.setdefault(session_id, {
+            'service_instance': connection.service_instance,
+            'connection': connection,
+            'host': record['host'],
+            'created_at': record['created_at']
+        })
     
-    return None
+    return session
+
+def forget_session(session_id):
+    """Drop this worker's claim on a session's vCenter connection."""
+    session = sessions.pop(session_id, None)
+    if session:
+        vcenter_pool.release(session['connection'])
+
+def get_principal_from_request():
+    """Get the application user of the request's bearer token, or None if it is missing, invalid or expired."""
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    
+    return get_principal(auth_header.split(' ')[1])
+
+def get_app_user_from_request():
+    """Get the application user from the X-User-Token header or user_token parameter."""
+    if 'app_user' in g:
+        return g.app_user
+    return get_principal(request.headers.get('X-User-Token') or request.args.get('user_token'))
+
+def get_principal(token):
+    """Verify a user token and return the user's cached role and VM assignments."""
+    user_id = token_signer.verify(token) if token else None
+    if not user_id:
+        return None
+    
+    return principals.get(user_id)
+
+def visible_vm_ids(user, host):
+    """Return the set of ids of a vCenter's VMs a user may see, or None for all VMs."""
+    if user['role'] == 'ADMIN':
+        return None
+    return user['assigned_vms'].get(host, frozenset())
+
+def publish_visibility(user_id):
+    """Push a user's changed VM assignments to their open event streams."""
+    user = principals.get(user_id)
+    if not user:
+        return
+    
+    for host, broker in list(event_brokers.items()):
+        broker.update_visibility(user_id, visible_vm_ids(user, host))
 
 def cleanup_sessions():
     """Clean up all vCenter sessions."""
-    for session_id in list(sessions.keys()):
-        try:
-            Disconnect(sessions[session_id]['service_instance'])
-        except:
-            pass
-        del sessions[session_id]
+    for cache in inventory_caches.values():
+        cache.checkpoint()
+        cache.stop()
+    for index in snapshot_indexes.values():
+        index.cache.stop()
+    for collector in metrics_collectors.values():
+        collector.stop()
+    for tracker in task_trackers.values():
+        tracker.stop()
+    for store in metrics_stores.values():
+        store.resign()
+    
+    sessions.clear()
+    vcenter_pool.close_all()
+    db.pool.close_all()
+
+# Disconnect all sessions when the app stops
+atexit.register(cleanup_sessions)
 
 if __name__ == '__main__':
     # Enable more detailed logging
@@ -0,0 +1,263 @@
+import io
+import os
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import app as wsgi
+import events
+
+# Threads per vCenter running blocking pyVmomi work; caps concurrent SOAP load on each vCenter
+VCENTER_WORKER_THREADS = int(os.environ.get('ASGI_VCENTER_THREADS', 32))
+
+# Threads for requests not tied to a vCenter session (auth, users, health)
+LOCAL_WORKER_THREADS = int(os.environ.get('ASGI_LOCAL_THREADS', 8))
+
+# Interval at which a new stream polls for the initial inventory load
+READY_POLL_SECONDS = 0.05
+
+EVENT_STREAM_PATH = '/vcenter/vms/events'
+
+# Per-vCenter executors, keyed by vCenter host
+vcenter_executors = {}
+vcenter_executors_lock = threading.Lock()
+
+local_executor = ThreadPoolExecutor(LOCAL_WORKER_THREADS, thread_name_prefix='api')
+
+def get_executor(host):
+    """Return the bounded executor for a vCenter, or the local one when host is None"""
+    if host is None:
+        return local_executor
+    with vcenter_executors_lock:
+        executor = vcenter_executors.get(host)
+        if executor is None:
+            executor = ThreadPoolExecutor(VCENTER_WORKER_THREADS, thread_name_prefix=f"vcenter-{host}")
+            vcenter_executors[host] = executor
+    return executor
+
+def request_host(environ):
+    """Return the vCenter host of a request's session if this worker already resolved it.
+
+    Unresolved sessions run on the local executor once; get_session then
+    records them so later requests go to their vCenter's executor.
+    """
+    auth_header = environ.get('HTTP_AUTHORIZATION', '')
+    if not auth_header.startswith('Bearer '):
+        return None
+    session = wsgi.sessions.get(auth_header.split(' ')[1])
+    return session['host'] if session else None
+
+def build_environ(scope, body):
+    """Translate an ASGI HTTP scope into a WSGI environ"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+
+    return environ
+
+def call_wsgi(environ):
+    """Run the Flask app for one request and return (status, headers, body).
+
+    body is bytes, or for streamed responses (no Content-Length) an
+    iterator whose chunks are produced on the executor as they are sent.
+    """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    result = wsgi.app(environ, start_response)
+    headers = encode_headers(started['headers'])
+    if not any(name == b'content-length' for name, _ in headers):
+        return started['status'], headers, result
+
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    return started['status'], headers, body
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+async def read_body(receive):
+    """Return the request body, or None if the client went away first"""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+async def send_response(send, status, headers, body):
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_streamed_response(send, executor, status, headers, result):
+    """Send a streamed WSGI body, producing each chunk on the executor"""
+    loop = asyncio.get_running_loop()
+    chunks = iter(result)
+    try:
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        while True:
+            chunk = await loop.run_in_executor(executor, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+async def watch_disconnect(receive, disconnected, wakeup):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    disconnected.set()
+    wakeup.set()
+
+async def stream_vm_events(environ, receive, send):
+    """Serve /vcenter/vms/events without holding a thread per stream"""
+    loop = asyncio.get_running_loop()
+
+    def open_stream():
+        with wsgi.app.request_context(environ):
+            stream, error = wsgi.open_vm_event_stream()
+            if error:
+                response = wsgi.app.make_response(error)
+                return None, (response.status_code, encode_headers(response.headers.items()), response.get_data())
+            return stream, None
+
+    stream, error = await loop.run_in_executor(get_executor(request_host(environ)), open_stream)
+    if error:
+        await send_response(send, *error)
+        return
+
+    cache, broker, subscriber, since, service_instance = stream
+    executor = get_executor(cache.name)
+    ready = asyncio.Event()
+    disconnected = asyncio.Event()
+    subscriber.wakeup = lambda: loop.call_soon_threadsafe(ready.set)
+    watcher = asyncio.create_task(watch_disconnect(receive, disconnected, ready))
+
+    async def send_text(text):
+        await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+
+        # Wait for the initial inventory load here rather than in a pool thread
+        deadline = loop.time() + wsgi.INVENTORY_READY_TIMEOUT
+        while not cache.ready.is_set() and loop.time() < deadline and not disconnected.is_set():
+            await asyncio.sleep(READY_POLL_SECONDS)
+
+        last_version, message = await loop.run_in_executor(executor, wsgi.first_vm_event, cache, subscriber, since)
+        await send_text(message)
+
+        # No version means the first message reported an error
+        while last_version is not None and not disconnected.is_set():
+            ready.clear()
+            pending = subscriber.get(0)
+            if not pending and not subscriber.overflowed:
+                try:
+                    await asyncio.wait_for(ready.wait(), events.HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                if disconnected.is_set():
+                    break
+                pending = subscriber.get(0)
+
+            if subscriber.overflowed:
+                # Rebuilding the snapshot serializes the whole inventory; keep it off the loop
+                last_version, messages = await loop.run_in_executor(
+                    executor, wsgi.next_vm_events, cache, subscriber, pending, last_version
+                )
+            else:
+                last_version, messages = wsgi.next_vm_events(cache, subscriber, pending, last_version)
+
+            if not messages:
+                # Keep proxies from closing the stream and the inventory feed from idling out
+                cache.attach(service_instance)
+                await send_text(': keepalive\n\n')
+                continue
+
+            await send_text(''.join(messages))
+    finally:
+        subscriber.wakeup = None
+        broker.unsubscribe(subscriber)
+        watcher.cancel()
+
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            wsgi.cleanup_sessions()
+            local_executor.shutdown(wait=False)
+            for executor in list(vcenter_executors.values()):
+                executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    """ASGI entry point serving the Flask routes of app.py.
+
+    Views run on a bounded thread pool per vCenter so the event loop never
+    waits on SOAP calls; event streams are served natively on the loop.
+    """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body = await read_body(receive)
+    if body is None:
+        return
+
+    environ = build_environ(scope, body)
+    if scope['path'] == EVENT_STREAM_PATH and scope['method'] == 'GET':
+        await stream_vm_events(environ, receive, send)
+        return
+
+    executor = get_executor(request_host(environ))
+    status, headers, body = await asyncio.get_running_loop().run_in_executor(executor, call_wsgi, environ)
+    if isinstance(body, bytes):
+        await send_response(send, status, headers, body)
+    else:
+        await send_streamed_response(send, executor, status, headers, body)
@@ -0,0 +1,264 @@
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+# Seconds an issued token stays valid
+TOKEN_TTL = int(os.environ.get('AUTH_TOKEN_TTL', 43200))
+
+# Key signing tokens; generated once and shared by all workers through a file when not set
+AUTH_SECRET = os.environ.get('AUTH_SECRET')
+AUTH_SECRET_FILE = os.environ.get(
+    'AUTH_SECRET_FILE',
+    os.path.join(os.path.dirname(os.environ.get('DB_FILE', '/app/data/vm_captain.db')), 'auth_secret')
+)
+
+# PBKDF2-SHA256 iterations for new password hashes; stored hashes with fewer are upgraded at login
+PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 310000))
+
+PASSWORD_HASH_ALGORITHM = 'pbkdf2_sha256'
+
+# Principals (role and assigned VMs) kept in memory per worker; the least recently used are dropped first
+PRINCIPAL_CACHE_SIZE = int(os.environ.get('PRINCIPAL_CACHE_SIZE', 1024))
+
+# Touched on every user write so the principal caches of all workers drop their entries
+PRINCIPAL_STAMP_FILE = os.environ.get(
+    'PRINCIPAL_STAMP_FILE',
+    os.path.join(os.path.dirname(os.environ.get('DB_FILE', '/app/data/vm_captain.db')), 'principals.stamp')
+)
+
+# Bytes the stamp file may grow to before it starts over
+STAMP_FILE_LIMIT = 4096
+
+# Logins hashing passwords at once, and logins allowed to wait for one of them
+LOGIN_WORKERS = int(os.environ.get('LOGIN_WORKERS', 2))
+LOGIN_QUEUE_SIZE = int(os.environ.get('LOGIN_QUEUE_SIZE', 32))
+
+# Seconds a login request waits for its turn and its password check
+LOGIN_TIMEOUT = float(os.environ.get('LOGIN_TIMEOUT', 10))
+
+TOKEN_VERSION = 'v1'
+
+def load_secret(path=AUTH_SECRET_FILE):
+    """Return the signing key, creating it on first use; the first worker to start writes it"""
+    if AUTH_SECRET:
+        return AUTH_SECRET.encode()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Another worker may still be writing it
+        for _ in range(50):
+            with open(path, 'rb') as f:
+                key = f.read().strip()
+            if key:
+                return key
+            time.sleep(0.01)
+        raise RuntimeError(f"Empty auth secret file: {path}")
+
+    key = secrets.token_hex(32).encode()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+def derive_key(secret, purpose):
+    """Return a key for one purpose derived from the auth secret, so no two uses share a key"""
+    return hmac.new(secret, f"vm-captain:{purpose}".encode(), hashlib.sha256).digest()
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+class TokenSigner:
+    """Issues and verifies HMAC-signed, expiring user tokens; no storage is involved"""
+
+    def __init__(self, key, ttl=TOKEN_TTL):
+        self.key = key
+        self.ttl = ttl
+
+    def issue(self, user_id):
+        """Return (token, expiry epoch) for a user"""
+        expires_at = int(time.time()) + self.ttl
+        payload = b64encode(json.dumps({'sub': user_id, 'exp': expires_at}, separators=(',', ':')).encode())
+        return f"{TOKEN_VERSION}.{payload}.{self._sign(payload)}", expires_at
+
+    def verify(self, token):
+        """Return the user id of a valid, unexpired token, else None"""
+        try:
+            version, payload, signature = token.split('.')
+        except (AttributeError, ValueError):
+            return None
+        if version != TOKEN_VERSION or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            claims = json.loads(b64decode(payload))
+        except ValueError:
+            return None
+        if not isinstance(claims, dict) or not isinstance(claims.get('exp'), int) or claims['exp'] <= time.time():
+            return None
+        return claims.get('sub')
+
+    def _sign(self, payload):
+        return b64encode(hmac.new(self.key, f"{TOKEN_VERSION}.{payload}".encode(), hashlib.sha256).digest())
+
+def hash_password(password, iterations=PASSWORD_HASH_ITERATIONS):
+    """Return a salted PBKDF2 hash of a password as algorithm$iterations$salt$hash"""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return f"{PASSWORD_HASH_ALGORITHM}${iterations}${b64encode(salt)}${b64encode(digest)}"
+
+def is_password_hash(stored):
+    return stored.startswith(f"{PASSWORD_HASH_ALGORITHM}$")
+
+def verify_password(password, stored):
+    """Return (matches, needs rehash) for a password against a stored hash.
+
+    Plaintext passwords left by older versions still match, and are
+    reported for rehashing like hashes with fewer iterations than configured.
+    """
+    if not is_password_hash(stored):
+        return hmac.compare_digest(password.encode(), stored.encode()), True
+
+    try:
+        _, iterations, salt, digest = stored.split('$')
+        iterations = int(iterations)
+        expected = b64decode(digest)
+        salt = b64decode(salt)
+    except ValueError:
+        return False, False
+    actual = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return hmac.compare_digest(actual, expected), iterations < PASSWORD_HASH_ITERATIONS
+
+def waste_password_check(password):
+    """Spend the time of a password check, so failing logins of unknown users are not told apart"""
+    hashlib.pbkdf2_hmac('sha256', password.encode(), bytes(16), PASSWORD_HASH_ITERATIONS)
+
+def principal(user):
+    """Return the fields of a user needed to authorize requests"""
+    return {
+        'id': user['id'],
+        'username': user['username'],
+        'role': user['role'],
+        'assigned_vms': assigned_by_vcenter(user.get('assigned_vms', ())),
+    }
+
+def assigned_by_vcenter(assigned_vms):
+    """Group {'vcenter', 'vm_id'} assignments into {vcenter host: frozenset of VM ids}"""
+    grouped = {}
+    for vm in assigned_vms:
+        grouped.setdefault(vm['vcenter'], set()).add(vm['vm_id'])
+    return {vcenter: frozenset(vm_ids) for vcenter, vm_ids in grouped.items()}
+
+class PrincipalCache:
+    """LRU cache of principals by user id, so authorizing a request needs no database query.
+
+    Writes to a user call invalidate(), which drops the local entry and
+    touches a stamp file; every worker clears its cache when it sees the
+    stamp change, at the cost of one stat per lookup.
+    """
+
+    def __init__(self, load, size=PRINCIPAL_CACHE_SIZE, stamp_file=PRINCIPAL_STAMP_FILE):
+        self.load = load
+        self.size = size
+        self.stamp_file = stamp_file
+        self.counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        self._entries = OrderedDict()
+        self._stamp = self._read_stamp()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Return the user's principal, or None if there is no such user"""
+        stamp = self._read_stamp()
+        with self._lock:
+            if stamp != self._stamp:
+                self._stamp = stamp
+                self._entries.clear()
+            if user_id in self._entries:
+                self._entries.move_to_end(user_id)
+                self.counters['hits'] += 1
+                return self._entries[user_id]
+            self.counters['misses'] += 1
+
+        user = self.load(user_id)
+        found = principal(user) if user else None
+        with self._lock:
+            # A write during the load changed the stamp; keep what may predate it out of the cache
+            if self._read_stamp() == stamp == self._stamp:
+                self._entries[user_id] = found
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return found
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self.counters['invalidations'] += 1
+        try:
+            # Growing the file changes the stamp even within one mtime tick
+            with open(self.stamp_file, 'ab') as f:
+                f.write(b'.')
+                if f.tell() > STAMP_FILE_LIMIT:
+                    f.truncate(0)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, size=len(self._entries))
+
+    def _read_stamp(self):
+        try:
+            stat = os.stat(self.stamp_file)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+def login_executor(workers):
+    """Return an executor whose workers are OS threads, also in a gevent worker"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        monkey = None
+    if monkey is not None and monkey.is_module_patched('threading'):
+        # Patched threads are greenlets sharing the worker's one OS thread,
+        # which hashing would block; gevent's pool runs on real threads
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        return NativeThreadPoolExecutor(workers)
+    return ThreadPoolExecutor(workers, thread_name_prefix='login')
+
+class Busy(Exception):
+    """Raised when the login pool's queue is full"""
+
+class LoginPool:
+    """A few threads hashing passwords, with a bounded queue in front of them.
+
+    Password hashing is deliberately slow; running it here keeps a burst of
+    logins from occupying every API worker thread. Logins beyond the queue
+    are rejected at once instead of piling up. Under gevent these are native
+    threads, so what runs here must not touch patched locks or queues.
+    """
+
+    def __init__(self, workers=LOGIN_WORKERS, queue_size=LOGIN_QUEUE_SIZE):
+        self._executor = login_executor(workers)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def run(self, fn, *args, timeout=LOGIN_TIMEOUT):
+        """Run fn(*args) on the pool and return its result; raises Busy, or TimeoutError after timeout"""
+        if not self._slots.acquire(blocking=False):
+            raise Busy('too many logins in progress')
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            # Only an alias of the builtin from Python 3.11
+            raise TimeoutError('timed out waiting for the login pool') from None
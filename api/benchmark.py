@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import sqlite3
+import tempfile
+import threading
+import time
+from pyVmomi import vim
+import inventory
+from fake_vcenter import FakeVCenter
+
+def legacy_vm_list(service_instance):
+    """Per-attribute VM list traversal used by get_vms before the PropertyCollector change"""
+    content = service_instance.RetrieveContent()
+    container = content.viewManager.CreateContainerView(
+        content.rootFolder, [vim.VirtualMachine], True
+    )
+
+    vms = []
+    for vm in container.view:
+        power_state = str(vm.runtime.powerState) if vm.runtime and hasattr(vm.runtime, 'powerState') else 'UNKNOWN'
+        vm_data = {
+            'id': vm._moId,
+            'name': vm.name,
+            'power_state': power_state,
+            'guest_full_name': vm.config.guestFullName if vm.config else 'Unknown',
+        }
+        if vm.guest and vm.guest.ipAddress:
+            vm_data['ip_address'] = vm.guest.ipAddress
+        vms.append(vm_data)
+
+    container.Destroy()
+    return vms
+
+def property_collector_vm_list(service_instance):
+    """VM list traversal as done by get_vms"""
+    return [inventory.vm_list_entry(vm_id, props)
+            for vm_id, props in inventory.iter_vm_properties(service_instance)]
+
+def bench_inventory(sizes, latency):
+    """Compare round-trips and wall time of both VM list strategies"""
+    print(f"{'VMs':>8} {'strategy':>20} {'round-trips':>12} {'seconds':>10}")
+    for size in sizes:
+        vcenter = FakeVCenter(vm_count=size, latency=latency)
+        service_instance = vcenter.service_instance()
+
+        for name, fn in (('legacy', legacy_vm_list), ('property-collector', property_collector_vm_list)):
+            vcenter.reset_calls()
+            start = time.perf_counter()
+            vms = fn(service_instance)
+            elapsed = time.perf_counter() - start
+            assert len(vms) == size
+            print(f"{size:>8} {name:>20} {vcenter.round_trips:>12} {elapsed:>10.3f}")
+
+def legacy_get_user_by_id(db_file, user_id):
+    """get_user_by_id as done before the connection pool: one connection per call"""
+    conn = sqlite3.connect(db_file)
+    conn.row_factory = sqlite3.Row
+    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    conn.close()
+    return user
+
+def legacy_update_user_password(db_file, user_id, password):
+    conn = sqlite3.connect(db_file)
+    conn.execute('UPDATE users SET password = ? WHERE id = ?', (password, user_id))
+    conn.commit()
+    conn.close()
+
+def run_contended(read, write, threads, duration):
+    """Run reader threads and one writer for duration; returns (reads/s, writes/s, errors)"""
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def loop(fn, counter):
+        done = errors = 0
+        while time.perf_counter() < deadline:
+            try:
+                fn()
+                done += 1
+            except sqlite3.OperationalError:
+                errors += 1
+        with lock:
+            counts[counter] += done
+            counts['errors'] += errors
+
+    workers = [threading.Thread(target=loop, args=(read, 'reads')) for _ in range(threads)]
+    workers.append(threading.Thread(target=loop, args=(write, 'writes')))
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return counts['reads'] / duration, counts['writes'] / duration, counts['errors']
+
+def bench_db(iterations, threads, duration):
+    """Compare per-call connections in rollback journal mode with the pooled WAL connections"""
+    data_dir = tempfile.mkdtemp(prefix='vmc-bench-')
+    os.environ['DB_FILE'] = os.path.join(data_dir, 'pooled.db')
+    # Writes measure SQLite contention, not password hashing cost
+    os.environ.setdefault('PASSWORD_HASH_ITERATIONS', '1000')
+    import auth
+    import db_models
+
+    # Same schema and rows, left in SQLite's default rollback journal mode
+    legacy_file = os.path.join(data_dir, 'legacy.db')
+    with db_models.db_connection() as conn:
+        conn.execute("VACUUM INTO ?", (legacy_file,))
+    legacy = sqlite3.connect(legacy_file)
+    legacy.execute('PRAGMA journal_mode=DELETE')
+    legacy.close()
+
+    # Both writers hash the password like update_user_password, so only the connection handling differs
+    strategies = (
+        ('per-call', lambda: legacy_get_user_by_id(legacy_file, 'admin-1'),
+         lambda: legacy_update_user_password(legacy_file, 'user-1', auth.hash_password('123456'))),
+        ('pooled-wal', lambda: db_models.get_user_by_id('admin-1'),
+         lambda: db_models.update_user_password('user-1', '123456')),
+    )
+
+    print(f"{'strategy':>12} {'us/call':>9} {'threads':>8} {'reads/s':>10} {'writes/s':>10} {'errors':>7}")
+    for name, read, write in strategies:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            read()
+        per_call = (time.perf_counter() - start) / iterations * 1e6
+
+        reads, writes, errors = run_contended(read, write, threads, duration)
+        print(f"{name:>12} {per_call:>9.1f} {threads:>8} {reads:>10.0f} {writes:>10.0f} {errors:>7}")
+
+def main():
+    parser = argparse.ArgumentParser(description='VM Captain API benchmarks against a fake vCenter')
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='Comma separated inventory sizes')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Simulated per-call vCenter latency in seconds')
+    parser.add_argument('--suites', default='inventory',
+                        help='Comma separated suites to run: inventory, db')
+    parser.add_argument('--db-iterations', type=int, default=5000,
+                        help='Sequential get_user_by_id calls timed by the db suite')
+    parser.add_argument('--db-threads', type=int, default=8,
+                        help='Concurrent reader threads in the db suite')
+    parser.add_argument('--db-duration', type=float, default=3.0,
+                        help='Seconds of contended reads and writes in the db suite')
+    args = parser.parse_args()
+
+    suites = args.suites.split(',')
+    if 'inventory' in suites:
+        sizes = [int(size) for size in args.sizes.split(',')]
+        bench_inventory(sizes, args.latency)
+    if 'db' in suites:
+        bench_db(args.db_iterations, args.db_threads, args.db_duration)
+
+if __name__ == '__main__':
+    main()
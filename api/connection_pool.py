@@ -0,0 +1,323 @@
+import os
+import time
+import hmac
+import hashlib
+import logging
+import threading
+from http.client import HTTPException
+from pyVim.connect import SmartConnect, SmartStubAdapter, Disconnect
+from pyVmomi import vim, SoapAdapter
+from pyVmomi.StubAdapterAccessorImpl import StubAdapterAccessorMixin
+import admission
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Maximum concurrent SOAP calls per pooled vCenter connection
+MAX_CALLS_PER_CONNECTION = int(os.environ.get('VCENTER_MAX_CALLS_PER_CONNECTION', 8))
+
+# Seconds between CurrentTime keepalive calls
+KEEPALIVE_INTERVAL = int(os.environ.get('VCENTER_KEEPALIVE_INTERVAL', 300))
+
+# Seconds an unused connection stays logged in before it is closed
+IDLE_TIMEOUT = int(os.environ.get('VCENTER_POOL_IDLE_TIMEOUT', 1800))
+
+def connection_key(secret, host, username, password, ignore_ssl):
+    """Return the opaque pool key for a set of credentials.
+
+    Keys are stored with the sessions, so they are keyed with a secret the
+    store does not hold; a plain hash would let the password be guessed
+    offline from a copy of the store.
+    """
+    return hmac.new(
+        secret, f"{host}\0{username}\0{password}\0{bool(ignore_ssl)}".encode(), hashlib.sha256
+    ).hexdigest()
+
+def attach_session(host, cookie, sslContext=None):
+    """Return a ServiceInstance that reuses an existing vCenter session cookie"""
+    stub = SmartStubAdapter(host=host, sslContext=sslContext)
+    stub.cookie = cookie
+    return vim.ServiceInstance('ServiceInstance', stub)
+
+class PooledStub(StubAdapterAccessorMixin):
+    """Stub wrapper that caps concurrent calls and logs in again on NotAuthenticated.
+
+    Managed objects returned through it keep a reference to the wrapper, so
+    every call made on them is timed and survives a re-login, and every call
+    but a long poll passes admission control for its vCenter and is throttled.
+    """
+
+    def __init__(self, connection, stub):
+        self.connection = connection
+        self.stub = stub
+        self.version = stub.version
+
+    def InvokeMethod(self, mo, info, args):
+        connection = self.connection
+        # Long polls block by design: they take no call slot and do not feed
+        # the admission limit, or the feeds would crowd out interactive calls
+        if info.wsdlName in admission.EXEMPT_METHODS:
+            controller = semaphore = None
+        else:
+            controller, semaphore = connection.admission, connection.semaphore
+            controller.acquire(admission.current_class())
+            if not semaphore.acquire(blocking=False):
+                connection.pool.count('waits')
+                semaphore.acquire()
+
+        started = time.perf_counter()
+        failed = True
+        congested = False
+        try:
+            stub = self.stub
+            try:
+                result = self._invoke(stub, mo, info, args)
+            except vim.fault.NotAuthenticated:
+                connection.relogin(stub)
+                result = self._invoke(self.stub, mo, info, args)
+            failed = False
+            return result
+        except (OSError, HTTPException):
+            # Refused or dropped connections are the clearest sign of an overloaded vCenter
+            congested = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            if controller is not None:
+                semaphore.release()
+                controller.release(elapsed, congested)
+            instrumentation.record_vcenter_call(info.wsdlName, elapsed, failed)
+
+    def _invoke(self, stub, mo, info, args):
+        result = stub.InvokeMethod(mo, info, args, outerStub=self)
+        if isinstance(stub, SoapAdapter.SoapStubAdapter):
+            # Given an outer stub, the SOAP adapter returns (status, result) and leaves faults to the caller
+            status, result = result
+            if status != 200:
+                raise result
+        return result
+
+class PooledConnection:
+    """One authenticated vCenter session shared by all API sessions with the same credentials.
+
+    A connection created without credentials is borrowed: it attaches to the
+    session cookie published by the worker that logged in.
+    """
+
+    def __init__(self, pool, key, host, ssl_context, username=None, password=None):
+        self.pool = pool
+        self.key = key
+        self.host = host
+        self.username = username
+        self._password = password
+        self._ssl_context = ssl_context
+        self.semaphore = threading.BoundedSemaphore(pool.max_calls)
+        self.admission = pool.admission_for(host)
+        self.users = 0
+        self.created_at = time.time()
+        self.last_used = time.time()
+        self._login_lock = threading.Lock()
+
+        self.stub = PooledStub(self, self._login())
+        self.service_instance = vim.ServiceInstance('ServiceInstance', self.stub)
+
+    @property
+    def borrowed(self):
+        return self._password is None
+
+    def _login(self, failed_stub=None):
+        if self.borrowed:
+            # Only the owning worker can log in again; pick up its newest cookie
+            cookie = self.pool.lookup_cookie(self.key) if self.pool.lookup_cookie else None
+            if not cookie or (failed_stub is not None and cookie == failed_stub.cookie):
+                raise RuntimeError('vCenter session expired, reconnect required')
+            return self.pool.attach(host=self.host, cookie=cookie, sslContext=self._ssl_context)._stub
+
+        service_instance = self.pool.connect(
+            host=self.host,
+            user=self.username,
+            pwd=self._password,
+            sslContext=self._ssl_context
+        )
+        if not service_instance:
+            raise RuntimeError('authentication failed')
+
+        if self.pool.publish_cookie:
+            self.pool.publish_cookie(self.key, self.host, service_instance._stub.cookie)
+        return service_instance._stub
+
+    def relogin(self, failed_stub):
+        """Replace an expired vCenter session; concurrent callers log in only once"""
+        with self._login_lock:
+            if self.stub.stub is failed_stub:
+                logger.info("Re-authenticating pooled vCenter connection to %s", self.host)
+                self.stub.stub = self._login(failed_stub)
+                self.pool.count('reconnects')
+
+    def keepalive(self):
+        """Issue a cheap call so vCenter does not expire the session"""
+        self.service_instance.CurrentTime()
+
+    def close(self):
+        if self.borrowed:
+            # Logging out would end the owner's vCenter session too
+            return
+        try:
+            Disconnect(vim.ServiceInstance('ServiceInstance', self.stub.stub))
+        except Exception:
+            pass
+
+class ConnectionPool:
+    """Pool of authenticated vCenter connections keyed by (host, credentials)"""
+
+    def __init__(self, key_secret, connect=SmartConnect, attach=attach_session, max_calls=MAX_CALLS_PER_CONNECTION,
+                 keepalive_interval=KEEPALIVE_INTERVAL, idle_timeout=IDLE_TIMEOUT):
+        # Keys connection_key, so pool keys reveal nothing about credentials
+        self.key_secret = key_secret
+        self.connect = connect
+        self.attach = attach
+        # Optional callbacks sharing session cookies between workers:
+        # publish_cookie(key, host, cookie) and lookup_cookie(key) -> cookie
+        self.publish_cookie = None
+        self.lookup_cookie = None
+        # Optional callbacks sharing when any worker last used a connection:
+        # touch_cookie(key, used_at) and cookie_last_used(key) -> timestamp
+        self.touch_cookie = None
+        self.cookie_last_used = None
+        self.max_calls = max_calls
+        self.keepalive_interval = keepalive_interval
+        self.idle_timeout = idle_timeout
+        self.counters = {'hits': 0, 'misses': 0, 'waits': 0, 'reconnects': 0, 'keepalive_failures': 0}
+        self._connections = {}
+        # One admission controller per vCenter, shared by all its connections
+        self._admission = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._keepalive_thread = None
+        self._stopping = threading.Event()
+
+    def count(self, counter):
+        self.counters[counter] += 1
+
+    def acquire(self, host, username, password, ssl_context=None, ignore_ssl=False):
+        """Return a connection for these credentials, logging in only if none is pooled"""
+        key = connection_key(self.key_secret, host, username, password, ignore_ssl)
+        connection = self._acquire(key, lambda: PooledConnection(
+            self, key, host, ssl_context, username=username, password=password
+        ))
+
+        # A connection borrowed earlier becomes owned, so this worker can log in again
+        if connection.borrowed:
+            connection.username = username
+            connection._password = password
+        return connection
+
+    def acquire_borrowed(self, key, host, ssl_context=None):
+        """Return a connection for a key another worker logged in with"""
+        return self._acquire(key, lambda: PooledConnection(self, key, host, ssl_context))
+
+    def _acquire(self, key, factory):
+        # Serialize logins per key so a burst of identical logins connects once
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            connection = self._connections.get(key)
+            if connection is not None:
+                self.count('hits')
+            else:
+                self.count('misses')
+                connection = factory()
+                with self._lock:
+                    self._connections[key] = connection
+
+            connection.users += 1
+            connection.last_used = time.time()
+
+        self._ensure_keepalive()
+        return connection
+
+    def admission_for(self, host):
+        """Return the admission controller of a vCenter"""
+        with self._lock:
+            controller = self._admission.get(host)
+            if controller is None:
+                controller = self._admission[host] = admission.AdmissionController(host)
+            return controller
+
+    def admission_stats(self):
+        with self._lock:
+            controllers = list(self._admission.values())
+        return {controller.name: controller.stats() for controller in controllers}
+
+    def release(self, connection):
+        """Drop one API session's claim; the connection stays pooled until idle"""
+        with self._lock:
+            connection.users = max(0, connection.users - 1)
+            connection.last_used = time.time()
+
+    def stats(self):
+        with self._lock:
+            connections = list(self._connections.values())
+        return dict(self.counters, **{
+            'size': len(connections),
+            'in_use': sum(1 for c in connections if c.users),
+            'max_calls_per_connection': self.max_calls,
+            'admission': self.admission_stats(),
+        })
+
+    def close_all(self):
+        self._stopping.set()
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+    def _ensure_keepalive(self):
+        with self._lock:
+            if self._keepalive_thread is None or not self._keepalive_thread.is_alive():
+                self._stopping.clear()
+                self._keepalive_thread = threading.Thread(
+                    target=self._keepalive_loop, name='vcenter-keepalive', daemon=True
+                )
+                self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        while not self._stopping.wait(self.keepalive_interval):
+            with self._lock:
+                connections = list(self._connections.values())
+
+            for connection in connections:
+                try:
+                    if self.touch_cookie:
+                        self.touch_cookie(connection.key, time.time() if connection.users else connection.last_used)
+                    idle = self._idle(connection)
+                except Exception as e:
+                    logger.warning("Could not share the use of %s: %s", connection.host, e)
+                    idle = False
+
+                if idle:
+                    with self._lock:
+                        self._connections.pop(connection.key, None)
+                    logger.info("Closing idle pooled vCenter connection to %s", connection.host)
+                    connection.close()
+                    continue
+
+                try:
+                    # NotAuthenticated is handled by the stub with a re-login
+                    connection.keepalive()
+                except Exception as e:
+                    self.count('keepalive_failures')
+                    logger.warning("Keepalive for %s failed: %s", connection.host, e)
+
+    def _idle(self, connection):
+        """Whether a connection can be closed; an owned one also needs every other worker to be done with it"""
+        now = time.time()
+        if connection.users or now - connection.last_used <= self.idle_timeout:
+            return False
+        if connection.borrowed or not self.cookie_last_used:
+            return True
+        # Other workers may still be borrowing the cookie, and logging out would end their session too
+        used_at = self.cookie_last_used(connection.key)
+        return used_at is None or now - used_at > self.idle_timeout
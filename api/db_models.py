@@ -1,12 +1,50 @@
 
 import sqlite3
 import os
+import re
+import time
 import json
+import queue
+from contextlib import contextmanager
 from datetime import datetime
+import auth
+import instrumentation
 
 # Database file path
 DB_FILE = os.environ.get('DB_FILE', '/app/data/vm_captain.db')
 
+# Idle connections kept open per process
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+
+# Seconds a writer waits for the write lock before failing
+DB_BUSY_TIMEOUT = 5
+
+# Prepared statements cached per connection
+STATEMENT_CACHE_SIZE = 64
+
+# Applied to every new connection. WAL lets readers in every worker proceed
+# while one connection writes; NORMAL sync is durable across app crashes in WAL mode.
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT * 1000}',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+    'PRAGMA mmap_size=67108864',
+    'PRAGMA foreign_keys=ON',
+)
+
+# Bumped by every schema migration in initialize_database
+SCHEMA_VERSION = 2
+
+# vCenter host of VM assignments that do not name one: those made before
+# assignments recorded their vCenter, and those of clients that leave it out
+_configured_vcenter = re.match(r'https?://([^/]+)', os.environ.get('VITE_VCENTER_URL', ''))
+DEFAULT_VCENTER = _configured_vcenter.group(1) if _configured_vcenter else ''
+
+# Called with a user id after a write to that user or their VM assignments
+user_change_listeners = []
+
 # Ensure the directory exists
 os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
 
@@ -17,233 +55,400 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+# Table a statement reads or writes, for labelling query timings
+TABLE_PATTERN = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+(\w+)', re.IGNORECASE)
+
+# Labels of the statements seen so far; statements are static strings, so this stays small
+statement_labels = {}
+
+def query_labels(sql):
+    """Return (operation, table) of a SQL statement"""
+    labels = statement_labels.get(sql)
+    if labels is None:
+        table = TABLE_PATTERN.search(sql)
+        labels = ((sql.split(None, 1) or [''])[0].upper(), table.group(1).lower() if table else '')
+        if len(statement_labels) < 1024:
+            statement_labels[sql] = labels
+    return labels
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording how long each statement takes"""
+    
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            instrumentation.record_query(*query_labels(sql), time.perf_counter() - started)
+    
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            instrumentation.record_query(*query_labels(sql), time.perf_counter() - started)
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors are timed, including those its execute shortcuts create"""
+    
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
 def get_db_connection():
     """Create a database connection and return it"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=DB_BUSY_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=TimedConnection
+    )
     conn.row_factory = dict_factory
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+class ConnectionPool:
+    """Thread-safe pool of open SQLite connections.
+    
+    Callers never wait for a connection: one is opened when none is idle,
+    and at most size idle connections are kept for reuse.
+    """
+    
+    def __init__(self, size=DB_POOL_SIZE, connect=get_db_connection):
+        self.connect = connect
+        self._idle = queue.LifoQueue(size)
+    
+    @contextmanager
+    def connection(self):
+        """Yield a connection, committing on success and rolling back on error"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+        
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+    
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+pool = ConnectionPool()
+
+def db_connection():
+    """Borrow a pooled connection for the duration of a with block"""
+    return pool.connection()
+
 def initialize_database():
-    """Create tables if they don't exist"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Create users table
+    """Create tables if they don't exist and migrate older schemas"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        # Workers start together; take the write lock so only one migrates
+        cursor.execute('BEGIN IMMEDIATE')
+        
+        # Create users table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL,
+            assigned_vms TEXT DEFAULT '[]'
+        )
+        ''')
+        
+        # VM assignments, one row per (user, vCenter host, VM moref); morefs are
+        # only unique within a vCenter. assigned_vms on users is no longer read.
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_vms (
+            user_id TEXT NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            vcenter TEXT NOT NULL,
+            vm_id TEXT NOT NULL,
+            PRIMARY KEY (user_id, vcenter, vm_id)
+        ) WITHOUT ROWID
+        ''')
+        
+        version = cursor.execute('PRAGMA user_version').fetchone()['user_version']
+        if version < 2:
+            migrate_user_vms_vcenter(cursor)
+        if version < 1:
+            migrate_assigned_vms(cursor)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_vms_vm ON user_vms (vcenter, vm_id)')
+        if version < SCHEMA_VERSION:
+            cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        
+        # Check if we need to add default users
+        cursor.execute("SELECT COUNT(*) as count FROM users")
+        result = cursor.fetchone()
+        
+        if result['count'] == 0:
+            # Add default users
+            default_users = [
+                {
+                    'id': 'admin-1',
+                    'username': 'admin',
+                    'password': auth.hash_password('123456'),
+                    'role': 'ADMIN',
+                    'assigned_vms': json.dumps([])
+                },
+                {
+                    'id': 'user-1',
+                    'username': 'user',
+                    'password': auth.hash_password('123456'),
+                    'role': 'USER',
+                    'assigned_vms': json.dumps([])
+                }
+            ]
+            
+            for user in default_users:
+                cursor.execute('''
+                INSERT INTO users (id, username, password, role, assigned_vms)
+                VALUES (?, ?, ?, ?, ?)
+                ''', (user['id'], user['username'], user['password'], user['role'], user['assigned_vms']))
+
+def migrate_user_vms_vcenter(cursor):
+    """Rebuild user_vms with a vcenter column, assigning existing rows to DEFAULT_VCENTER"""
+    columns = [row['name'] for row in cursor.execute('PRAGMA table_info(user_vms)')]
+    if 'vcenter' in columns:
+        return
+    if not DEFAULT_VCENTER and cursor.execute('SELECT 1 FROM user_vms LIMIT 1').fetchone():
+        print("VITE_VCENTER_URL is not set; VM assignments made before assignments named a vCenter grant nothing")
+    cursor.execute('ALTER TABLE user_vms RENAME TO user_vms_v1')
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id TEXT PRIMARY KEY,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        role TEXT NOT NULL,
-        assigned_vms TEXT DEFAULT '[]'
-    )
+    CREATE TABLE user_vms (
+        user_id TEXT NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        vcenter TEXT NOT NULL,
+        vm_id TEXT NOT NULL,
+        PRIMARY KEY (user_id, vcenter, vm_id)
+    ) WITHOUT ROWID
     ''')
-    
-    # Check if we need to add default users
-    cursor.execute("SELECT COUNT(*) as count FROM users")
-    result = cursor.fetchone()
-    
-    if result['count'] == 0:
-        # Add default users
-        default_users = [
-            {
-                'id': 'admin-1',
-                'username': 'admin',
-                'password': '123456',
-                'role': 'ADMIN',
-                'assigned_vms': json.dumps([])
-            },
-            {
-                'id': 'user-1',
-                'username': 'user',
-                'password': '123456',
-                'role': 'USER',
-                'assigned_vms': json.dumps([])
-            }
-        ]
-        
-        for user in default_users:
-            cursor.execute('''
-            INSERT INTO users (id, username, password, role, assigned_vms)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (user['id'], user['username'], user['password'], user['role'], user['assigned_vms']))
-    
-    conn.commit()
-    conn.close()
+    cursor.execute('INSERT INTO user_vms (user_id, vcenter, vm_id) SELECT user_id, ?, vm_id FROM user_vms_v1', (DEFAULT_VCENTER,))
+    cursor.execute('DROP TABLE user_vms_v1')
 
-def get_user_by_credentials(username, password):
-    """Find a user by username and password"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM users WHERE username = ? AND password = ?', (username, password))
-    user = cursor.fetchone()
-    
-    conn.close()
-    
-    if user and 'assigned_vms' in user:
-        user['assigned_vms'] = json.loads(user['assigned_vms'])
-    
+def migrate_assigned_vms(cursor):
+    """Move the JSON assigned_vms column into user_vms rows"""
+    rows = cursor.execute("SELECT id, assigned_vms FROM users WHERE assigned_vms NOT IN ('', '[]')").fetchall()
+    for row in rows:
+        try:
+            vm_ids = json.loads(row['assigned_vms'] or '[]')
+        except ValueError:
+            print(f"Skipping unreadable assigned_vms of user {row['id']}")
+            continue
+        cursor.executemany(
+            'INSERT OR IGNORE INTO user_vms (user_id, vcenter, vm_id) VALUES (?, ?, ?)',
+            [(row['id'], DEFAULT_VCENTER, vm_id) for vm_id in vm_ids]
+        )
+    cursor.execute("UPDATE users SET assigned_vms = '[]'")
+
+def notify_user_changed(user_id):
+    for listener in user_change_listeners:
+        listener(user_id)
+
+def with_assigned_vms(conn, user):
+    """Fill in a user row's assigned_vms list of {'vcenter', 'vm_id'} from user_vms"""
+    if user:
+        user['assigned_vms'] = conn.execute(
+            'SELECT vcenter, vm_id FROM user_vms WHERE user_id = ?', (user['id'],)
+        ).fetchall()
     return user
 
+def run_inline(fn, *args):
+    return fn(*args)
+
+def get_user_by_credentials(username, password, run_hash=run_inline):
+    """Find a user by username and password, upgrading an outdated password hash on success.
+
+    Password hashing goes through run_hash(fn, *args), e.g. a thread pool;
+    no connection is held meanwhile.
+    """
+    with db_connection() as conn:
+        user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+    if not user:
+        # Unknown usernames take as long as wrong passwords
+        run_hash(auth.waste_password_check, password)
+        return None
+    
+    matches, needs_rehash = run_hash(auth.verify_password, password, user['password'])
+    if not matches:
+        return None
+    if needs_rehash:
+        user['password'] = run_hash(auth.hash_password, password)
+    
+    with db_connection() as conn:
+        if needs_rehash:
+            conn.execute('UPDATE users SET password = ? WHERE id = ?', (user['password'], user['id']))
+        return with_assigned_vms(conn, user)
+
 def get_all_users():
     """Return all users"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM users')
-    users = cursor.fetchall()
-    
-    conn.close()
-    
-    # Convert assigned_vms from JSON string to list
+    with db_connection() as conn:
+        users = conn.execute('SELECT * FROM users').fetchall()
+        assignments = conn.execute('SELECT user_id, vcenter, vm_id FROM user_vms').fetchall()
+    
+    # One pass over user_vms instead of a query per user
+    assigned = {}
+    for row in assignments:
+        assigned.setdefault(row.pop('user_id'), []).append(row)
     for user in users:
-        if 'assigned_vms' in user:
-            user['assigned_vms'] = json.loads(user['assigned_vms'])
+        user['assigned_vms'] = assigned.get(user['id'], [])
     
     return users
 
 def get_user_by_id(user_id):
     """Find a user by ID"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-    user = cursor.fetchone()
-    
-    conn.close()
-    
-    if user and 'assigned_vms' in user:
-        user['assigned_vms'] = json.loads(user['assigned_vms'])
-    
-    return user
+    with db_connection() as conn:
+        user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+        return with_assigned_vms(conn, user)
 
 def add_user(user):
     """Add a new user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Check if username exists
-    cursor.execute('SELECT COUNT(*) as count FROM users WHERE username = ?', (user['username'],))
-    result = cursor.fetchone()
-    
-    if result['count'] > 0:
-        conn.close()
-        return False
-    
-    # Convert assigned_vms list to JSON string
-    assigned_vms_json = json.dumps(user.get('assigned_vms', []))
-    
     try:
-        cursor.execute('''
-        INSERT INTO users (id, username, password, role, assigned_vms)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (user['id'], user['username'], user['password'], user['role'], assigned_vms_json))
-        
-        conn.commit()
-        conn.close()
+        with db_connection() as conn:
+            # Check if username exists
+            result = conn.execute('SELECT COUNT(*) as count FROM users WHERE username = ?', (user['username'],)).fetchone()
+            
+            if result['count'] > 0:
+                return False
+            
+            conn.execute('''
+            INSERT INTO users (id, username, password, role)
+            VALUES (?, ?, ?, ?)
+            ''', (user['id'], user['username'], auth.hash_password(user['password']), user['role']))
+            conn.executemany(
+                'INSERT OR IGNORE INTO user_vms (user_id, vcenter, vm_id) VALUES (?, ?, ?)',
+                [(user['id'], vm['vcenter'], vm['vm_id']) for vm in user.get('assigned_vms', [])]
+            )
         return True
     except Exception as e:
         print(f"Error adding user: {str(e)}")
-        conn.close()
         return False
 
 def update_user(user):
-    """Update an existing user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Check if user exists
-    cursor.execute('SELECT COUNT(*) as count FROM users WHERE id = ?', (user['id'],))
-    result = cursor.fetchone()
-    
-    if result['count'] == 0:
-        conn.close()
-        return False
-    
-    # Convert assigned_vms list to JSON string
-    assigned_vms_json = json.dumps(user.get('assigned_vms', []))
-    
+    """Update an existing user, replacing their VM assignments; a plaintext password is hashed"""
+    password = user['password'] if auth.is_password_hash(user['password']) else auth.hash_password(user['password'])
     try:
-        cursor.execute('''
-        UPDATE users 
-        SET username = ?, password = ?, role = ?, assigned_vms = ?
-        WHERE id = ?
-        ''', (user['username'], user['password'], user['role'], assigned_vms_json, user['id']))
-        
-        conn.commit()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.execute('''
+            UPDATE users 
+            SET username = ?, password = ?, role = ?
+            WHERE id = ?
+            ''', (user['username'], password, user['role'], user['id']))
+            
+            # No row updated means the user does not exist
+            if cursor.rowcount == 0:
+                return False
+            
+            conn.execute('DELETE FROM user_vms WHERE user_id = ?', (user['id'],))
+            conn.executemany(
+                'INSERT OR IGNORE INTO user_vms (user_id, vcenter, vm_id) VALUES (?, ?, ?)',
+                [(user['id'], vm['vcenter'], vm['vm_id']) for vm in user.get('assigned_vms', [])]
+            )
+        notify_user_changed(user['id'])
         return True
     except Exception as e:
         print(f"Error updating user: {str(e)}")
-        conn.close()
         return False
 
 def delete_user(user_id):
     """Delete a user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
-        result = cursor.rowcount > 0
-        
-        conn.commit()
-        conn.close()
-        return result
+        with db_connection() as conn:
+            deleted = conn.execute('DELETE FROM users WHERE id = ?', (user_id,)).rowcount > 0
+        if deleted:
+            notify_user_changed(user_id)
+        return deleted
     except Exception as e:
         print(f"Error deleting user: {str(e)}")
-        conn.close()
         return False
 
 def update_user_password(user_id, new_password):
     """Update a user's password"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('UPDATE users SET password = ? WHERE id = ?', (new_password, user_id))
-        result = cursor.rowcount > 0
-        
-        conn.commit()
-        conn.close()
-        return result
+        with db_connection() as conn:
+            return conn.execute(
+                'UPDATE users SET password = ? WHERE id = ?', (auth.hash_password(new_password), user_id)
+            ).rowcount > 0
     except Exception as e:
         print(f"Error updating password: {str(e)}")
-        conn.close()
         return False
 
-def assign_vm_to_user(user_id, vm_id):
-    """Assign a VM to a user"""
-    user = get_user_by_id(user_id)
-    
-    if not user:
-        return False
-    
-    assigned_vms = user.get('assigned_vms', [])
-    
-    if vm_id not in assigned_vms:
-        assigned_vms.append(vm_id)
-        user['assigned_vms'] = assigned_vms
-        return update_user(user)
-    
-    return True
+def assign_vms_to_user(user_id, vcenter, vm_ids):
+    """Assign VMs of a vCenter to a user in one transaction; returns the number newly assigned or None if no such user"""
+    with db_connection() as conn:
+        if not conn.execute('SELECT 1 FROM users WHERE id = ?', (user_id,)).fetchone():
+            return None
+        
+        before = conn.total_changes
+        conn.executemany(
+            'INSERT OR IGNORE INTO user_vms (user_id, vcenter, vm_id) VALUES (?, ?, ?)',
+            [(user_id, vcenter, vm_id) for vm_id in vm_ids]
+        )
+        count = conn.total_changes - before
+    
+    if count:
+        notify_user_changed(user_id)
+    return count
 
-def remove_vm_from_user(user_id, vm_id):
-    """Remove a VM from a user"""
-    user = get_user_by_id(user_id)
-    
-    if not user:
-        return False
-    
-    assigned_vms = user.get('assigned_vms', [])
-    
-    if vm_id in assigned_vms:
-        assigned_vms.remove(vm_id)
-        user['assigned_vms'] = assigned_vms
-        return update_user(user)
-    
-    return True
+def remove_vms_from_user(user_id, vcenter, vm_ids):
+    """Remove VMs of a vCenter from a user in one transaction; returns the number removed or None if no such user"""
+    with db_connection() as conn:
+        if not conn.execute('SELECT 1 FROM users WHERE id = ?', (user_id,)).fetchone():
+            return None
+        
+        before = conn.total_changes
+        conn.executemany(
+            'DELETE FROM user_vms WHERE user_id = ? AND vcenter = ? AND vm_id = ?',
+            [(user_id, vcenter, vm_id) for vm_id in vm_ids]
+        )
+        count = conn.total_changes - before
+    
+    if count:
+        notify_user_changed(user_id)
+    return count
+
+def assign_vm_to_user(user_id, vcenter, vm_id):
+    """Assign a VM of a vCenter to a user"""
+    return assign_vms_to_user(user_id, vcenter, [vm_id]) is not None
+
+def remove_vm_from_user(user_id, vcenter, vm_id):
+    """Remove a VM of a vCenter from a user"""
+    return remove_vms_from_user(user_id, vcenter, [vm_id]) is not None
+
+def get_assigned_vm_ids(user_id, vcenter):
+    """Return the set of ids of a vCenter's VMs assigned to a user"""
+    with db_connection() as conn:
+        return {
+            row['vm_id'] for row in
+            conn.execute('SELECT vm_id FROM user_vms WHERE user_id = ? AND vcenter = ?', (user_id, vcenter))
+        }
+
+def get_users_for_vm(vcenter, vm_id):
+    """Return ids of users a VM of a vCenter is assigned to"""
+    with db_connection() as conn:
+        return [
+            row['user_id'] for row in
+            conn.execute('SELECT user_id FROM user_vms WHERE vcenter = ? AND vm_id = ?', (vcenter, vm_id))
+        ]
 
 # Initialize database on module import
 initialize_database()
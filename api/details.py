@@ -0,0 +1,167 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from pyVmomi import vim, vmodl
+import inventory
+import singleflight
+
+# Properties rendered by the VM detail page, fetched in one RetrieveProperties call
+VM_DETAIL_PROPERTIES = [
+    'name',
+    'runtime.powerState',
+    'config.guestFullName',
+    'config.annotation',
+    'config.hardware.numCPU',
+    'config.hardware.memoryMB',
+    'config.hardware.device',
+    'guest.ipAddress',
+    'guest.hostName',
+    'guest.net',
+]
+
+# Seconds a fetched VM detail is served without asking vCenter again
+DETAIL_TTL = float(os.environ.get('VM_DETAIL_TTL', 10))
+
+# VM details kept per vCenter; the least recently used are dropped first
+DETAIL_CACHE_SIZE = int(os.environ.get('VM_DETAIL_CACHE_SIZE', 1000))
+
+def fetch_vm_properties(service_instance, vm_id, path_set=None):
+    """Return the properties of one VM by moref in a single call, or None if it does not exist"""
+    content = service_instance.RetrieveContent()
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+        obj=vim.VirtualMachine(vm_id, content.propertyCollector._stub),
+        skip=False
+    )
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+        type=vim.VirtualMachine,
+        pathSet=path_set or VM_DETAIL_PROPERTIES,
+        all=False
+    )
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+
+    try:
+        for _, props in inventory.retrieve_properties(content.propertyCollector, filter_spec):
+            return props
+    except vmodl.fault.ManagedObjectNotFound:
+        return None
+    return None
+
+def disk_entry(device):
+    backing = device.backing
+    capacity = device.capacityInBytes or (device.capacityInKB or 0) * 1024
+    return {
+        'label': device.deviceInfo.label if device.deviceInfo else f"Disk {device.key}",
+        'size_gb': round(capacity / 2**30, 2),
+        'disk_mode': getattr(backing, 'diskMode', None) or 'unknown',
+        'thin_provisioned': bool(getattr(backing, 'thinProvisioned', False)),
+    }
+
+def nic_entry(nic):
+    return {
+        'network': nic.network,
+        'mac_address': nic.macAddress,
+        'connected': bool(nic.connected),
+        'ip_addresses': list(nic.ipAddress or []),
+    }
+
+def vm_detail_entry(vm_id, props):
+    """Convert retrieved VM properties to the detail view representation"""
+    power_state = props.get('runtime.powerState')
+    devices = props.get('config.hardware.device') or []
+
+    vm_data = {
+        'id': vm_id,
+        'name': props.get('name'),
+        'power_state': str(power_state) if power_state else 'UNKNOWN',
+        'guest_full_name': props.get('config.guestFullName') or 'Unknown',
+        'description': props.get('config.annotation') or '',
+        'num_cpu': props.get('config.hardware.numCPU') or 0,
+        'memory_size_mb': props.get('config.hardware.memoryMB') or 0,
+        'disks': [disk_entry(device) for device in devices if isinstance(device, vim.vm.device.VirtualDisk)],
+        'networks': [nic_entry(nic) for nic in props.get('guest.net') or []],
+    }
+
+    if props.get('guest.ipAddress'):
+        vm_data['ip_address'] = props['guest.ipAddress']
+    if props.get('guest.hostName'):
+        vm_data['host_name'] = props['guest.hostName']
+
+    return vm_data
+
+class DetailCache:
+    """Short-lived VM details of one vCenter with request coalescing.
+
+    Concurrent requests for a VM that is not cached share one upstream
+    fetch. Entries expire after ttl seconds, or earlier when the inventory
+    feed reports the VM changed.
+    """
+
+    def __init__(self, name, service_instance, ttl=DETAIL_TTL, size=DETAIL_CACHE_SIZE):
+        self.name = name
+        self.service_instance = service_instance
+        self.ttl = ttl
+        self.size = size
+        self.counters = {'hits': 0, 'misses': 0}
+        self.flights = singleflight.Group(f"vm-detail-{name}")
+
+        # vm_id -> (expires at, detail or None)
+        self._entries = OrderedDict()
+        # Bumped per VM on invalidation so a fetch started earlier is not cached
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def attach(self, service_instance):
+        """Use service_instance for future fetches"""
+        self.service_instance = service_instance
+
+    def fetch(self, vm_id):
+        """Fetch one VM's detail from vCenter, or None if it does not exist"""
+        props = fetch_vm_properties(self.service_instance, vm_id)
+        return vm_detail_entry(vm_id, props) if props is not None else None
+
+    def get(self, vm_id, timeout=None):
+        """Return the VM's detail, or None if it does not exist.
+
+        Raises what the fetch raised, or singleflight.Timeout.
+        """
+        with self._lock:
+            cached = self._entries.get(vm_id)
+            if cached is not None and cached[0] > time.time():
+                self._entries.move_to_end(vm_id)
+                self.counters['hits'] += 1
+                return cached[1]
+            self.counters['misses'] += 1
+
+        return self.flights.do(vm_id, lambda: self._load(vm_id), timeout)
+
+    def _load(self, vm_id):
+        with self._lock:
+            generation = self._generations.get(vm_id, 0)
+
+        detail = self.fetch(vm_id)
+
+        with self._lock:
+            if self._generations.get(vm_id, 0) == generation:
+                self._entries[vm_id] = (time.time() + self.ttl, detail)
+                self._entries.move_to_end(vm_id)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return detail
+
+    def invalidate(self, vm_ids):
+        with self._lock:
+            for vm_id in vm_ids:
+                self._entries.pop(vm_id, None)
+                self._generations[vm_id] = self._generations.get(vm_id, 0) + 1
+        # Requests after the change must not join a fetch that may predate it
+        for vm_id in vm_ids:
+            self.flights.forget(vm_id)
+
+    def on_inventory_change(self, version, added, changed, removed):
+        """Inventory cache listener dropping details of VMs that appeared, changed or went away"""
+        self.invalidate([entry['id'] for entry in added + changed] + list(removed))
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, size=len(self._entries), ttl=self.ttl, flights=self.flights.stats())
@@ -0,0 +1,142 @@
+import os
+import json
+import threading
+from collections import deque
+
+# Change batches buffered per subscriber before it is marked for resync
+QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 256))
+
+# Interval between keepalive comments on idle streams
+HEARTBEAT_SECONDS = int(os.environ.get('EVENT_HEARTBEAT_SECONDS', 15))
+
+def format_sse(event, data, event_id=None):
+    """Format one Server-Sent Events message"""
+    message = ''
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    message += f"event: {event}\ndata: {data}\n\n"
+    return message
+
+class Subscriber:
+    """One stream client with a bounded queue of pending events"""
+
+    def __init__(self, user_id, visible):
+        self.user_id = user_id
+        # Set of visible VM ids, or None when the user may see every VM
+        self.visible = visible
+        self.overflowed = False
+        # Optional callable run after every push, for consumers that cannot block in get()
+        self.wakeup = None
+        self._queue = deque()
+        self._cond = threading.Condition()
+
+    def push(self, event):
+        """Queue an (event, data, id) tuple; on overflow drop the backlog and request a resync"""
+        with self._cond:
+            if len(self._queue) >= QUEUE_SIZE:
+                self._queue.clear()
+                self.overflowed = True
+            elif not self.overflowed:
+                self._queue.append(event)
+            self._cond.notify()
+
+        if self.wakeup:
+            self.wakeup()
+
+    def get(self, timeout):
+        """Return pending events, waiting up to timeout for the first one"""
+        with self._cond:
+            if timeout and not self._queue and not self.overflowed:
+                self._cond.wait(timeout)
+            events = list(self._queue)
+            self._queue.clear()
+            return events
+
+    def take_overflow(self):
+        """Return True once after the queue overflowed"""
+        with self._cond:
+            overflowed, self.overflowed = self.overflowed, False
+            return overflowed
+
+    def filter(self, entries):
+        if self.visible is None:
+            return entries
+        return [entry for entry in entries if entry['id'] in self.visible]
+
+    def filter_ids(self, vm_ids):
+        if self.visible is None:
+            return vm_ids
+        return [vm_id for vm_id in vm_ids if vm_id in self.visible]
+
+class EventBroker:
+    """Fans out one inventory cache's change feed to all stream subscribers"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        cache.add_listener(self.publish)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def subscribe(self, user_id, visible):
+        subscriber = Subscriber(user_id, visible)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, version, added, changed, removed):
+        """Deliver one change batch, filtered per subscriber"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        # Unfiltered subscribers all share one serialized payload
+        unfiltered = None
+
+        for subscriber in subscribers:
+            if subscriber.visible is None:
+                if unfiltered is None:
+                    unfiltered = json.dumps({
+                        'version': version,
+                        'added': added,
+                        'changed': changed,
+                        'removed': removed
+                    })
+                subscriber.push(('vms', unfiltered, version))
+                continue
+
+            payload = {
+                'version': version,
+                'added': subscriber.filter(added),
+                'changed': subscriber.filter(changed),
+                'removed': subscriber.filter_ids(removed)
+            }
+            if payload['added'] or payload['changed'] or payload['removed']:
+                subscriber.push(('vms', json.dumps(payload), version))
+
+    def update_visibility(self, user_id, visible):
+        """Apply a new visible VM set to a user's subscribers, pushing VMs that appeared or vanished"""
+        with self._lock:
+            subscribers = [s for s in self._subscribers if s.user_id == user_id]
+
+        for subscriber in subscribers:
+            previous = subscriber.visible
+            subscriber.visible = visible
+            if previous is None or visible is None:
+                continue
+
+            # Sent without an event id so streams never drop it as already seen
+            payload = {
+                'version': self.cache.version,
+                'added': self.cache.get_entries(visible - previous),
+                'changed': [],
+                'removed': list(previous - visible)
+            }
+            if payload['added'] or payload['removed']:
+                subscriber.push(('vms', json.dumps(payload), None))
@@ -0,0 +1,1023 @@
+import argparse
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.parsers.expat import ParserCreate
+from pyVim.connect import SmartConnect
+from pyVmomi import vim, vmodl, SoapAdapter, VmomiSupport
+
+# Guest operating systems handed out to synthetic VMs
+GUEST_OS_NAMES = [
+    'Ubuntu Linux (64-bit)',
+    'Red Hat Enterprise Linux 8 (64-bit)',
+    'Microsoft Windows Server 2019 (64-bit)',
+    'Microsoft Windows Server 2022 (64-bit)',
+    'VMware Photon OS (64-bit)',
+]
+
+# Performance counter catalog: (key, group, name, rollup, unit)
+PERF_COUNTERS = [
+    (2, 'cpu', 'usage', 'average', 'percent'),
+    (24, 'mem', 'usage', 'average', 'percent'),
+    (125, 'disk', 'usage', 'average', 'kiloBytesPerSecond'),
+]
+
+# Data object types used to answer accessors for nested VM properties
+NESTED_PROPERTY_TYPES = {
+    'runtime': vim.vm.RuntimeInfo,
+    'config': vim.vm.ConfigInfo,
+    'guest': vim.vm.GuestInfo,
+}
+
+# Per-VM properties computed from the fake's snapshot trees
+SNAPSHOT_PATHS = ('snapshot', 'layoutEx.file', 'layoutEx.disk', 'layoutEx.snapshot')
+
+# API version the SOAP server announces and answers in
+SOAP_VERSION = VmomiSupport.GetServiceVersions('vim25')[0]
+
+# Methods the SOAP server answers without a login session
+ANONYMOUS_METHODS = ('RetrieveContent', 'Login', 'CurrentTime')
+
+# Key of the single virtual disk of every synthetic VM
+DISK_KEY = 2000
+
+# Per-VM properties computed from other properties when requested
+DEVICE_PATHS = ('config.hardware.device', 'guest.net')
+
+class FakeStub:
+    """Minimal pyVmomi stub that answers SOAP calls from an in-memory inventory"""
+
+    def __init__(self, vcenter, cookie=None):
+        self.vcenter = vcenter
+        self.version = 'vim.version.version1'
+        self.cookie = cookie
+
+    @property
+    def authenticated(self):
+        return self.cookie is None or self.vcenter.login_sessions.get(self.cookie, False)
+
+    def InvokeMethod(self, mo, info, args, outerStub=None):
+        # Property reads routed through a stub wrapper arrive as Fetch calls
+        method = 'Fetch' if info.wsdlName == 'Fetch' else info.name
+        return self.vcenter.invoke(mo, method, args, self, outerStub)
+
+    def InvokeAccessor(self, mo, info, outerStub=None):
+        return self.vcenter.invoke(mo, 'Fetch', [info.name], self, outerStub)
+
+class FakeVCenter:
+    """In-process vCenter stand-in that counts round-trips per method"""
+
+    def __init__(self, vm_count=100, latency=0.0, seed=0, task_duration=0.1, powered_on_ratio=0.7,
+                 ip_ratio=1.0, snapshot_ratio=0.3, max_snapshots=4, method_latency=None):
+        # Seconds every call takes, unless method_latency names the method
+        self.latency = latency
+        self.method_latency = dict(method_latency or {})
+        # Shape of generated VMs: share powered on, share of those reporting a guest IP,
+        # share carrying a snapshot tree, and most snapshots per tree
+        self.powered_on_ratio = powered_on_ratio
+        self.ip_ratio = ip_ratio
+        self.snapshot_ratio = snapshot_ratio
+        self.max_snapshots = max_snapshots
+        # Seconds a task spends queued plus running before it completes
+        self.task_duration = task_duration
+        self.calls = Counter()
+        self.stub = FakeStub(self)
+        # Login session cookie -> still authenticated
+        self.login_sessions = {}
+        self._local = threading.local()
+        self.vms = {}
+        self.tasks = {}
+        # Snapshot id -> node dict; vm_id -> {'roots': [...], 'current': snapshot id}
+        self.snapshots = {}
+        self._vm_snapshots = {}
+        self._views = {}
+        # List view id -> ({object id: version added}, {object id: version removed})
+        self._list_views = {}
+        self._pending_results = {}
+        self._collectors = {}
+        self._next_id = 0
+        self._vm_seq = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+        # Change journal backing WaitForUpdatesEx: (version, object id) pairs
+        self.update_version = 0
+        self.journal_limit = 100000
+        self._journal = []
+        self._journal_start = 0
+        self._created = {}
+
+        rng = random.Random(seed)
+        for i in range(vm_count):
+            self.add_vm(rng)
+
+    # Inventory management
+
+    def add_vm(self, rng=random):
+        """Add a synthetic VM and return its moref id"""
+        with self._lock:
+            self._vm_seq += 1
+            seq = self._vm_seq
+        vm_id = f"vm-{seq}"
+
+        powered_on = rng.random() < self.powered_on_ratio
+        has_ip = powered_on and rng.random() < self.ip_ratio
+        self.vms[vm_id] = {
+            'name': f"synthetic-vm-{seq:05d}",
+            'runtime.powerState': 'poweredOn' if powered_on else 'poweredOff',
+            'config.guestFullName': rng.choice(GUEST_OS_NAMES),
+            'guest.ipAddress': f"10.{seq // 65536 % 256}.{seq // 256 % 256}.{seq % 256}" if has_ip else None,
+            'config.annotation': f"Synthetic VM {seq}",
+            'config.hardware.numCPU': (1, 2, 4, 8)[seq % 4],
+            'config.hardware.memoryMB': (2048, 4096, 8192, 16384)[seq % 4],
+            'guest.hostName': f"synthetic-{seq:05d}.local" if powered_on else None,
+            'summary.storage': vim.vm.Summary.StorageSummary(
+                committed=rng.randint(1, 100) * 2**30,
+                uncommitted=rng.randint(0, 100) * 2**30,
+                unshared=0,
+                timestamp=datetime.now(timezone.utc)
+            ),
+        }
+        self._vm_snapshots[vm_id] = {'roots': [], 'current': None}
+
+        # Some VMs carry a chain of old snapshots, a few of them branched
+        if self.max_snapshots and rng.random() < self.snapshot_ratio:
+            now = time.time()
+            for age_days in sorted((rng.uniform(0, 120) for _ in range(rng.randint(1, self.max_snapshots))), reverse=True):
+                if self._vm_snapshots[vm_id]['current'] and rng.random() < 0.2:
+                    # Revert to the parent first so the next snapshot branches
+                    self._vm_snapshots[vm_id]['current'] = self.snapshots[self._vm_snapshots[vm_id]['current']]['parent']
+                self._add_snapshot(
+                    vm_id, f"snapshot-{age_days:.0f}d", '', memory=rng.random() < 0.3, quiesce=False,
+                    created=datetime.fromtimestamp(now - age_days * 86400, timezone.utc),
+                    delta_size=rng.randint(1, 40) * 2**28
+                )
+
+        self._created[vm_id] = self._record_change(vm_id)
+        return vm_id
+
+    def set_vm_property(self, vm_id, path, value):
+        """Change one property of a VM and notify update waiters"""
+        self.vms[vm_id][path] = value
+        self._record_change(vm_id)
+
+    def remove_vm(self, vm_id):
+        """Delete a VM and notify update waiters"""
+        del self.vms[vm_id]
+        for snapshot_id in [sid for sid, node in self.snapshots.items() if node['vm_id'] == vm_id]:
+            del self.snapshots[snapshot_id]
+        del self._vm_snapshots[vm_id]
+        del self._created[vm_id]
+        self._record_change(vm_id)
+
+    def _record_change(self, obj_id):
+        with self._changed:
+            self.update_version += 1
+            self._journal.append((self.update_version, obj_id))
+            if len(self._journal) > self.journal_limit:
+                dropped = len(self._journal) - self.journal_limit
+                self._journal_start = self._journal[dropped - 1][0]
+                del self._journal[:dropped]
+            self._changed.notify_all()
+            return self.update_version
+
+    def _start_task(self, vm_id, description_id, action):
+        """Create a queued task that runs action() in the background and return its moref"""
+        with self._lock:
+            self._next_id += 1
+            task_id = f"task-{self._next_id}"
+
+        task = vim.Task(task_id, self._caller_stub)
+        self.tasks[task_id] = vim.TaskInfo(
+            key=task_id,
+            task=task,
+            descriptionId=description_id,
+            entity=vim.VirtualMachine(vm_id, self._caller_stub),
+            entityName=self.vms[vm_id]['name'],
+            state='queued',
+            cancelled=False,
+            cancelable=False,
+            queueTime=datetime.now(timezone.utc)
+        )
+        self._record_change(task_id)
+        threading.Thread(target=self._run_task, args=(task_id, action), daemon=True).start()
+        return task
+
+    def _run_task(self, task_id, action):
+        info = self.tasks[task_id]
+        time.sleep(self.task_duration / 2)
+        info.state = 'running'
+        info.progress = 0
+        info.startTime = datetime.now(timezone.utc)
+        self._record_change(task_id)
+
+        time.sleep(self.task_duration / 2)
+        try:
+            info.result = action()
+            info.state = 'success'
+        except vmodl.MethodFault as e:
+            info.error = vmodl.LocalizedMethodFault(fault=e, localizedMessage=e.msg or type(e).__name__)
+            info.state = 'error'
+        info.progress = 100
+        info.completeTime = datetime.now(timezone.utc)
+        self._record_change(task_id)
+
+    def _set_power_state(self, vm_id, required, state):
+        props = self.vms[vm_id]
+        if props['runtime.powerState'] not in required:
+            raise vim.fault.InvalidPowerState(
+                requestedState=state,
+                existingState=props['runtime.powerState'],
+                msg=f"The attempted operation cannot be performed in the current state ({props['runtime.powerState']})."
+            )
+        props['runtime.powerState'] = state
+        seq = int(vm_id.split('-')[1])
+        props['guest.ipAddress'] = f"10.{seq // 65536 % 256}.{seq // 256 % 256}.{seq % 256}" if state == 'poweredOn' else None
+        self._record_change(vm_id)
+
+    def _add_snapshot(self, vm_id, name, description, memory, quiesce, created=None, delta_size=2**28):
+        """Take a snapshot as a child of the current one and make it current"""
+        with self._lock:
+            self._next_id += 1
+            seq = self._next_id
+        snapshot_id = f"snapshot-{seq}"
+        tree = self._vm_snapshots[vm_id]
+        parent = tree['current']
+        powered_on = self.vms[vm_id]['runtime.powerState'] == 'poweredOn'
+
+        self.snapshots[snapshot_id] = {
+            'id': snapshot_id,
+            'seq': seq,
+            'vm_id': vm_id,
+            'name': name,
+            'description': description,
+            'create_time': created or datetime.now(timezone.utc),
+            'state': self.vms[vm_id]['runtime.powerState'] if memory and powered_on else 'poweredOff',
+            'quiesced': bool(quiesce),
+            'memory_size': 2**30 if memory and powered_on else 0,
+            'delta_size': delta_size,
+            'parent': parent,
+            'children': [],
+        }
+        (self.snapshots[parent]['children'] if parent else tree['roots']).append(snapshot_id)
+        tree['current'] = snapshot_id
+        return vim.vm.Snapshot(snapshot_id, self._caller_stub)
+
+    def _remove_snapshot(self, snapshot_id, remove_children):
+        node = self.snapshots.pop(snapshot_id)
+        tree = self._vm_snapshots[node['vm_id']]
+        siblings = self.snapshots[node['parent']]['children'] if node['parent'] else tree['roots']
+        position = siblings.index(snapshot_id)
+
+        if remove_children:
+            for child_id in list(node['children']):
+                self.snapshots[child_id]['parent'] = None
+                self._remove_snapshot_subtree(child_id)
+            siblings.pop(position)
+        else:
+            # Children move up to the removed snapshot's parent
+            for child_id in node['children']:
+                self.snapshots[child_id]['parent'] = node['parent']
+            siblings[position:position + 1] = node['children']
+
+        if tree['current'] not in self.snapshots:
+            tree['current'] = node['parent']
+        self._record_change(node['vm_id'])
+
+    def _remove_snapshot_subtree(self, snapshot_id):
+        node = self.snapshots.pop(snapshot_id)
+        for child_id in node['children']:
+            self._remove_snapshot_subtree(child_id)
+
+    def _snapshot_path(self, snapshot_id):
+        """Return snapshot ids from the root down to snapshot_id"""
+        path = []
+        while snapshot_id:
+            path.append(snapshot_id)
+            snapshot_id = self.snapshots[snapshot_id]['parent']
+        return path[::-1]
+
+    def _snapshot_property(self, vm_id, path):
+        tree = self._vm_snapshots[vm_id]
+        stub = self._caller_stub
+        nodes = [node for node in list(self.snapshots.values()) if node['vm_id'] == vm_id]
+
+        def delta_unit(snapshot_id):
+            return vim.vm.FileLayoutEx.DiskUnit(fileKey=[self.snapshots[snapshot_id]['seq'] * 10 + 3])
+
+        base_unit = vim.vm.FileLayoutEx.DiskUnit(fileKey=[0])
+
+        if path == 'snapshot':
+            if not tree['roots']:
+                return None
+
+            def subtree(snapshot_id):
+                node = self.snapshots[snapshot_id]
+                return vim.vm.SnapshotTree(
+                    snapshot=vim.vm.Snapshot(snapshot_id, stub),
+                    vm=vim.VirtualMachine(vm_id, stub),
+                    name=node['name'],
+                    description=node['description'],
+                    id=node['seq'],
+                    createTime=node['create_time'],
+                    state=node['state'],
+                    quiesced=node['quiesced'],
+                    childSnapshotList=[subtree(child_id) for child_id in node['children']]
+                )
+
+            return vim.vm.SnapshotInfo(
+                currentSnapshot=vim.vm.Snapshot(tree['current'], stub) if tree['current'] else None,
+                rootSnapshotList=[subtree(root_id) for root_id in tree['roots']]
+            )
+
+        if path == 'layoutEx.file':
+            name = self.vms[vm_id]['name']
+            files = [vim.vm.FileLayoutEx.FileInfo(
+                key=0, name=f"[datastore1] {name}/{name}.vmdk", type='diskDescriptor',
+                size=self.vms[vm_id]['summary.storage'].committed
+            )]
+            for node in nodes:
+                key = node['seq'] * 10
+                files.append(vim.vm.FileLayoutEx.FileInfo(
+                    key=key + 1, name=f"[datastore1] {name}/{name}-Snapshot{node['seq']}.vmsn",
+                    type='snapshotData', size=32 * 2**10
+                ))
+                if node['memory_size']:
+                    files.append(vim.vm.FileLayoutEx.FileInfo(
+                        key=key + 2, name=f"[datastore1] {name}/{name}-Snapshot{node['seq']}.vmem",
+                        type='snapshotMemory', size=node['memory_size']
+                    ))
+                files.append(vim.vm.FileLayoutEx.FileInfo(
+                    key=key + 3, name=f"[datastore1] {name}/{name}-{node['seq']:06d}-delta.vmdk",
+                    type='diskExtent', size=node['delta_size']
+                ))
+            return vim.vm.FileLayoutEx.FileInfo.Array(files)
+
+        if path == 'layoutEx.disk':
+            chain = [base_unit] + [delta_unit(sid) for sid in self._snapshot_path(tree['current'])]
+            return vim.vm.FileLayoutEx.DiskLayout.Array([vim.vm.FileLayoutEx.DiskLayout(key=DISK_KEY, chain=chain)])
+
+        # layoutEx.snapshot: a snapshot's chain ends before the delta its own creation started
+        return vim.vm.FileLayoutEx.SnapshotLayout.Array([
+            vim.vm.FileLayoutEx.SnapshotLayout(
+                key=vim.vm.Snapshot(node['id'], stub),
+                dataKey=node['seq'] * 10 + 1,
+                memoryKey=node['seq'] * 10 + 2 if node['memory_size'] else -1,
+                disk=[vim.vm.FileLayoutEx.DiskLayout(
+                    key=DISK_KEY,
+                    chain=[base_unit] + [delta_unit(sid) for sid in self._snapshot_path(node['parent'])]
+                )]
+            )
+            for node in nodes
+        ])
+
+    def _device_property(self, vm_id, path):
+        props = self.vms[vm_id]
+        if path == 'guest.net':
+            if not props.get('guest.ipAddress'):
+                return vim.vm.GuestInfo.NicInfo.Array([])
+            return vim.vm.GuestInfo.NicInfo.Array([vim.vm.GuestInfo.NicInfo(
+                network='VM Network',
+                macAddress=f"00:50:56:00:{int(vm_id.split('-')[1]) // 256 % 256:02x}:{int(vm_id.split('-')[1]) % 256:02x}",
+                connected=True,
+                deviceConfigId=4000,
+                ipAddress=[props['guest.ipAddress']]
+            )])
+
+        storage = props['summary.storage']
+        name = props['name']
+        return vim.vm.device.VirtualDevice.Array([vim.vm.device.VirtualDisk(
+            key=DISK_KEY,
+            deviceInfo=vim.Description(label='Hard disk 1', summary=f"{storage.committed + storage.uncommitted} B"),
+            capacityInBytes=storage.committed + storage.uncommitted,
+            capacityInKB=(storage.committed + storage.uncommitted) // 1024,
+            backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+                fileName=f"[datastore1] {name}/{name}.vmdk",
+                diskMode='persistent',
+                thinProvisioned=bool(storage.uncommitted)
+            )
+        )])
+
+    def service_instance(self):
+        """Return a ServiceInstance bound to this fake"""
+        return vim.ServiceInstance('ServiceInstance', self.stub)
+
+    def connect(self, host=None, user=None, pwd=None, **kwargs):
+        """SmartConnect stand-in returning a ServiceInstance with its own login session"""
+        self.calls['Login'] += 1
+        self._delay('Login')
+        return vim.ServiceInstance('ServiceInstance', FakeStub(self, self.new_login_session()))
+
+    def new_login_session(self):
+        """Register a new authenticated login session and return its cookie"""
+        cookie = f"vmware_soap_session=\"{uuid.uuid4()}\""
+        self.login_sessions[cookie] = True
+        return cookie
+
+    def attach(self, host=None, cookie=None, **kwargs):
+        """attach_session stand-in reusing an existing login session cookie"""
+        return vim.ServiceInstance('ServiceInstance', FakeStub(self, cookie))
+
+    def expire_sessions(self):
+        """Invalidate every login session, as a vCenter session timeout would"""
+        for cookie in self.login_sessions:
+            self.login_sessions[cookie] = False
+
+    @property
+    def _caller_stub(self):
+        # Managed objects are bound to the stub the caller asked for results on
+        return getattr(self._local, 'stub', None) or self.stub
+
+    def reset_calls(self):
+        self.calls.clear()
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    # Request dispatch
+
+    def _delay(self, method):
+        seconds = self.method_latency.get(method, self.latency)
+        if seconds:
+            time.sleep(seconds)
+
+    def invoke(self, mo, method, args, stub=None, outer_stub=None):
+        self.calls[method] += 1
+        self._delay(method)
+
+        if stub is not None and not stub.authenticated:
+            raise vim.fault.NotAuthenticated(object=mo, privilegeId='System.View')
+
+        handler = getattr(self, f"_handle_{method}", None)
+        if handler is None:
+            raise vmodl.fault.MethodNotFound(receiver=mo, method=method)
+
+        self._local.stub = outer_stub or stub
+        try:
+            return handler(mo, *args)
+        finally:
+            self._local.stub = None
+
+    def _handle_CurrentTime(self, mo):
+        return datetime.now(timezone.utc)
+
+    def _handle_RetrieveContent(self, mo):
+        return vim.ServiceInstanceContent(
+            rootFolder=vim.Folder('group-d1', self._caller_stub),
+            viewManager=vim.view.ViewManager('ViewManager', self._caller_stub),
+            propertyCollector=vmodl.query.PropertyCollector('propertyCollector', self._caller_stub),
+            perfManager=vim.PerformanceManager('PerfMgr', self._caller_stub),
+            sessionManager=vim.SessionManager('SessionManager', self._caller_stub),
+            about=vim.AboutInfo(
+                name='VMware vCenter Server', fullName='Fake VMware vCenter Server', vendor='VM Captain',
+                version=VmomiSupport.versionIdMap[SOAP_VERSION].rpartition('/')[2], build='0',
+                osType='linux-x64', productLineId='vpx', apiType='VirtualCenter',
+                apiVersion=VmomiSupport.versionIdMap[SOAP_VERSION].rpartition('/')[2],
+            ),
+        )
+
+    def _handle_Login(self, mo, userName, password, locale=None):
+        now = datetime.now(timezone.utc)
+        return vim.UserSession(
+            key=uuid.uuid4().hex, userName=userName, fullName=userName,
+            loginTime=now, lastActiveTime=now, locale=locale or 'en', messageLocale=locale or 'en',
+            extensionSession=False, ipAddress='127.0.0.1', userAgent='', callCount=0
+        )
+
+    def _handle_Logout(self, mo):
+        cookie = getattr(self._caller_stub, 'cookie', None)
+        if cookie in self.login_sessions:
+            self.login_sessions[cookie] = False
+
+    def _handle_CreateContainerView(self, mo, container, types, recursive):
+        with self._lock:
+            self._next_id += 1
+            view_id = f"session[fake]view-{self._next_id}"
+        self._views[view_id] = list(self.vms)
+        return vim.view.ContainerView(view_id, self._caller_stub)
+
+    def _handle_CreateListView(self, mo, obj=None):
+        with self._lock:
+            self._next_id += 1
+            view_id = f"session[fake]listview-{self._next_id}"
+        self._list_views[view_id] = ({}, {})
+        self._views[view_id] = []
+        self._handle_Modify(vim.view.ListView(view_id, self._caller_stub), obj)
+        return vim.view.ListView(view_id, self._caller_stub)
+
+    # ListView.ModifyListView is exposed as Modify by pyVmomi
+    def _handle_Modify(self, mo, add=None, remove=None):
+        members, removed = self._list_views[mo._moId]
+        for obj in add or []:
+            if obj._moId not in members:
+                removed.pop(obj._moId, None)
+                members[obj._moId] = self._record_change(obj._moId)
+        for obj in remove or []:
+            if members.pop(obj._moId, None) is not None:
+                removed[obj._moId] = self._record_change(obj._moId)
+        self._views[mo._moId] = list(members)
+        return []
+
+    def _handle_Destroy(self, mo):
+        self._views.pop(mo._moId, None)
+        self._list_views.pop(mo._moId, None)
+        self._collectors.pop(mo._moId, None)
+
+    def _handle_PowerOn(self, mo, host=None):
+        return self._start_task(mo._moId, 'VirtualMachine.powerOn',
+                                lambda: self._set_power_state(mo._moId, ('poweredOff', 'suspended'), 'poweredOn'))
+
+    def _handle_PowerOff(self, mo):
+        return self._start_task(mo._moId, 'VirtualMachine.powerOff',
+                                lambda: self._set_power_state(mo._moId, ('poweredOn', 'suspended'), 'poweredOff'))
+
+    def _handle_Reset(self, mo):
+        return self._start_task(mo._moId, 'VirtualMachine.reset',
+                                lambda: self._set_power_state(mo._moId, ('poweredOn',), 'poweredOn'))
+
+    def _handle_Suspend(self, mo):
+        return self._start_task(mo._moId, 'VirtualMachine.suspend',
+                                lambda: self._set_power_state(mo._moId, ('poweredOn',), 'suspended'))
+
+    def _handle_CreateSnapshot(self, mo, name, description=None, memory=False, quiesce=False):
+        def take():
+            snapshot = self._add_snapshot(mo._moId, name, description or '', memory, quiesce)
+            self._record_change(mo._moId)
+            return snapshot
+        return self._start_task(mo._moId, 'VirtualMachine.createSnapshot', take)
+
+    # VirtualMachineSnapshot.RemoveSnapshot_Task is exposed as Remove by pyVmomi
+    def _handle_Remove(self, mo, removeChildren, consolidate=None):
+        node = self.snapshots.get(mo._moId)
+        if node is None:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+        return self._start_task(node['vm_id'], 'vm.Snapshot.remove',
+                                lambda: self._remove_snapshot(mo._moId, removeChildren))
+
+    def _handle_RemoveAllSnapshots(self, mo, consolidate=None):
+        def remove_all():
+            tree = self._vm_snapshots[mo._moId]
+            for root_id in list(tree['roots']):
+                self._remove_snapshot(root_id, True)
+        return self._start_task(mo._moId, 'VirtualMachine.removeAllSnapshots', remove_all)
+
+    def _handle_CreatePropertyCollector(self, mo):
+        with self._lock:
+            self._next_id += 1
+            collector_id = f"session[fake]collector-{self._next_id}"
+        self._collectors[collector_id] = []
+        return vmodl.query.PropertyCollector(collector_id, self._caller_stub)
+
+    def _handle_CreateFilter(self, mo, spec, partial_updates):
+        with self._lock:
+            self._next_id += 1
+            filter_id = f"session[fake]filter-{self._next_id}"
+        path_set = [path for prop_spec in spec.propSet for path in prop_spec.pathSet]
+        view_id = spec.objectSet[0].obj._moId
+        self._collectors.setdefault(mo._moId, []).append((filter_id, view_id, path_set))
+        return vmodl.query.PropertyCollector.Filter(filter_id, self._caller_stub)
+
+    def _handle_WaitForUpdatesEx(self, mo, version, options):
+        filters = self._collectors[mo._moId]
+        max_wait = options.maxWaitSeconds if options and options.maxWaitSeconds is not None else 60
+
+        if not version:
+            current = self.update_version
+            return self._update_set(filters, current, None, set())
+
+        since = int(version)
+        with self._changed:
+            if since < self._journal_start:
+                raise vmodl.query.InvalidCollectorVersion()
+            if self.update_version <= since:
+                self._changed.wait(max_wait)
+            current = self.update_version
+            changed = {obj_id for ver, obj_id in self._journal if ver > since}
+
+        if not changed:
+            return None
+        return self._update_set(filters, current, since, changed)
+
+    def _filter_kinds(self, view_id, since, changed):
+        """Return {object id: update kind} for one filter; since None means the initial update"""
+        if view_id in self._list_views:
+            members, removed = self._list_views[view_id]
+            if since is None:
+                return {obj_id: 'enter' for obj_id in members}
+            kinds = {}
+            for obj_id in changed:
+                if obj_id in members:
+                    kinds[obj_id] = 'enter' if members[obj_id] > since else 'modify'
+                elif removed.get(obj_id, 0) > since:
+                    kinds[obj_id] = 'leave'
+            return kinds
+
+        # Container views follow every VM
+        if since is None:
+            return {vm_id: 'enter' for vm_id in list(self.vms)}
+        kinds = {}
+        for obj_id in changed:
+            if not obj_id.startswith('vm-'):
+                continue
+            if obj_id not in self.vms:
+                kinds[obj_id] = 'leave'
+            elif self._created[obj_id] > since:
+                kinds[obj_id] = 'enter'
+            else:
+                kinds[obj_id] = 'modify'
+        return kinds
+
+    def _update_set(self, filters, version, since, changed):
+        filter_updates = []
+        for filter_id, view_id, path_set in filters:
+            object_updates = []
+            for obj_id, kind in self._filter_kinds(view_id, since, changed).items():
+                change_set = []
+                if kind != 'leave':
+                    for path in path_set:
+                        value = self._property(obj_id, path)
+                        op = 'assign' if value is not None else 'remove'
+                        change_set.append(vmodl.query.PropertyCollector.Change(name=path, op=op, val=value))
+                object_updates.append(vmodl.query.PropertyCollector.ObjectUpdate(
+                    kind=kind,
+                    obj=self._moref(obj_id),
+                    changeSet=change_set
+                ))
+            if object_updates:
+                filter_updates.append(vmodl.query.PropertyCollector.FilterUpdate(
+                    filter=vmodl.query.PropertyCollector.Filter(filter_id, self._caller_stub),
+                    objectSet=object_updates
+                ))
+        return vmodl.query.PropertyCollector.UpdateSet(
+            version=str(version),
+            filterSet=filter_updates,
+            truncated=False
+        )
+
+    def _moref(self, obj_id):
+        if obj_id.startswith('task-'):
+            return vim.Task(obj_id, self._caller_stub)
+        return vim.VirtualMachine(obj_id, self._caller_stub)
+
+    def _property(self, obj_id, path):
+        if obj_id.startswith('task-'):
+            info = self.tasks[obj_id]
+            if path == 'info':
+                return info
+            if path.startswith('info.'):
+                return getattr(info, path[len('info.'):])
+            raise vmodl.query.InvalidProperty(name=path)
+        return self._vm_property(obj_id, path)
+
+    def _handle_Fetch(self, mo, prop):
+        if isinstance(mo, vim.PerformanceManager) and prop == 'perfCounter':
+            return [
+                vim.PerformanceManager.CounterInfo(
+                    key=key,
+                    groupInfo=vim.ElementDescription(key=group, label=group, summary=group),
+                    nameInfo=vim.ElementDescription(key=name, label=name, summary=name),
+                    unitInfo=vim.ElementDescription(key=unit, label=unit, summary=unit),
+                    rollupType=rollup,
+                    statsType='rate'
+                )
+                for key, group, name, rollup, unit in PERF_COUNTERS
+            ]
+        if isinstance(mo, (vim.view.ContainerView, vim.view.ListView)):
+            return [self._moref(obj_id) for obj_id in self._views[mo._moId]]
+        if isinstance(mo, (vim.VirtualMachine, vim.Task)):
+            return self._property(mo._moId, prop)
+        raise vmodl.query.InvalidProperty(name=prop)
+
+    def _vm_property(self, vm_id, path):
+        props = self.vms.get(vm_id)
+        if props is None:
+            raise vmodl.fault.ManagedObjectNotFound(obj=vim.VirtualMachine(vm_id, self._caller_stub))
+        if path in SNAPSHOT_PATHS:
+            return self._snapshot_property(vm_id, path)
+        if path in DEVICE_PATHS:
+            return self._device_property(vm_id, path)
+        if path in props:
+            return props[path]
+        if path in NESTED_PROPERTY_TYPES:
+            prefix = path + '.'
+            values = {k[len(prefix):]: v for k, v in props.items()
+                      if k.startswith(prefix) and '.' not in k[len(prefix):] and v is not None}
+            return NESTED_PROPERTY_TYPES[path](**values)
+        raise vmodl.query.InvalidProperty(name=path)
+
+    def _handle_QueryStats(self, mo, query_spec):
+        results = []
+        for spec in query_spec:
+            vm_id = spec.entity._moId
+            if self.vms.get(vm_id, {}).get('runtime.powerState') != 'poweredOn':
+                continue
+            results.append(vim.PerformanceManager.EntityMetric(
+                entity=spec.entity,
+                value=[
+                    vim.PerformanceManager.IntSeries(id=metric_id, value=[random.randint(0, 10000)])
+                    for metric_id in spec.metricId
+                ]
+            ))
+        return results
+
+    def _handle_RetrievePropertiesEx(self, mo, spec_set, options):
+        vm_ids = []
+        path_set = []
+        for spec in spec_set:
+            for obj_spec in spec.objectSet:
+                if isinstance(obj_spec.obj, (vim.view.ContainerView, vim.view.ListView)):
+                    vm_ids.extend(self._views[obj_spec.obj._moId])
+                else:
+                    vm_ids.append(obj_spec.obj._moId)
+            for prop_spec in spec.propSet:
+                path_set.extend(prop_spec.pathSet)
+
+        return self._page_result(vm_ids, path_set, options.maxObjects if options else None)
+
+    def _handle_ContinueRetrievePropertiesEx(self, mo, token):
+        vm_ids, path_set, page_size = self._pending_results.pop(token)
+        return self._page_result(vm_ids, path_set, page_size)
+
+    def _handle_CancelRetrievePropertiesEx(self, mo, token):
+        self._pending_results.pop(token, None)
+
+    def _page_result(self, vm_ids, path_set, page_size):
+        page_size = page_size or len(vm_ids) or 1
+        page, rest = vm_ids[:page_size], vm_ids[page_size:]
+
+        objects = []
+        for vm_id in page:
+            prop_set = []
+            for path in path_set:
+                value = self._property(vm_id, path)
+                if value is not None:
+                    prop_set.append(vmodl.DynamicProperty(name=path, val=value))
+            objects.append(vmodl.query.PropertyCollector.ObjectContent(
+                obj=self._moref(vm_id),
+                propSet=prop_set
+            ))
+
+        token = None
+        if rest:
+            with self._lock:
+                self._next_id += 1
+                token = f"token-{self._next_id}"
+            self._pending_results[token] = (rest, path_set, page_size)
+
+        return vmodl.query.PropertyCollector.RetrieveResult(token=token, objects=objects)
+
+class SoapRequestDeserializer(SoapAdapter.ExpatDeserializerNSHandlers):
+    """Parses a SOAP request into (managed object, method info, arguments) with pyVmomi's deserializer"""
+
+    def __init__(self):
+        SoapAdapter.ExpatDeserializerNSHandlers.__init__(self)
+        self.deser = SoapAdapter.SoapDeserializer(version=SOAP_VERSION)
+
+    def Deserialize(self, request):
+        self.parser = ParserCreate(namespace_separator=SoapAdapter.NS_SEP)
+        self.parser.buffer_text = True
+        self.nsMap = {}
+        self.depth = 0
+        self.in_body = False
+        self.wsdl_name = None
+        self.info = None
+        self.mo = None
+        self.values = {}
+        self.pending = None
+        SoapAdapter.SetHandlers(self.parser, SoapAdapter.GetHandlers(self))
+        self.parser.Parse(request, True)
+        self._collect()
+        if self.mo is None:
+            raise vmodl.fault.InvalidRequest(msg='request has no _this')
+        return self.mo, self.info, [self.values.get(param.name) for param in self.info.params]
+
+    def _collect(self):
+        # The deserializer hands the parser back after a parameter's closing tag, which it consumes
+        if self.pending is None:
+            return
+        name, self.pending = self.pending, None
+        self.depth -= 1
+        value = self.deser.GetResult()
+        if name == '_this':
+            self.mo = value
+            self.info = method_info(value, self.wsdl_name)
+        elif issubclass(self.param(name).type, list):
+            self.values.setdefault(name, self.param(name).type()).append(value)
+        else:
+            self.values[name] = value
+
+    def param(self, name):
+        for param in self.info.params:
+            if param.name == name:
+                return param
+        raise vmodl.fault.InvalidRequest(msg=f"unexpected parameter {name} of {self.wsdl_name}")
+
+    def StartElementHandler(self, tag, attr):
+        self._collect()
+        self.depth += 1
+        _, name = tag.rpartition(SoapAdapter.NS_SEP)[::2]
+        if self.depth == 2:
+            self.in_body = name == 'Body'
+        elif self.depth == 3 and self.in_body:
+            self.wsdl_name = name
+        elif self.depth == 4 and self.in_body:
+            if name == '_this':
+                value_type = VmomiSupport.ManagedObject
+            else:
+                value_type = self.param(name).type
+                if issubclass(value_type, list):
+                    value_type = value_type.Item
+            self.pending = name
+            self.deser.Deserialize(self.parser, value_type, False, self.nsMap)
+            self.deser.StartElementHandler(tag, attr)
+
+    def EndElementHandler(self, tag):
+        self._collect()
+        self.depth -= 1
+
+    def CharacterDataHandler(self, data):
+        pass
+
+def method_info(mo, wsdl_name):
+    """Return the method info of a SOAP method, including the Fetch calls pyVmomi makes for property reads"""
+    if wsdl_name == 'Fetch':
+        return VmomiSupport.Object(
+            name='Fetch', wsdlName='Fetch', version=SOAP_VERSION, isTask=False,
+            params=(VmomiSupport.Object(name='prop', type=str, version=SOAP_VERSION, flags=0),),
+            result=object, resultFlags=0
+        )
+    try:
+        return VmomiSupport.GetWsdlMethod(VmomiSupport.GetWsdlNamespace(SOAP_VERSION), wsdl_name).info
+    except KeyError:
+        raise vmodl.fault.MethodNotFound(receiver=mo, method=wsdl_name)
+
+def soap_envelope(body):
+    return ''.join([
+        SoapAdapter.XML_HEADER, '\n', SoapAdapter.SOAP_ENVELOPE_START, SoapAdapter.SOAP_BODY_START,
+        body, SoapAdapter.SOAP_BODY_END, SoapAdapter.SOAP_ENVELOPE_END
+    ]).encode(SoapAdapter.XML_ENCODING)
+
+def soap_namespaces():
+    ns_map = SoapAdapter.SOAP_NSMAP.copy()
+    ns_map[VmomiSupport.GetWsdlNamespace(SOAP_VERSION)] = ''
+    return ns_map
+
+def serialize_response(info, result, result_type):
+    """Serialize a method result the way vCenter answers it; void and unset results have no returnval"""
+    returnval = '' if result is None else SoapAdapter.SerializeToStr(
+        result,
+        VmomiSupport.Object(name='returnval', type=result_type, version=SOAP_VERSION, flags=info.resultFlags),
+        SOAP_VERSION,
+        soap_namespaces()
+    )
+    namespace = VmomiSupport.GetWsdlNamespace(SOAP_VERSION)
+    return soap_envelope(f'<{info.wsdlName}Response xmlns="{namespace}">{returnval}</{info.wsdlName}Response>')
+
+def serialize_fault(fault):
+    detail = SoapAdapter.SerializeFaultDetail(
+        fault,
+        VmomiSupport.Object(name=f"{fault._wsdlName}Fault", type=object, version=SOAP_VERSION, flags=0),
+        SOAP_VERSION,
+        SoapAdapter.SOAP_NSMAP.copy()
+    )
+    message = SoapAdapter.XmlEscape(fault.msg or type(fault).__name__)
+    return soap_envelope(
+        f'<{SoapAdapter.SOAP_NSMAP[SoapAdapter.XMLNS_SOAPENV]}:Fault><faultcode>ServerFaultCode</faultcode>'
+        f'<faultstring>{message}</faultstring><detail>{detail}</detail>'
+        f'</{SoapAdapter.SOAP_NSMAP[SoapAdapter.XMLNS_SOAPENV]}:Fault>'
+    )
+
+def service_versions():
+    """vimServiceVersions.xml, which SmartConnect reads to pick an API version"""
+    namespace, _, version = VmomiSupport.versionIdMap[SOAP_VERSION].rpartition('/')
+    return (
+        '<?xml version="1.0" encoding="UTF-8" ?>\n<namespaces version="1.0"><namespace>'
+        f'<name>urn:{namespace or "vim25"}</name><version>{version}</version>'
+        '</namespace></namespaces>'
+    ).encode()
+
+class SoapRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/sdk/vimServiceVersions.xml':
+            self.send_error(404)
+            return
+        self.respond(200, service_versions())
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        # pyVmomi echoes the whole Set-Cookie value back; the session is its first part
+        cookie = (self.headers.get('Cookie') or '').split(';')[0].strip()
+        status, body, new_cookie = self.server.dispatch(request, cookie)
+        self.respond(status, body, new_cookie)
+
+    def respond(self, status, body, cookie=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if cookie:
+            self.send_header('Set-Cookie', f"{cookie}; Path=/; HttpOnly; Secure")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class SoapServer(ThreadingHTTPServer):
+    """Serves a FakeVCenter over SOAP on a loopback port, so pyVmomi's own client and parser are exercised.
+
+    Requests and responses go through pyVmomi's serializers, with the fake's
+    latency applied per call. Only plain HTTP is served; connect and attach
+    are ConnectionPool stand-ins that reach it that way.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, vcenter, address='127.0.0.1', port=0):
+        super().__init__((address, port), SoapRequestHandler)
+        self.vcenter = vcenter
+        self.address, self.port = self.server_address[:2]
+        self.connect, self.attach = loopback_client(self.port, self.address)
+
+    def start(self):
+        """Serve from a background thread and return self"""
+        threading.Thread(target=self.serve_forever, name='fake-vcenter-soap', daemon=True).start()
+        return self
+
+    def dispatch(self, request, cookie):
+        """Run one SOAP request; returns (HTTP status, body, cookie of a new login session or None)"""
+        try:
+            mo, info, args = SoapRequestDeserializer().Deserialize(request)
+            method = 'Fetch' if info.wsdlName == 'Fetch' else info.name
+            stub = None if method in ANONYMOUS_METHODS else FakeStub(self.vcenter, cookie)
+            result = self.vcenter.invoke(mo, method, args, stub)
+            result_type = type(mo)._GetPropertyInfo(args[0]).type if method == 'Fetch' else info.result
+            new_cookie = self.vcenter.new_login_session() if method == 'Login' else None
+            return 200, serialize_response(info, result, result_type), new_cookie
+        except vmodl.MethodFault as fault:
+            return 500, serialize_fault(fault), None
+        except Exception as e:
+            return 500, serialize_fault(vmodl.fault.SystemError(reason=str(e), msg=str(e))), None
+
+def loopback_client(port, address='127.0.0.1'):
+    """Return (connect, attach) stand-ins for ConnectionPool that log in to a SoapServer with SmartConnect"""
+    def connect(host=None, user=None, pwd=None, **kwargs):
+        return SmartConnect(protocol='http', host=address, port=port, user=user, pwd=pwd)
+
+    def attach(host=None, cookie=None, **kwargs):
+        # SmartStubAdapter cannot negotiate over plain HTTP; the version is known anyway
+        stub = SoapAdapter.SoapStubAdapter(host=address, port=-port, version=SOAP_VERSION)
+        stub.cookie = cookie
+        return vim.ServiceInstance('ServiceInstance', stub)
+
+    return connect, attach
+
+def parse_method_latency(value):
+    """Parse comma separated method=seconds pairs into a dict"""
+    method_latency = {}
+    for item in filter(None, (value or '').split(',')):
+        method, _, seconds = item.partition('=')
+        method_latency[method.strip()] = float(seconds)
+    return method_latency
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake vCenter over SOAP on a loopback port')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8989)
+    parser.add_argument('--vms', type=int, default=1000,
+                        help='Synthetic inventory size')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every call')
+    parser.add_argument('--method-latency', default='',
+                        help='Comma separated method=seconds overrides, e.g. RetrievePropertiesEx=0.05')
+    parser.add_argument('--powered-on', type=float, default=0.7,
+                        help='Share of VMs powered on')
+    parser.add_argument('--with-ip', type=float, default=1.0,
+                        help='Share of powered-on VMs reporting a guest IP')
+    parser.add_argument('--with-snapshots', type=float, default=0.3,
+                        help='Share of VMs carrying a snapshot tree')
+    parser.add_argument('--max-snapshots', type=int, default=4,
+                        help='Most snapshots per tree')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    vcenter = FakeVCenter(
+        vm_count=args.vms, latency=args.latency, seed=args.seed, powered_on_ratio=args.powered_on,
+        ip_ratio=args.with_ip, snapshot_ratio=args.with_snapshots, max_snapshots=args.max_snapshots,
+        method_latency=parse_method_latency(args.method_latency)
+    )
+    server = SoapServer(vcenter, args.address, args.port)
+    print(f"Fake vCenter with {args.vms} VMs at http://{server.address}:{server.port}/sdk", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
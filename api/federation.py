@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import admission
+import instrumentation
+
+# Seconds each vCenter has to answer a federated query before it is reported as timed out
+SITE_TIMEOUT = float(os.environ.get('FEDERATION_SITE_TIMEOUT', 10))
+
+# Threads running the calls of federated queries to one vCenter, shared by all
+# requests. Calls that time out keep their thread until they return, so a
+# vCenter with all of its threads taken is reported busy instead of queueing
+# more calls, and a slow vCenter cannot take threads from the others.
+SITE_THREADS = int(os.environ.get('FEDERATION_SITE_THREADS', 8))
+
+# Most VMs a federated metrics query may ask for
+MAX_METRICS_VMS = int(os.environ.get('FEDERATION_MAX_METRICS_VMS', 100))
+
+# Separates the vCenter id from the moref in federated VM ids
+ID_SEPARATOR = ':'
+
+# Per-vCenter executors and their calls in flight, keyed by vCenter host
+executors = {}
+in_flight = {}
+executors_lock = threading.Lock()
+
+def new_federation_id():
+    return f"federation-{int(time.time())}-{uuid.uuid4().hex[:16]}"
+
+def configured_vcenters():
+    """Return the vCenters listed in the VCENTERS environment variable (a JSON array), if any"""
+    value = os.environ.get('VCENTERS')
+    return json.loads(value) if value else []
+
+def vcenter_ids(vcenters):
+    """Return an id per vCenter definition: its own 'id', else one derived from its position"""
+    ids = [str(vcenter.get('id') or f"vc{position + 1}") for position, vcenter in enumerate(vcenters)]
+    if len(set(ids)) != len(ids):
+        raise ValueError('vCenter ids must be unique')
+    if any(ID_SEPARATOR in vcenter_id for vcenter_id in ids):
+        raise ValueError(f"vCenter ids must not contain '{ID_SEPARATOR}'")
+    return ids
+
+def global_id(vcenter_id, moref):
+    return f"{vcenter_id}{ID_SEPARATOR}{moref}"
+
+def split_id(value):
+    """Return (vcenter id, moref) of a federated VM id; raises ValueError if it has no vCenter part"""
+    vcenter_id, separator, moref = value.partition(ID_SEPARATOR)
+    if not separator or not vcenter_id or not moref:
+        raise ValueError(f"invalid federated VM id: {value}")
+    return vcenter_id, moref
+
+def tag(vcenter_id, entry):
+    """Return a copy of a per-vCenter entry tagged with its vCenter and moref"""
+    return dict(entry, id=global_id(vcenter_id, entry['id']), vcenter_id=vcenter_id, moref=entry['id'])
+
+def submit(host, fn, *args):
+    """Run fn on the executor of a vCenter host; returns its future, or None while all of its threads are taken"""
+    with executors_lock:
+        if in_flight.get(host, 0) >= SITE_THREADS:
+            return None
+        in_flight[host] = in_flight.get(host, 0) + 1
+        executor = executors.get(host)
+        if executor is None:
+            executor = executors[host] = ThreadPoolExecutor(SITE_THREADS, thread_name_prefix=f"federation-{host}")
+
+    future = executor.submit(fn, *args)
+    future.add_done_callback(lambda _: release(host))
+    return future
+
+def release(host):
+    with executors_lock:
+        in_flight[host] -= 1
+
+def fan_out(sites, call, timeout=SITE_TIMEOUT):
+    """Run call(site) for every site in parallel; returns (results, statuses).
+
+    results maps the id of each site that answered within timeout seconds to
+    its result. statuses holds one record per site, in order, saying whether
+    it answered ('ok'), raised ('error'), was too slow ('timeout') or still
+    had SITE_THREADS calls running ('busy'). The whole fan-out takes as long
+    as its slowest site, at most timeout; calls still running past it are
+    left to finish on their own and discarded.
+    """
+    timings = {}
+
+    call = admission.carry_class(instrumentation.carry_profile(call))
+
+    def timed(site):
+        started = time.monotonic()
+        try:
+            return call(site)
+        finally:
+            timings[site['id']] = time.monotonic() - started
+
+    started = time.monotonic()
+    futures = [(site, submit(site['host'], timed, site)) for site in sites]
+    wait([future for _, future in futures if future is not None], timeout)
+
+    results, statuses = {}, []
+    for site, future in futures:
+        status = {'id': site['id'], 'host': site['host']}
+        if future is None:
+            status.update(status='busy', error=f"{SITE_THREADS} earlier calls still running", elapsed_ms=0)
+        elif not future.done():
+            future.cancel()
+            status.update(status='timeout', error=f"no answer within {timeout:g}s", elapsed_ms=round(timeout * 1000))
+        elif future.exception() is not None:
+            status.update(status='error', error=str(future.exception()) or type(future.exception()).__name__)
+        else:
+            results[site['id']] = future.result()
+            status['status'] = 'ok'
+        if 'elapsed_ms' not in status:
+            status['elapsed_ms'] = round(timings.get(site['id'], time.monotonic() - started) * 1000)
+        statuses.append(status)
+
+    return results, statuses
+
+def merged(results, sites):
+    """Concatenate per-site entry lists in site order, tagging every entry"""
+    entries = []
+    for site in sites:
+        entries.extend(tag(site['id'], entry) for entry in results.get(site['id'], ()))
+    return entries
@@ -0,0 +1,414 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import secrets
+import threading
+from bisect import bisect_left
+
+# Directory where every worker process publishes its Prometheus metrics; /metrics
+# merges them. Kept apart from the VM metrics history under METRICS_DIR.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(os.path.dirname(os.environ.get('DB_FILE', '/app/data/vm_captain.db')), 'prometheus')
+)
+
+# Seconds between writes of this process's metrics file
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+# Request header asking for a Server-Timing breakdown of the response
+PROFILE_HEADER = 'X-Profile'
+
+# Holds the counters of worker processes that have exited, so totals never go backwards
+RETIRED_FILE = 'retired.json'
+
+# Histogram bucket upper bounds
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CALL_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self.series)
+
+class Gauge(Counter):
+    """A value set at collection time; merge says how workers' values combine ('sum' or 'max')"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), merge='sum'):
+        super().__init__(name, documentation, labels)
+        self.merge = merge
+
+    def set(self, labels, value):
+        with self._lock:
+            self.series[labels] = value
+
+class Histogram(Counter):
+    """Bucketed observations; each series is a list of per-bucket counts, the +Inf count and the sum"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=REQUEST_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, labels, value):
+        with self._lock:
+            counts = self.series.get(labels)
+            if counts is None:
+                counts = self.series[labels] = [0] * (len(self.buckets) + 2)
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def values(self):
+        with self._lock:
+            return {labels: list(counts) for labels, counts in self.series.items()}
+
+class Registry:
+    """This process's metric families, published to a file shared by all workers.
+
+    Every worker rewrites its own file every METRICS_FLUSH_INTERVAL seconds and
+    when it is scraped. A scrape merges all files: counters and histograms are
+    summed, gauges are combined only from workers that are still running.
+    Files of exited workers are folded into one retired file.
+    """
+
+    def __init__(self, directory=PROMETHEUS_MULTIPROC_DIR, interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.families = {}
+        # Called before every flush to refresh gauges
+        self.collectors = []
+        self._flusher = None
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.path = os.path.join(self.directory, f"worker-{self.pid}-{secrets.token_hex(4)}.json")
+
+    def register(self, family):
+        self.families[family.name] = family
+        return family
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), merge='sum'):
+        return self.register(Gauge(name, documentation, labels, merge))
+
+    def histogram(self, name, documentation, labels=(), buckets=REQUEST_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def after_fork(self):
+        """Start over in a forked child; its parent's numbers stay in the parent's file"""
+        for family in self.families.values():
+            family._lock = threading.Lock()
+            family.series.clear()
+        running = self._flusher is not None
+        self._flusher = None
+        self._reset()
+        if running:
+            self.start()
+
+    def start(self):
+        """Flush periodically from a background thread, and once more at exit"""
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def snapshot(self):
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception:
+                pass
+        return {
+            name: {
+                'kind': family.kind,
+                'help': family.documentation,
+                'labels': list(family.labels),
+                'buckets': list(getattr(family, 'buckets', ())),
+                'merge': getattr(family, 'merge', 'sum'),
+                'series': [[list(labels), value] for labels, value in family.values().items()],
+            }
+            for name, family in self.families.items()
+        }
+
+    def flush(self):
+        """Write this process's metrics file atomically"""
+        write_json(self.path, {'pid': self.pid, 'families': self.snapshot()})
+
+    def collect(self):
+        """Return the merged metric families of all workers, as written by their last flush"""
+        self.flush()
+        merged = {}
+        stale_after = max(3 * self.interval, 30)
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                retired = read_json(os.path.join(self.directory, RETIRED_FILE)) or {'families': {}}
+                exited = []
+                for entry in os.scandir(self.directory):
+                    if not entry.name.startswith('worker-') or not entry.name.endswith('.json'):
+                        continue
+                    data = read_json(entry.path)
+                    if data is None:
+                        continue
+                    fresh = time.time() - entry.stat().st_mtime < stale_after
+                    if not fresh and not pid_alive(data['pid']):
+                        exited.append(entry.path)
+                        merge_families(retired['families'], data['families'], gauges=False)
+                    else:
+                        merge_families(merged, data['families'], gauges=fresh)
+
+                if exited:
+                    write_json(os.path.join(self.directory, RETIRED_FILE), retired)
+                    for path in exited:
+                        os.remove(path)
+                merge_families(merged, retired['families'], gauges=False)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return merged
+
+    def exposition(self):
+        """Return the merged metrics in the Prometheus text format"""
+        return render(self.collect())
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(temporary, path)
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+def merge_families(into, families, gauges=True):
+    """Add one worker's families into merged ones; gauges are skipped unless gauges is set"""
+    for name, family in families.items():
+        if family['kind'] == 'gauge' and not gauges:
+            continue
+        target = into.setdefault(name, dict(family, series=[]))
+        series = {tuple(labels): value for labels, value in target['series']}
+        for labels, value in family['series']:
+            labels = tuple(labels)
+            current = series.get(labels)
+            if current is None:
+                series[labels] = value
+            elif family['kind'] == 'histogram':
+                series[labels] = [a + b for a, b in zip(current, value)]
+            elif family['kind'] == 'gauge' and family['merge'] == 'max':
+                series[labels] = max(current, value)
+            else:
+                series[labels] = current + value
+        target['series'] = [[list(labels), value] for labels, value in series.items()]
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def label_text(names, values, extra=None):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def number(value):
+    if isinstance(value, float):
+        return repr(value) if value != int(value) else str(int(value))
+    return str(value)
+
+def render(families):
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        kind, names = family['kind'], family['labels']
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(family['series']):
+            if kind != 'histogram':
+                lines.append(f"{name}{label_text(names, labels)} {number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(family['buckets']) + ['+Inf'], value[:-1]):
+                cumulative += count
+                le = 'le="+Inf"' if bound == '+Inf' else f'le="{number(float(bound))}"'
+                lines.append(f"{name}_bucket{label_text(names, labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{label_text(names, labels)} {number(value[-1])}")
+            lines.append(f"{name}_count{label_text(names, labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+registry = Registry()
+os.register_at_fork(after_in_child=registry.after_fork)
+atexit.register(lambda: registry.flush() if os.getpid() == registry.pid else None)
+
+http_requests = registry.histogram(
+    'vmcaptain_http_request_duration_seconds',
+    'Time until an API response starts, by route',
+    ('route', 'method', 'status'),
+    REQUEST_BUCKETS
+)
+http_response_sizes = registry.histogram(
+    'vmcaptain_http_response_size_bytes',
+    'Bytes in API response bodies, by route',
+    ('route',),
+    SIZE_BUCKETS
+)
+vcenter_calls = registry.histogram(
+    'vmcaptain_vcenter_call_duration_seconds',
+    'Duration of vCenter API calls, by method',
+    ('method',),
+    CALL_BUCKETS
+)
+vcenter_call_errors = registry.counter(
+    'vmcaptain_vcenter_call_errors_total',
+    'vCenter API calls that raised, by method',
+    ('method',)
+)
+admission_rejections = registry.counter(
+    'vmcaptain_admission_rejections_total',
+    'vCenter calls refused by admission control, by call class and whether the queue was full or timed out',
+    ('class', 'reason')
+)
+sqlite_queries = registry.histogram(
+    'vmcaptain_sqlite_query_duration_seconds',
+    'Time SQLite spent executing statements, up to their first row',
+    ('operation', 'table'),
+    QUERY_BUCKETS
+)
+
+# The request being profiled on this thread (greenlet under gevent), if any
+_local = threading.local()
+
+class Profile:
+    """Time spent per vCenter method and SQL statement during one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind, name, seconds):
+        with self._lock:
+            span = self.spans.get((kind, name))
+            if span is None:
+                span = self.spans[(kind, name)] = [0, 0.0]
+            span[0] += 1
+            span[1] += seconds
+
+    def server_timing(self):
+        """Return a Server-Timing header value: totals per kind, the rest of the request, then each method"""
+        total = time.perf_counter() - self.started
+        kinds = {}
+        for (kind, _), (count, seconds) in self.spans.items():
+            summary = kinds.setdefault(kind, [0, 0.0])
+            summary[0] += count
+            summary[1] += seconds
+
+        entries = [
+            f'{kind};dur={seconds * 1000:.2f};desc="{count} calls"'
+            for kind, (count, seconds) in sorted(kinds.items())
+        ]
+        entries.append(f'app;dur={max(0.0, total - sum(s for _, s in kinds.values())) * 1000:.2f}')
+        entries.append(f'total;dur={total * 1000:.2f}')
+        entries.extend(
+            f'{kind}-{name};dur={seconds * 1000:.2f};desc="{count} calls"'
+            for (kind, name), (count, seconds) in sorted(self.spans.items(), key=lambda item: -item[1][1])
+        )
+        return ', '.join(entries)
+
+def start_profile():
+    _local.profile = profile = Profile()
+    return profile
+
+def stop_profile():
+    _local.profile = None
+
+def carry_profile(fn):
+    """Return fn, wrapped to add its calls to the current request's profile when it runs on another thread"""
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return fn
+
+    def run(*args, **kwargs):
+        _local.profile = profile
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.profile = None
+    return run
+
+def record_vcenter_call(method, seconds, failed=False):
+    vcenter_calls.observe((method,), seconds)
+    if failed:
+        vcenter_call_errors.inc((method,))
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.add('vcenter', method, seconds)
+
+def record_query(operation, table, seconds):
+    sqlite_queries.observe((operation, table), seconds)
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.add('sqlite', f"{operation}-{table}" if table else operation, seconds)
+
+class CountedBody:
+    """Wraps a streamed response body, recording its size when the server closes it"""
+
+    def __init__(self, body, record):
+        self.body = body
+        self.record = record
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            if self.record is not None:
+                self.record(self.size)
+                self.record = None
@@ -0,0 +1,492 @@
+import os
+import re
+import json
+import time
+import zlib
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from pyVmomi import vim, vmodl
+
+logger = logging.getLogger(__name__)
+
+# Properties needed to render the VM list view. Anything not listed here is
+# never transferred from vCenter for list requests.
+VM_LIST_PROPERTIES = [
+    'name',
+    'runtime.powerState',
+    'config.guestFullName',
+    'guest.ipAddress',
+]
+
+# Maximum number of objects vCenter returns per RetrievePropertiesEx page
+PAGE_SIZE = int(os.environ.get('VCENTER_PAGE_SIZE', 1000))
+
+# How long a single WaitForUpdatesEx call may block in vCenter
+WAIT_SECONDS = int(os.environ.get('INVENTORY_WAIT_SECONDS', 30))
+
+# Stop following a vCenter after this many seconds without list requests
+IDLE_TIMEOUT = int(os.environ.get('INVENTORY_IDLE_TIMEOUT', 900))
+
+# Delay before reconnecting after the update feed fails
+RETRY_DELAY = int(os.environ.get('INVENTORY_RETRY_DELAY', 5))
+
+# Removed VMs remembered for delta queries
+TOMBSTONE_LIMIT = int(os.environ.get('INVENTORY_TOMBSTONE_LIMIT', 10000))
+
+# Directory of the inventory checkpoints served at startup, next to the SQLite database by default
+CHECKPOINT_DIR = os.environ.get(
+    'INVENTORY_CHECKPOINT_DIR',
+    os.path.join(os.path.dirname(os.environ.get('DB_FILE', '/app/data/vm_captain.db')), 'inventory')
+)
+
+# Minimum seconds between checkpoints of a changing inventory; 0 disables checkpoints
+CHECKPOINT_INTERVAL = int(os.environ.get('INVENTORY_CHECKPOINT_INTERVAL', 60))
+
+# Checkpoints older than this many seconds are ignored at startup
+CHECKPOINT_MAX_AGE = int(os.environ.get('INVENTORY_CHECKPOINT_MAX_AGE', 86400))
+
+# Bumped whenever the checkpoint layout changes; other formats are ignored
+CHECKPOINT_FORMAT = 1
+
+def build_view_filter_spec(view, obj_type, path_set):
+    """Build a PropertyFilterSpec selecting path_set on every object in a container or list view"""
+    traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+        name='traverseView',
+        path='view',
+        skip=False,
+        type=type(view)
+    )
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+        obj=view,
+        skip=True,
+        selectSet=[traversal_spec]
+    )
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+        type=obj_type,
+        pathSet=path_set,
+        all=False
+    )
+    return vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[obj_spec],
+        propSet=[prop_spec]
+    )
+
+def retrieve_properties(property_collector, filter_spec, page_size=PAGE_SIZE):
+    """Yield (managed object, properties dict) pairs, following result paging"""
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+    result = property_collector.RetrievePropertiesEx([filter_spec], options)
+
+    while result:
+        for obj_content in result.objects:
+            props = {prop.name: prop.val for prop in obj_content.propSet}
+            yield obj_content.obj, props
+
+        if not result.token:
+            break
+        result = property_collector.ContinueRetrievePropertiesEx(result.token)
+
+def iter_vm_properties(service_instance, path_set=None, page_size=PAGE_SIZE):
+    """Yield (moref id, properties dict) for every VM using a single container view"""
+    content = service_instance.RetrieveContent()
+    container = content.viewManager.CreateContainerView(
+        content.rootFolder, [vim.VirtualMachine], True
+    )
+
+    try:
+        filter_spec = build_view_filter_spec(
+            container, vim.VirtualMachine, path_set or VM_LIST_PROPERTIES
+        )
+        for vm, props in retrieve_properties(content.propertyCollector, filter_spec, page_size):
+            yield vm._moId, props
+    finally:
+        container.Destroy()
+
+def fetch_vm_inventory(service_instance, path_set=None, page_size=PAGE_SIZE):
+    """Return a list of (moref id, properties dict) for every VM"""
+    return list(iter_vm_properties(service_instance, path_set, page_size))
+
+def vm_list_entry(vm_id, props):
+    """Convert retrieved VM properties to the list view representation"""
+    power_state = props.get('runtime.powerState')
+
+    vm_data = {
+        'id': vm_id,
+        'name': props.get('name'),
+        'power_state': str(power_state) if power_state else 'UNKNOWN',
+        'guest_full_name': props.get('config.guestFullName') or 'Unknown',
+    }
+
+    # Add IP address if available
+    if props.get('guest.ipAddress'):
+        vm_data['ip_address'] = props['guest.ipAddress']
+
+    return vm_data
+
+def checkpoint_file(name):
+    """Return the checkpoint file of a vCenter's VM list"""
+    return os.path.join(CHECKPOINT_DIR, re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '.json.z')
+
+def write_checkpoint(path, data):
+    """Write a compressed JSON checkpoint atomically; readers see the old or the new file, never a mix"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    payload = zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_checkpoint(path, path_set, max_age=CHECKPOINT_MAX_AGE):
+    """Return a checkpoint of the given properties, or None if it is missing, unreadable, foreign or too old"""
+    try:
+        with open(path, 'rb') as f:
+            data = json.loads(zlib.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, zlib.error) as e:
+        logger.warning("Ignoring unreadable inventory checkpoint %s: %s", path, e)
+        return None
+
+    if (not isinstance(data, dict) or data.get('format') != CHECKPOINT_FORMAT
+            or data.get('path_set') != list(path_set) or time.time() - data.get('saved_at', 0) > max_age):
+        return None
+    return data
+
+class InventoryCache:
+    """In-memory VM inventory for one vCenter, kept current with WaitForUpdatesEx.
+
+    Given a checkpoint file, the cache starts from the inventory saved there
+    and is ready at once, flagged stale until the feed has resynced with
+    vCenter. While following updates it saves the inventory again at most
+    every checkpoint_interval seconds, and only when it changed.
+    """
+
+    def __init__(self, name, service_instance, path_set=None, entry_factory=vm_list_entry,
+                 wait_seconds=WAIT_SECONDS, idle_timeout=IDLE_TIMEOUT, checkpoint_file=None,
+                 checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.name = name
+        self.service_instance = service_instance
+        self.path_set = path_set or VM_LIST_PROPERTIES
+        self.entry_factory = entry_factory
+        self.wait_seconds = wait_seconds
+        self.idle_timeout = idle_timeout
+        self.checkpoint_file = checkpoint_file if checkpoint_interval > 0 else None
+        self.checkpoint_interval = checkpoint_interval
+
+        # Local monotonic version, bumped once per applied update batch that
+        # changes anything. The epoch keeps ETags unique across restarts.
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.resyncs = 0
+        self.last_error = None
+        self.last_access = time.time()
+        self.ready = threading.Event()
+
+        # True while serving a restored checkpoint the feed has not confirmed yet
+        self.stale = False
+
+        self._props = {}
+        self._entries = {}
+        self._json = None
+
+        # Version at which each VM last changed, and tombstones for removed
+        # VMs; both ordered oldest first. Versions below _horizon are no
+        # longer reconstructable.
+        self._vm_versions = {}
+        # Version at which each VM was first seen, to tell additions from changes
+        self._vm_added = {}
+        self._removed = OrderedDict()
+        self._horizon = 0
+
+        # Callables invoked as listener(version, added, changed, removed)
+        # after each version change, outside the cache lock
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self._checkpointed_version = None
+        self._checkpointed_at = 0.0
+        self._checkpoint_lock = threading.Lock()
+        if self.checkpoint_file:
+            self._restore()
+
+    @property
+    def etag(self):
+        return f"{self.epoch}-{self.version}"
+
+    def attach(self, service_instance):
+        """Use service_instance for future (re)connects and make sure the worker is running"""
+        self.service_instance = service_instance
+        self.last_access = time.time()
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name=f"inventory-{self.name}", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        """Ask the worker to exit after its current WaitForUpdatesEx call"""
+        self._stopping.set()
+
+    def wait_ready(self, timeout):
+        """Block until the initial inventory has been loaded"""
+        return self.ready.wait(timeout)
+
+    def entries(self):
+        """Return (version, list of VM list entries)"""
+        with self._lock:
+            return self.version, list(self._entries.values())
+
+    def json(self):
+        """Return (version, serialized VM list), serializing at most once per version"""
+        with self._lock:
+            if self._json is None or self._json[0] != self.version:
+                self._json = (self.version, json.dumps(list(self._entries.values())).encode())
+            return self._json
+
+    def checkpoint(self):
+        """Save the inventory and its version to the checkpoint file if it changed since the last save"""
+        if not self.checkpoint_file or self.stale or not self.ready.is_set():
+            return False
+
+        with self._checkpoint_lock:
+            with self._lock:
+                version = self.version
+                if version == self._checkpointed_version:
+                    return False
+                # Property dicts are replaced on change, never modified, so they are serialized unlocked
+                vms = list(self._props.items())
+
+            try:
+                write_checkpoint(self.checkpoint_file, {
+                    'format': CHECKPOINT_FORMAT,
+                    'name': self.name,
+                    'version': version,
+                    'saved_at': time.time(),
+                    'path_set': list(self.path_set),
+                    'vms': vms,
+                })
+            except (OSError, TypeError, ValueError) as e:
+                logger.warning("Could not checkpoint inventory of %s: %s", self.name, e)
+                return False
+
+            self._checkpointed_version = version
+            self._checkpointed_at = time.monotonic()
+            return True
+
+    def _restore(self):
+        """Load the last checkpoint, if any, and serve it as stale until the feed resyncs"""
+        data = read_checkpoint(self.checkpoint_file, self.path_set)
+        if data is None:
+            return
+
+        with self._lock:
+            # Versions up to the checkpoint's cannot be replayed; the new epoch tells clients so
+            self.version = self._horizon = data['version']
+            for vm_id, props in data['vms']:
+                self._set_entry(vm_id, props, self.version)
+            self._checkpointed_version = self.version
+
+        self.stale = True
+        self.ready.set()
+        logger.info("Restored %d VMs of %s from a checkpoint %.0fs old",
+                    len(data['vms']), self.name, time.time() - data['saved_at'])
+
+    def _run(self):
+        while not self._stopping.is_set() and not self._idle():
+            try:
+                self._follow_updates()
+            except Exception as e:
+                if self._stopping.is_set():
+                    break
+                self.last_error = str(e)
+                self.resyncs += 1
+                logger.warning("Inventory feed for %s failed, resyncing: %s", self.name, e)
+                self._stopping.wait(RETRY_DELAY)
+
+        # Whatever we hold is no longer followed; the next attach resyncs first
+        self.ready.clear()
+        logger.info("Inventory feed for %s stopped", self.name)
+
+    def _idle(self):
+        return time.time() - self.last_access > self.idle_timeout
+
+    def _follow_updates(self):
+        """Load the full inventory and then apply incremental updates until stopped"""
+        content = self.service_instance.RetrieveContent()
+
+        # A private collector keeps our filter and version out of the session's default one
+        collector = content.propertyCollector.CreatePropertyCollector()
+        container = content.viewManager.CreateContainerView(
+            content.rootFolder, [vim.VirtualMachine], True
+        )
+
+        try:
+            filter_spec = build_view_filter_spec(container, vim.VirtualMachine, self.path_set)
+            collector.CreateFilter(filter_spec, partialUpdates=True)
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.wait_seconds)
+
+            # An empty version returns every VM as 'enter'; after a reconnect that
+            # is reconciled against what we already hold.
+            version = ''
+            seen = set()
+            resyncing = True
+
+            while not self._stopping.is_set() and not self._idle():
+                update_set = collector.WaitForUpdatesEx(version, options)
+                if update_set is not None:
+                    self._apply(update_set, seen if resyncing else None)
+                    version = update_set.version
+
+                    if resyncing and not update_set.truncated:
+                        self._finish_resync(seen)
+                        resyncing = False
+                        self.stale = False
+                        self.last_error = None
+                        self.ready.set()
+
+                if not resyncing and time.monotonic() - self._checkpointed_at >= self.checkpoint_interval:
+                    self.checkpoint()
+        finally:
+            try:
+                collector.Destroy()
+                container.Destroy()
+            except Exception:
+                pass
+
+    def add_listener(self, listener):
+        """Register a callable notified with every applied change batch"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def get_entries(self, vm_ids):
+        """Return the list entries for the given VM ids that exist"""
+        with self._lock:
+            return [self._entries[vm_id] for vm_id in vm_ids if vm_id in self._entries]
+
+    def changes_since(self, since, epoch=None):
+        """Return the VMs added, changed and removed after version since.
+
+        Returns None when since cannot be answered incrementally (another
+        epoch, a future version or older than the retained tombstones) and
+        the caller has to reload the full list.
+        """
+        with self._lock:
+            if (epoch is not None and epoch != self.epoch) or since > self.version or since < self._horizon:
+                return None
+
+            # _vm_versions and _removed are kept ordered by version, so only
+            # the tail newer than since is visited
+            added, changed = [], []
+            for vm_id in reversed(self._vm_versions):
+                if self._vm_versions[vm_id] <= since:
+                    break
+                (added if self._vm_added[vm_id] > since else changed).append(self._entries[vm_id])
+
+            removed = []
+            for vm_id in reversed(self._removed):
+                if self._removed[vm_id] <= since:
+                    break
+                removed.append(vm_id)
+
+            return {
+                'version': self.version,
+                'epoch': self.epoch,
+                'added': added,
+                'changed': changed,
+                'removed': removed,
+            }
+
+    def _apply(self, update_set, seen):
+        """Apply one UpdateSet, bumping the version only if an entry changed"""
+        added, changed, removed = [], [], []
+
+        with self._lock:
+            next_version = self.version + 1
+
+            for filter_update in update_set.filterSet or []:
+                for obj_update in filter_update.objectSet or []:
+                    vm_id = obj_update.obj._moId
+
+                    if obj_update.kind == 'leave':
+                        if vm_id in self._props:
+                            self._remove_entry(vm_id, next_version)
+                            removed.append(vm_id)
+                        continue
+
+                    if seen is not None:
+                        seen.add(vm_id)
+
+                    if obj_update.kind == 'enter':
+                        props = {}
+                    else:
+                        props = dict(self._props.get(vm_id, {}))
+
+                    for change in obj_update.changeSet or []:
+                        if change.op in ('remove', 'indirectRemove') or change.val is None:
+                            props.pop(change.name, None)
+                        else:
+                            props[change.name] = change.val
+
+                    previous = self._props.get(vm_id)
+                    if previous != props:
+                        self._set_entry(vm_id, props, next_version)
+                        (changed if previous is not None else added).append(self._entries[vm_id])
+
+            if added or changed or removed:
+                self.version = next_version
+
+        self._notify(added, changed, removed)
+
+    def _finish_resync(self, seen):
+        """Drop VMs that disappeared while we were not following updates"""
+        with self._lock:
+            gone = [vm_id for vm_id in self._props if vm_id not in seen]
+            for vm_id in gone:
+                self._remove_entry(vm_id, self.version + 1)
+            if gone:
+                self.version += 1
+
+        self._notify([], [], gone)
+
+    def _notify(self, added, changed, removed):
+        if not (added or changed or removed):
+            return
+
+        for listener in list(self._listeners):
+            try:
+                listener(self.version, added, changed, removed)
+            except Exception as e:
+                logger.error("Inventory listener for %s failed: %s", self.name, e)
+
+    def _set_entry(self, vm_id, props, version):
+        if vm_id not in self._props:
+            self._vm_added[vm_id] = version
+        self._props[vm_id] = props
+        self._entries[vm_id] = self.entry_factory(vm_id, props)
+        self._removed.pop(vm_id, None)
+
+        # Re-insert so the dict stays ordered by version
+        self._vm_versions.pop(vm_id, None)
+        self._vm_versions[vm_id] = version
+
+    def _remove_entry(self, vm_id, version):
+        del self._props[vm_id]
+        del self._entries[vm_id]
+        del self._vm_versions[vm_id]
+        del self._vm_added[vm_id]
+        self._removed[vm_id] = version
+
+        # Forget the oldest tombstones; clients behind them must resync
+        while len(self._removed) > TOMBSTONE_LIMIT:
+            _, dropped_version = self._removed.popitem(last=False)
+            self._horizon = dropped_version
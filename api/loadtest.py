@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from urllib.parse import quote
+
+# Server entry points compared by the load test
+MODES = ('gunicorn', 'asgi')
+
+# Where the fake vCenter runs: inside the API process, or as a SOAP server the API reaches over HTTP
+VCENTERS = ('inprocess', 'soap')
+
+# Endpoints measured by name; {vm} is replaced with a VM of the inventory.
+# Paths under /api/ authenticate with the user token, the rest with the vCenter session and the user token.
+ENDPOINTS = {
+    'vms': '/vcenter/vms',
+    'search': '/vcenter/vms/search?q=vm&power_state=poweredOn&sort=name&limit=50',
+    'vm': '/vcenter/vms/{vm}',
+    'snapshots': '/vcenter/vms/{vm}/snapshots',
+    'metrics': '/vcenter/vms/{vm}/metrics',
+    'users': '/api/users',
+}
+
+# Histogram counting every call the API makes to vCenter
+ROUND_TRIP_SERIES = 'vmcaptain_vcenter_call_duration_seconds_count'
+
+# Seconds between memory samples of the server
+RSS_INTERVAL = 0.1
+
+def serve(mode, port, args):
+    """Run the API on port against a fake vCenter, as gunicorn (gevent) or uvicorn (ASGI)"""
+    def load_app():
+        # Imported here so gevent monkey-patches threading before the app starts its threads
+        import app
+        import fake_vcenter
+
+        if args.vcenter_port:
+            app.vcenter_pool.connect, app.vcenter_pool.attach = fake_vcenter.loopback_client(args.vcenter_port)
+        else:
+            vcenter = fake_vcenter.FakeVCenter(
+                vm_count=args.vms, latency=args.latency, powered_on_ratio=args.powered_on,
+                ip_ratio=args.with_ip, snapshot_ratio=args.with_snapshots, max_snapshots=args.max_snapshots,
+                method_latency=fake_vcenter.parse_method_latency(args.method_latency)
+            )
+            app.vcenter_pool.connect = vcenter.connect
+            app.vcenter_pool.attach = vcenter.attach
+        if mode == 'asgi':
+            import asgi
+            return asgi.app
+        return app.app
+
+    if mode == 'asgi':
+        import uvicorn
+        uvicorn.run(load_app(), host='127.0.0.1', port=port, log_level='warning', backlog=4096)
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for name, value in {
+                'bind': f"127.0.0.1:{port}",
+                'workers': 1,
+                'worker_class': 'gevent',
+                'worker_connections': 10000,
+                'backlog': 4096,
+                'loglevel': 'warning',
+            }.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return load_app()
+
+    Server().run()
+
+class Client:
+    """Minimal HTTP/1.1 keep-alive client, so the harness itself stays cheap per connection"""
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, headers=None, body=b''):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+
+        lines = [f"{method} {path} HTTP/1.1", 'Host: 127.0.0.1', f"Content-Length: {len(body)}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            self.close()
+            raise ConnectionError('connection closed')
+        status = int(status_line.split()[1])
+
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get('transfer-encoding') == 'chunked':
+            body = bytearray()
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                body += await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+        else:
+            body = await self.reader.readexactly(int(response_headers.get('content-length', 0)))
+
+        if response_headers.get('connection') == 'close':
+            self.close()
+        return status, body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+async def open_stream(port, path):
+    """Open an event stream and keep reading it; returns the task holding it open"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept: text/event-stream\r\n\r\n".encode())
+
+    async def drain():
+        try:
+            while await reader.read(65536):
+                pass
+        finally:
+            writer.close()
+
+    status_line = await reader.readline()
+    if b' 200 ' not in status_line:
+        writer.close()
+        raise ConnectionError(status_line.decode().strip() or 'stream refused')
+    return asyncio.create_task(drain())
+
+async def run_load(port, path, headers, concurrency, duration):
+    """Issue requests from concurrency keep-alive connections; returns (latencies, errors, seconds)"""
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        client = Client(port)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                status, _ = await client.request('GET', path, headers)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                errors += 1
+                client.close()
+                continue
+            if status >= 400:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+        client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - start
+
+async def round_trips(port):
+    """Return the number of vCenter calls the server has made so far, from its metrics"""
+    client = Client(port)
+    try:
+        _, body = await client.request('GET', '/metrics')
+    finally:
+        client.close()
+    total = 0.0
+    for line in body.decode().splitlines():
+        if line.startswith(ROUND_TRIP_SERIES):
+            total += float(line.rsplit(' ', 1)[1])
+    return total
+
+def process_rss(pid):
+    """Return the resident memory of a process and its descendants in bytes"""
+    total = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = f.read().split()
+    except OSError:
+        return total
+    return total + sum(process_rss(int(child)) for child in children)
+
+class PeakRSS:
+    """Samples the memory of a process tree on a thread and keeps the highest reading"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, process_rss(self.pid))
+            if self._stopped.wait(RSS_INTERVAL):
+                return
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def bench_mode(mode, port, server_pid, args):
+    """Connect, open the requested streams and measure each endpoint at each concurrency level"""
+    client = Client(port)
+    for _ in range(200):
+        try:
+            status, body = await client.request(
+                'POST', '/api/auth/login', {'Content-Type': 'application/json'},
+                b'{"username": "admin", "password": "123456"}'
+            )
+            break
+        except OSError:
+            client.close()
+            await asyncio.sleep(0.1)
+    else:
+        raise RuntimeError(f"{mode} server did not start")
+
+    user_token = json.loads(body)['token']
+    user_headers = {'Authorization': f"Bearer {user_token}"}
+
+    status, body = await client.request(
+        'POST', '/vcenter/connect', {'Content-Type': 'application/json', 'X-User-Token': user_token},
+        b'{"url": "https://vcenter.local", "username": "loadtest", "password": "loadtest"}'
+    )
+    session_id = json.loads(body)['session_id']
+    headers = {'Authorization': f"Bearer {session_id}", 'X-User-Token': user_token}
+
+    status, body = await client.request('GET', '/vcenter/vms', headers)
+    vm_id = json.loads(body)[0]['id']
+    client.close()
+    paths = [(name, ENDPOINTS.get(name, name).format(vm=quote(vm_id))) for name in args.endpoints]
+
+    streams = []
+    stream_path = f"/vcenter/vms/events?session={quote(session_id)}&user_token={quote(user_token)}"
+    stream_errors = 0
+    for _ in range(args.streams):
+        try:
+            streams.append(await open_stream(port, stream_path))
+        except (OSError, ConnectionError):
+            stream_errors += 1
+
+    results = []
+    for name, path in paths:
+        path_headers = user_headers if path.startswith('/api/') else headers
+
+        # Warm the caches behind the endpoint so every level measures steady-state serving
+        await run_load(port, path, path_headers, 1, 1)
+
+        for concurrency in args.concurrency:
+            calls = await round_trips(port)
+            with PeakRSS(server_pid) as rss:
+                latencies, errors, seconds = await run_load(port, path, path_headers, concurrency, args.duration)
+            calls = await round_trips(port) - calls
+            result = {
+                'mode': mode,
+                'vcenter': args.vcenter,
+                'endpoint': name,
+                'concurrency': concurrency,
+                'streams': len(streams),
+                'requests': len(latencies),
+                'requests_per_second': round(len(latencies) / seconds, 1),
+                'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+                'round_trips_per_request': round(calls / max(len(latencies) + errors, 1), 3),
+                'peak_rss_mb': round(rss.peak / 2**20, 1),
+                'errors': errors + stream_errors,
+            }
+            results.append(result)
+            print_result(result)
+
+    for stream in streams:
+        stream.cancel()
+    return results
+
+COLUMNS = (
+    ('mode', 'mode', 9, ''),
+    ('endpoint', 'endpoint', 10, ''),
+    ('concurrency', 'conns', 6, ''),
+    ('streams', 'streams', 8, ''),
+    ('requests_per_second', 'req/s', 10, '.1f'),
+    ('p50_ms', 'p50 ms', 9, '.1f'),
+    ('p99_ms', 'p99 ms', 9, '.1f'),
+    ('round_trips_per_request', 'calls/req', 10, '.2f'),
+    ('peak_rss_mb', 'rss MB', 8, '.1f'),
+    ('errors', 'errors', 7, ''),
+)
+
+def print_result(result):
+    print(' '.join(f"{result[key]:>{width}{spec}}" for key, _, width, spec in COLUMNS), flush=True)
+
+def git_commit():
+    """Return the checked out commit, marked when the tree has local changes, or None outside git"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if dirty else commit
+
+def compare(results, baseline_file):
+    """Print the change of throughput, latency, round-trips and memory against a saved run"""
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    key = lambda result: (result['mode'], result['vcenter'], result['endpoint'], result['concurrency'], result['streams'])
+    previous = {key(result): result for result in baseline['results']}
+
+    print(f"\nChange against {baseline.get('commit') or baseline_file}")
+    print(f"{'mode':>9} {'endpoint':>10} {'conns':>6} {'req/s':>9} {'p50':>9} {'p99':>9} {'calls/req':>10} {'rss':>9}")
+    for result in results:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        changes = []
+        for field in ('requests_per_second', 'p50_ms', 'p99_ms', 'round_trips_per_request', 'peak_rss_mb'):
+            if before[field]:
+                changes.append(f"{(result[field] - before[field]) / before[field] * 100:+.1f}%")
+            else:
+                changes.append('n/a')
+        print(f"{result['mode']:>9} {result['endpoint']:>10} {result['concurrency']:>6} "
+              f"{changes[0]:>9} {changes[1]:>9} {changes[2]:>9} {changes[3]:>10} {changes[4]:>9}")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('fake vCenter exited')
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('fake vCenter did not start')
+
+def bench(args):
+    print(' '.join(f"{title:>{width}}" for _, title, width, _ in COLUMNS))
+    inventory = [
+        '--vms', str(args.vms), '--latency', str(args.latency), '--method-latency', args.method_latency,
+        '--powered-on', str(args.powered_on), '--with-ip', str(args.with_ip),
+        '--with-snapshots', str(args.with_snapshots), '--max-snapshots', str(args.max_snapshots),
+    ]
+    results = []
+    for mode in args.modes:
+        port = free_port()
+
+        # Each server gets a throwaway database and session store
+        data_dir = tempfile.mkdtemp(prefix='vmc-loadtest-')
+        env = dict(
+            os.environ, DB_FILE=os.path.join(data_dir, 'vm_captain.db'),
+            METRICS_DIR=os.path.join(data_dir, 'metrics'),
+            PROMETHEUS_MULTIPROC_DIR=os.path.join(data_dir, 'prometheus'),
+        )
+        directory = os.path.dirname(os.path.abspath(__file__))
+
+        vcenter = None
+        command = [sys.executable, __file__, 'serve', '--mode', mode, '--port', str(port)]
+        if args.vcenter == 'soap':
+            vcenter_port = free_port()
+            vcenter = subprocess.Popen(
+                [sys.executable, os.path.join(directory, 'fake_vcenter.py'), '--port', str(vcenter_port)] + inventory,
+                stdout=subprocess.DEVNULL
+            )
+            wait_for_port(vcenter_port, vcenter)
+            command += ['--vcenter-port', str(vcenter_port)]
+        else:
+            command += inventory
+        server = subprocess.Popen(command, env=env)
+
+        try:
+            results += asyncio.run(bench_mode(mode, port, server.pid, args))
+        finally:
+            server.terminate()
+            server.wait()
+            if vcenter is not None:
+                vcenter.terminate()
+                vcenter.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': sys.version.split()[0],
+                'settings': {name: value for name, value in vars(args).items() if name not in ('command', 'json', 'compare')},
+                'results': results,
+            }, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+def add_inventory_arguments(parser):
+    parser.add_argument('--vms', type=int, default=1000,
+                        help='Fake vCenter inventory size')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Simulated per-call vCenter latency in seconds')
+    parser.add_argument('--method-latency', default='',
+                        help='Comma separated method=seconds overrides, e.g. RetrievePropertiesEx=0.05')
+    parser.add_argument('--powered-on', type=float, default=0.7,
+                        help='Share of fake VMs powered on')
+    parser.add_argument('--with-ip', type=float, default=1.0,
+                        help='Share of powered-on fake VMs reporting a guest IP')
+    parser.add_argument('--with-snapshots', type=float, default=0.3,
+                        help='Share of fake VMs carrying a snapshot tree')
+    parser.add_argument('--max-snapshots', type=int, default=4,
+                        help='Most snapshots per tree')
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the gunicorn and ASGI servers against a fake vCenter')
+    subcommands = parser.add_subparsers(dest='command')
+
+    serve_parser = subcommands.add_parser('serve', help='Run one server (used by the load test)')
+    serve_parser.add_argument('--mode', choices=MODES, required=True)
+    serve_parser.add_argument('--port', type=int, required=True)
+    serve_parser.add_argument('--vcenter-port', type=int,
+                              help='Port of a fake vCenter SOAP server; runs one in process when not set')
+    add_inventory_arguments(serve_parser)
+
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='Comma separated servers to compare')
+    parser.add_argument('--concurrency', default='10,100,1000',
+                        help='Comma separated numbers of concurrent keep-alive connections')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='Seconds per concurrency level')
+    parser.add_argument('--streams', type=int, default=0,
+                        help='Event streams held open while measuring')
+    parser.add_argument('--endpoints', default='vms',
+                        help=f"Comma separated endpoints to measure one after the other: "
+                             f"{', '.join(ENDPOINTS)} or paths")
+    parser.add_argument('--vcenter', choices=VCENTERS, default='inprocess',
+                        help='Run the fake vCenter inside the API, or as a SOAP server reached with SmartConnect')
+    parser.add_argument('--json', help='Write the results, tagged with the git commit, to this file')
+    parser.add_argument('--compare', help='Print the change against results saved by an earlier --json run')
+    add_inventory_arguments(parser)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.mode, args.port, args)
+        return
+
+    args.modes = args.modes.split(',')
+    args.endpoints = args.endpoints.split(',')
+    args.concurrency = [int(value) for value in args.concurrency.split(',')]
+    bench(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import secrets
+import threading
+from logging.handlers import QueueHandler, QueueListener
+import instrumentation
+
+# 'text' keeps the default synchronous handlers; 'json' writes one JSON object per line from a background thread
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# Records waiting for the writer thread; more are dropped rather than blocking a request
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+# Distinct debug messages counted per request summary; later ones are only added to the total
+SUMMARY_MESSAGES = int(os.environ.get('LOG_SUMMARY_MESSAGES', 20))
+
+# Header carrying a request id from a proxy, and echoing it back
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+# Attributes every LogRecord has; anything else was passed with extra= and becomes a field
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'request_id'}
+
+request_logger = logging.getLogger('vmcaptain.request')
+
+dropped_records = instrumentation.registry.counter(
+    'vmcaptain_log_records_dropped_total', 'Log records dropped because the log queue was full'
+)
+
+# The request being served on this thread (greenlet under gevent), if any
+_local = threading.local()
+
+_listener = None
+
+class DebugTally:
+    """Occurrences of one debug message within a request; only the first is ever formatted"""
+
+    __slots__ = ('first', 'count')
+
+    def __init__(self, record):
+        self.first = record
+        self.count = 1
+
+    def summary(self):
+        return {'logger': self.first.name, 'message': self.first.getMessage(), 'count': self.count}
+
+class RequestLog:
+    """Request id and debug tallies of one request"""
+
+    __slots__ = ('request_id', 'tallies', 'debug_records')
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.tallies = {}
+        self.debug_records = 0
+
+    def tally(self, record):
+        self.debug_records += 1
+        key = (record.name, record.msg)
+        tally = self.tallies.get(key)
+        if tally is not None:
+            tally.count += 1
+        elif len(self.tallies) < SUMMARY_MESSAGES:
+            self.tallies[key] = DebugTally(record)
+
+def start_request(request_id=None):
+    """Begin a request on this thread; returns its id, taken from the client if it sent a sane one"""
+    if not request_id or len(request_id) > 128 or not request_id.isprintable():
+        request_id = secrets.token_hex(8)
+    _local.request = RequestLog(request_id)
+    return request_id
+
+def end_request(method, path, route, status, seconds):
+    """Log one summary line for the request, with its debug tallies, and end it"""
+    log = getattr(_local, 'request', None)
+    _local.request = None
+    if log is None or _listener is None:
+        return
+    extra = {
+        'request_id': log.request_id,
+        'method': method,
+        'path': path,
+        'route': route,
+        'status': status,
+        'duration_ms': round(seconds * 1000, 2),
+    }
+    if log.debug_records:
+        extra['debug_records'] = log.debug_records
+        extra['debug'] = list(log.tallies.values())
+    request_logger.info('%s %s %s %.1fms', method, path, status, seconds * 1000, extra=extra)
+
+def current_request_id():
+    log = getattr(_local, 'request', None)
+    return log.request_id if log is not None else None
+
+class BackgroundHandler(QueueHandler):
+    """Hands records to the writer thread without formatting them.
+
+    Records logged while serving a request get its id; debug records are
+    tallied into the request's summary line instead of being queued one by
+    one. Message arguments are formatted on the writer thread, so they must
+    not be mutated after logging.
+    """
+
+    def emit(self, record):
+        log = getattr(_local, 'request', None)
+        if log is not None:
+            if record.levelno <= logging.DEBUG:
+                log.tally(record)
+                return
+            record.request_id = log.request_id
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc()
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, request id and extra fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id is not None:
+            entry['request_id'] = request_id
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=json_default)
+
+def json_default(value):
+    if isinstance(value, DebugTally):
+        return value.summary()
+    return str(value)
+
+def configure(app):
+    """Route all logging through the background writer when LOG_FORMAT is json"""
+    global _listener
+    if LOG_FORMAT != 'json':
+        return
+
+    from flask.logging import default_handler
+    app.logger.removeHandler(default_handler)
+
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(JsonFormatter())
+    handler = BackgroundHandler(queue.Queue(LOG_QUEUE_SIZE))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = QueueListener(handler.queue, writer, respect_handler_level=True)
+    _listener.start()
+    os.register_at_fork(after_in_child=after_fork)
+    atexit.register(stop)
+
+def after_fork():
+    """Give a forked child its own queue and writer thread; the parent's thread does not survive the fork"""
+    global _listener
+    if _listener is None:
+        return
+    handler = next(h for h in logging.getLogger().handlers if isinstance(h, BackgroundHandler))
+    handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = QueueListener(handler.queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+def stop():
+    """Write out the queued records and stop the writer thread"""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
@@ -0,0 +1,275 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from pyVmomi import vim
+import inventory
+
+logger = logging.getLogger(__name__)
+
+# Seconds between collection cycles; vCenter realtime samples are 20s apart
+COLLECT_INTERVAL = int(os.environ.get('METRICS_INTERVAL', 20))
+
+# VMs per QueryPerf call
+BATCH_SIZE = int(os.environ.get('METRICS_BATCH_SIZE', 250))
+
+# Samples kept per VM (180 x 20s = 1 hour)
+HISTORY_SIZE = int(os.environ.get('METRICS_HISTORY_SIZE', 180))
+
+# Collection cycles kept for timing reports
+CYCLE_HISTORY = 20
+
+# Stop collecting after this many seconds without list requests
+IDLE_TIMEOUT = int(os.environ.get('METRICS_IDLE_TIMEOUT', 900))
+
+# vCenter realtime statistics interval
+REALTIME_INTERVAL = 20
+
+# Realtime counters collected per VM, keyed by the field they fill
+COUNTERS = {
+    'cpu_usage': 'cpu.usage.average',
+    'memory_usage': 'mem.usage.average',
+}
+
+EMPTY_USAGE = {'cpu_usage': 0, 'memory_usage': 0, 'disk_usage': 0}
+
+class SampleRing:
+    """Fixed-size ring buffer of (timestamp, cpu, memory, disk) samples"""
+
+    __slots__ = ('_samples', '_next', '_count')
+
+    def __init__(self, size=HISTORY_SIZE):
+        self._samples = [None] * size
+        self._next = 0
+        self._count = 0
+
+    def append(self, sample):
+        self._samples[self._next] = sample
+        self._next = (self._next + 1) % len(self._samples)
+        self._count = min(self._count + 1, len(self._samples))
+
+    def latest(self):
+        if not self._count:
+            return None
+        return self._samples[self._next - 1]
+
+    def samples(self):
+        """Return samples oldest first"""
+        size = len(self._samples)
+        start = (self._next - self._count) % size
+        return [self._samples[(start + i) % size] for i in range(self._count)]
+
+class MetricsCollector:
+    """Collects realtime VM usage from one vCenter into per-VM ring buffers"""
+
+    def __init__(self, name, service_instance, vm_ids, store=None, interval=COLLECT_INTERVAL,
+                 batch_size=BATCH_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.name = name
+        self.service_instance = service_instance
+        # Callable returning the ids of powered-on VMs to sample
+        self.vm_ids = vm_ids
+        # Optional tsdb.MetricsStore receiving every cycle for history queries.
+        # Of the workers sharing it, only its writer queries vCenter; the
+        # others take each cycle from the store.
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+
+        # Bumped after every completed cycle so callers can cache joined output
+        self.generation = 0
+        self.cycles = deque(maxlen=CYCLE_HISTORY)
+        self.last_error = None
+        self.last_access = time.time()
+
+        self._rings = {}
+        self._counter_ids = None
+        # Timestamp of the last cycle taken from the store while following
+        self._followed = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def attach(self, service_instance):
+        """Use service_instance for future cycles and make sure the worker is running"""
+        self.service_instance = service_instance
+        self.last_access = time.time()
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name=f"metrics-{self.name}", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def latest(self, vm_id):
+        """Return the latest usage fields for a VM, zeros when never sampled"""
+        ring = self._rings.get(vm_id)
+        sample = ring.latest() if ring else None
+        if sample is None:
+            return EMPTY_USAGE
+        return {'cpu_usage': sample[1], 'memory_usage': sample[2], 'disk_usage': sample[3]}
+
+    def history(self, vm_id):
+        """Return buffered samples for a VM, oldest first"""
+        ring = self._rings.get(vm_id)
+        return ring.samples() if ring else []
+
+    def status(self):
+        """Return collector configuration and recent cycle timings"""
+        return {
+            'interval': self.interval,
+            'batch_size': self.batch_size,
+            'generation': self.generation,
+            'tracked_vms': len(self._rings),
+            'writer': self.store is None or self.store.writing,
+            'last_error': self.last_error,
+            'cycles': list(self.cycles),
+        }
+
+    def _run(self):
+        while not self._stopping.is_set() and time.time() - self.last_access <= self.idle_timeout:
+            started = time.time()
+            try:
+                self.collect()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                self._counter_ids = None
+                logger.warning("Metrics collection for %s failed: %s", self.name, e)
+
+            self._stopping.wait(max(0, self.interval - (time.time() - started)))
+
+        if self.store is not None:
+            self.store.resign()
+        logger.info("Metrics collection for %s stopped", self.name)
+
+    def collect(self):
+        """Run one collection cycle, from vCenter if this process writes the store"""
+        if self.store is not None and not self.store.lead():
+            self._follow()
+            return
+
+        cycle = {'started': time.time()}
+        content = self.service_instance.RetrieveContent()
+        perf_manager = content.perfManager
+
+        if self._counter_ids is None:
+            self._counter_ids = self._resolve_counters(perf_manager)
+
+        vm_ids = list(self.vm_ids())
+
+        start = time.perf_counter()
+        usage = self._query_usage(perf_manager, vm_ids)
+        cycle['query_seconds'] = round(time.perf_counter() - start, 4)
+
+        start = time.perf_counter()
+        disk_usage = self._query_disk_usage()
+        cycle['storage_seconds'] = round(time.perf_counter() - start, 4)
+
+        now = time.time()
+        samples = {}
+        for vm_id in vm_ids:
+            cpu, memory = usage.get(vm_id, (0, 0))
+            samples[vm_id] = (cpu, memory, disk_usage.get(vm_id, 0))
+        self._record(now, samples)
+
+        if self.store is not None:
+            start = time.perf_counter()
+            self.store.append(now, samples)
+            cycle['store_seconds'] = round(time.perf_counter() - start, 4)
+
+        self.generation += 1
+        cycle['vms'] = len(vm_ids)
+        cycle['batches'] = (len(vm_ids) + self.batch_size - 1) // self.batch_size
+        cycle['duration_seconds'] = round(time.time() - cycle['started'], 4)
+        self.cycles.append(cycle)
+
+    def _follow(self):
+        """Take the newest cycle the store's writer collected, if it is new"""
+        cycle = {'started': time.time(), 'follower': True}
+        latest = self.store.latest()
+        if latest is None or latest[0] == self._followed:
+            return
+        self._followed, stored = latest
+        # Usage is collected as whole percentages; the store keeps float32
+        samples = {vm_id: tuple(round(value) for value in values) for vm_id, values in stored.items()}
+        self._record(self._followed, samples)
+
+        self.generation += 1
+        cycle['vms'] = len(samples)
+        cycle['duration_seconds'] = round(time.time() - cycle['started'], 4)
+        self.cycles.append(cycle)
+
+    def _record(self, now, samples):
+        """Append a cycle's samples {vm_id: (cpu, memory, disk)} to the rings"""
+        for vm_id, values in samples.items():
+            ring = self._rings.get(vm_id)
+            if ring is None:
+                ring = self._rings[vm_id] = SampleRing()
+            ring.append((now,) + tuple(values))
+
+        # Powered-off and removed VMs report zeros again
+        for vm_id in [vm_id for vm_id in self._rings if vm_id not in samples]:
+            del self._rings[vm_id]
+
+    def _resolve_counters(self, perf_manager):
+        """Map usage fields to counter ids using the counter catalog"""
+        names = {}
+        for counter in perf_manager.perfCounter:
+            full_name = f"{counter.groupInfo.key}.{counter.nameInfo.key}.{counter.rollupType}"
+            names[full_name] = counter.key
+
+        missing = [name for name in COUNTERS.values() if name not in names]
+        if missing:
+            raise RuntimeError(f"Performance counters not available: {', '.join(missing)}")
+
+        return {field: names[name] for field, name in COUNTERS.items()}
+
+    def _query_usage(self, perf_manager, vm_ids):
+        """Return vm_id -> (cpu %, memory %) from batched QueryPerf calls"""
+        metric_ids = [
+            vim.PerformanceManager.MetricId(counterId=counter_id, instance='')
+            for counter_id in self._counter_ids.values()
+        ]
+        fields = {counter_id: field for field, counter_id in self._counter_ids.items()}
+        stub = perf_manager._stub
+
+        usage = {}
+        for i in range(0, len(vm_ids), self.batch_size):
+            specs = [
+                vim.PerformanceManager.QuerySpec(
+                    entity=vim.VirtualMachine(vm_id, stub),
+                    metricId=metric_ids,
+                    intervalId=REALTIME_INTERVAL,
+                    maxSample=1
+                )
+                for vm_id in vm_ids[i:i + self.batch_size]
+            ]
+
+            for entity_metric in perf_manager.QueryPerf(querySpec=specs) or []:
+                values = {}
+                for series in entity_metric.value:
+                    if series.value:
+                        # Percentage counters are reported in hundredths of a percent
+                        values[fields[series.id.counterId]] = round(series.value[-1] / 100)
+                usage[entity_metric.entity._moId] = (values.get('cpu_usage', 0), values.get('memory_usage', 0))
+
+        return usage
+
+    def _query_disk_usage(self):
+        """Return vm_id -> committed share of provisioned storage in percent"""
+        disk_usage = {}
+        for vm_id, props in inventory.iter_vm_properties(self.service_instance, ['summary.storage']):
+            storage = props.get('summary.storage')
+            if storage is None:
+                continue
+            provisioned = (storage.committed or 0) + (storage.uncommitted or 0)
+            if provisioned:
+                disk_usage[vm_id] = round(storage.committed * 100 / provisioned)
+        return disk_usage
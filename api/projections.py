@@ -0,0 +1,135 @@
+import json
+import threading
+
+class View:
+    """One user's VM list: ids and shared serialized fragments, in inventory order"""
+
+    __slots__ = ('visible', 'view_id', 'ids', 'fragments', '_positions')
+
+    def __init__(self, visible, view_id, ids, fragments):
+        self.visible = visible
+        self.view_id = view_id
+        self.ids = ids
+        self.fragments = fragments
+        self._positions = None
+
+    @property
+    def positions(self):
+        """vm_id -> index in ids, built on first use by a paginated request"""
+        if self._positions is None:
+            self._positions = {vm_id: position for position, vm_id in enumerate(self.ids)}
+        return self._positions
+
+class InventoryProjections:
+    """Serialized VM lists of one vCenter, shared and projected per user.
+
+    Every VM is serialized once per inventory change and metrics cycle; a
+    user's list is the join of the fragments of the VMs they may see. A
+    vm_id -> users index drops only the views of users whose VMs changed.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+        # vm_id -> serialized list entry joined with usage, in inventory order
+        self._fragments = {}
+        # vm_id -> position in inventory order, so projections keep that order
+        self._positions = {}
+        self._next_position = 0
+        self._generation = None
+
+        # user_id (None for the unfiltered list) -> View
+        self._views = {}
+        # vm_id -> ids of users with a cached view containing it
+        self._viewers = {}
+        self._builds = 0
+
+        # VM ids changed by the inventory feed and not yet applied
+        self._dirty = set()
+        self._lock = threading.Lock()
+        cache.add_listener(self._on_change)
+
+    def close(self):
+        self.cache.remove_listener(self._on_change)
+
+    def view(self, user_id, visible, collector):
+        """Return the View of a user's VM list; visible None means every VM.
+
+        The view id changes whenever the content does, so it can serve as
+        ETag. Fragments are shared between views, never copied per user.
+        """
+        visible = frozenset(visible) if visible is not None else None
+
+        with self._lock:
+            self._refresh(collector)
+
+            cached = self._views.get(user_id)
+            if cached is not None and cached.visible == visible:
+                return cached
+
+            self._drop_view(user_id)
+            if visible is None:
+                ids = list(self._fragments)
+            else:
+                ids = sorted((vm_id for vm_id in visible if vm_id in self._fragments), key=self._positions.get)
+                for vm_id in visible:
+                    self._viewers.setdefault(vm_id, set()).add(user_id)
+
+            self._builds += 1
+            view = self._views[user_id] = View(visible, self._builds, ids, [self._fragments[vm_id] for vm_id in ids])
+            return view
+
+    def _refresh(self, collector):
+        """Bring fragments up to date with the collector generation and pending changes"""
+        if collector.generation != self._generation:
+            # New usage for every VM: reserialize everything once
+            self._generation = collector.generation
+            self._dirty.clear()
+            _, entries = self.cache.entries()
+            self._fragments = {entry['id']: self._serialize(entry, collector) for entry in entries}
+            self._positions = {vm_id: position for position, vm_id in enumerate(self._fragments)}
+            self._next_position = len(self._positions)
+            self._views.clear()
+            self._viewers.clear()
+            return
+
+        if not self._dirty:
+            return
+
+        dirty, self._dirty = self._dirty, set()
+        present = {entry['id']: entry for entry in self.cache.get_entries(dirty)}
+        for vm_id in dirty:
+            if vm_id in present:
+                self._fragments[vm_id] = self._serialize(present[vm_id], collector)
+                if vm_id not in self._positions:
+                    self._positions[vm_id] = self._next_position
+                    self._next_position += 1
+            else:
+                self._fragments.pop(vm_id, None)
+                self._positions.pop(vm_id, None)
+
+            for user_id in list(self._viewers.get(vm_id, ())):
+                self._drop_view(user_id)
+
+        # The unfiltered list contains every VM
+        self._views.pop(None, None)
+
+    def _drop_view(self, user_id):
+        cached = self._views.pop(user_id, None)
+        if cached is None or cached.visible is None:
+            return
+        for vm_id in cached.visible:
+            viewers = self._viewers.get(vm_id)
+            if viewers is not None:
+                viewers.discard(user_id)
+                if not viewers:
+                    del self._viewers[vm_id]
+
+    def _serialize(self, entry, collector):
+        return json.dumps(dict(entry, **collector.latest(entry['id']))).encode()
+
+    def _on_change(self, version, added, changed, removed):
+        with self._lock:
+            self._dirty.update(entry['id'] for entry in added)
+            self._dirty.update(entry['id'] for entry in changed)
+            self._dirty.update(removed)
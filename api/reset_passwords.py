@@ -4,6 +4,7 @@
 import sqlite3
 import os
 import sys
+from auth import hash_password
 
 def reset_passwords():
     """Reset admin and user passwords to default"""
@@ -19,11 +20,11 @@ def reset_passwords():
         cursor = conn.cursor()
         
         # Reset admin password
-        cursor.execute("UPDATE users SET password = '123456' WHERE username = 'admin'")
+        cursor.execute("UPDATE users SET password = ? WHERE username = 'admin'", (hash_password('123456'),))
         admin_count = cursor.rowcount
         
         # Reset user password
-        cursor.execute("UPDATE users SET password = '123456' WHERE username = 'user'")
+        cursor.execute("UPDATE users SET password = ? WHERE username = 'user'", (hash_password('123456'),))
         user_count = cursor.rowcount
         
         # Commit changes
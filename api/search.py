@@ -0,0 +1,357 @@
+import heapq
+import bisect
+import ipaddress
+import threading
+
+# Longest name n-grams indexed; longer search terms intersect their n-grams and are then verified
+NGRAM_SIZE = 3
+
+# Fields search results can be sorted by; prefix with '-' for descending order
+SORT_FIELDS = ('name', 'power_state', 'guest_full_name', 'ip_address')
+
+# Results per page unless the request asks otherwise
+DEFAULT_LIMIT = 100
+
+# Bit positions set in each byte value, for decoding bitmaps
+BYTE_BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256))
+
+def popcount(bits):
+    """Number of set bits; int.bit_count only exists from Python 3.10"""
+    return bin(bits).count('1')
+
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+
+def ngrams(text):
+    """Return every substring of text of length 1 to NGRAM_SIZE"""
+    return {text[start:start + size] for size in range(1, NGRAM_SIZE + 1) for start in range(len(text) - size + 1)}
+
+def ip_key(value):
+    """Return a sortable (version, integer) key for an IP address, or None if it is not one"""
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        return None
+    return address.version, int(address)
+
+def parse_network(value):
+    """Parse an address or CIDR such as 10.0.0.0/8; raises ValueError"""
+    return ipaddress.ip_network(value.strip(), strict=False)
+
+def parse_sort(value):
+    """Return (field, descending) for a sort argument such as name or -ip_address"""
+    value = (value or 'name').strip()
+    descending = value.startswith('-')
+    field = value.lstrip('-')
+    if field not in SORT_FIELDS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_FIELDS)}, optionally prefixed with -")
+    return field, descending
+
+def merge_pages(pages, field, descending, offset, limit):
+    """Merge entry lists that are each in the order SearchIndex.search returns into one page.
+
+    Every list must hold its source's first offset + limit matches.
+    """
+    entries = [entry for page in pages for entry in page]
+    name_key = lambda entry: ((entry.get('name') or '').lower(), entry['id'])
+    if field == 'name':
+        entries.sort(key=name_key, reverse=descending)
+    elif field == 'ip_address':
+        keys = {id(entry): ip_key(entry['ip_address']) if entry.get('ip_address') else None for entry in entries}
+        with_ip = sorted((entry for entry in entries if keys[id(entry)] is not None),
+                         key=lambda entry: (keys[id(entry)], entry['id']), reverse=descending)
+        without_ip = sorted((entry for entry in entries if keys[id(entry)] is None), key=name_key, reverse=descending)
+        entries = with_ip + without_ip
+    else:
+        entries.sort(key=lambda entry: (entry[field],) + name_key(entry), reverse=descending)
+    return entries[offset:offset + limit]
+
+class Record:
+    """Indexed fields of one VM"""
+
+    __slots__ = ('vm_id', 'name', 'power_state', 'guest', 'ip')
+
+    def __init__(self, entry):
+        self.vm_id = entry['id']
+        self.name = (entry.get('name') or '').lower()
+        self.power_state = entry['power_state']
+        self.guest = entry['guest_full_name']
+        self.ip = ip_key(entry['ip_address']) if entry.get('ip_address') else None
+
+class SearchIndex:
+    """In-memory search indexes over the VM list of one vCenter.
+
+    Every VM gets a slot; power states and guest OSes map to bitmaps of
+    slots, names to n-gram posting sets and a sorted name array, and IPs to
+    a sorted address array for CIDR ranges. Filters are combined as bitmaps,
+    and only the requested page is ever put in order. Fed by the inventory
+    cache's change batches: only VMs the feed reports are re-indexed.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+        # vm_id -> slot; slot -> Record or None; slots of removed VMs, reused first
+        self._slots = {}
+        self._records = []
+        self._free = []
+
+        # Sorted (lowercase name, vm_id, slot) and ((version, address), vm_id, slot)
+        self._by_name = []
+        self._by_ip = []
+        # n-gram -> slots of VMs whose lowercase name contains it
+        self._grams = {}
+        # Bitmaps of slots: every VM, VMs with an IP, and per power state and guest OS
+        self._all = 0
+        self._with_ip = 0
+        self._power = {}
+        self._guest = {}
+
+        self._loaded = False
+        # VM ids changed by the inventory feed and not yet re-indexed
+        self._dirty = set()
+        self._lock = threading.Lock()
+        cache.add_listener(self._on_change)
+
+    def close(self):
+        self.cache.remove_listener(self._on_change)
+
+    def search(self, text=None, prefix=False, power_states=None, guest=None, network=None, visible=None,
+               sort='name', descending=False, offset=0, limit=100):
+        """Return (total matches, VM ids of the requested page in sort order).
+
+        text matches names case-insensitively, as a prefix or anywhere;
+        power_states is a collection of states; guest matches guest OS names
+        case-insensitively anywhere; network is an ip_network; visible, when
+        not None, restricts matches to those VM ids.
+        """
+        with self._lock:
+            self._refresh()
+
+            bits = self._all
+            if power_states is not None:
+                bits &= self._union(self._power.get(state, 0) for state in power_states)
+            if guest:
+                guest = guest.lower()
+                bits &= self._union(bitmap for name, bitmap in self._guest.items() if guest in name.lower())
+            if network is not None and bits:
+                bits &= self._network_bits(network)
+            if visible is not None and bits:
+                bits &= self._bitmap(self._slots[vm_id] for vm_id in visible if vm_id in self._slots)
+            # Name-ordered array the page is taken from; a prefix narrows it to its matches
+            names = self._by_name
+            if text and bits:
+                if prefix:
+                    names = self._prefix_range(text.lower())
+                    bits &= self._bitmap(item[2] for item in names)
+                else:
+                    bits &= self._substring_bits(text.lower())
+
+            total = popcount(bits)
+            if not total or offset >= total:
+                return total, []
+            page = self._page(self._segments(bits, names, sort, descending), descending, offset, limit)
+            return total, [self._records[slot].vm_id for slot in page]
+
+    def _union(self, bitmaps):
+        bits = 0
+        for bitmap in bitmaps:
+            bits |= bitmap
+        return bits
+
+    def _bitmap(self, slots):
+        """Return the bitmap of an iterable of slots; one pass over a byte buffer, not one int per slot"""
+        buffer = bytearray((len(self._records) + 7) // 8)
+        for slot in slots:
+            buffer[slot >> 3] |= 1 << (slot & 7)
+        return int.from_bytes(buffer, 'little')
+
+    def _decode(self, bits):
+        """Return the slots set in a bitmap, ascending"""
+        data = bits.to_bytes((len(self._records) + 7) // 8, 'little')
+        return [position * 8 + bit for position, byte in enumerate(data) if byte for bit in BYTE_BITS[byte]]
+
+    def _prefix_range(self, text):
+        """Return the part of the sorted name array whose names start with text"""
+        start = bisect.bisect_left(self._by_name, (text,))
+        end = bisect.bisect_left(self._by_name, (text + '\U0010ffff',), start)
+        return self._by_name[start:end]
+
+    def _substring_bits(self, text):
+        grams = [text[start:start + NGRAM_SIZE] for start in range(max(1, len(text) - NGRAM_SIZE + 1))]
+        postings = sorted((self._grams.get(gram, ()) for gram in set(grams)), key=len)
+        if not postings[0]:
+            return 0
+        candidates = set(postings[0]).intersection(*postings[1:])
+        if len(text) > NGRAM_SIZE:
+            # Sharing every n-gram does not guarantee containing the whole term
+            candidates = [slot for slot in candidates if text in self._records[slot].name]
+        return self._bitmap(candidates)
+
+    def _network_bits(self, network):
+        low = (network.version, int(network.network_address))
+        high = (network.version, int(network.broadcast_address))
+        start = bisect.bisect_left(self._by_ip, (low,))
+        end = bisect.bisect_right(self._by_ip, (high, '\U0010ffff'), start)
+        return self._bitmap(item[2] for item in self._by_ip[start:end])
+
+    def _segments(self, bits, names, sort, descending):
+        """Split matches into (bitmap, sorted array, key) segments that are ordered one after another"""
+        name_key = lambda slot: (self._records[slot].name, self._records[slot].vm_id)
+        if sort == 'name':
+            return [(bits, names, name_key)]
+        if sort == 'ip_address':
+            ip_key_of = lambda slot: (self._records[slot].ip, self._records[slot].vm_id)
+            # VMs without an IP come last either way
+            return [(bits & self._with_ip, self._by_ip, ip_key_of), (bits & ~self._with_ip, names, name_key)]
+
+        groups = self._power if sort == 'power_state' else self._guest
+        return [(bits & groups[value], names, name_key) for value in sorted(groups, reverse=descending)]
+
+    def _page(self, segments, descending, offset, limit):
+        """Return the slots of matches offset to offset + limit in sort order"""
+        page = []
+        for segment_bits, ordered, key in segments:
+            count = popcount(segment_bits)
+            if offset >= count:
+                offset -= count
+                continue
+
+            wanted = min(limit - len(page), count - offset)
+            if count == len(ordered):
+                # Every entry of the sorted array matches: the page is a slice of it
+                if descending:
+                    items = ordered[len(ordered) - offset - wanted:len(ordered) - offset][::-1]
+                else:
+                    items = ordered[offset:offset + wanted]
+                page.extend(item[2] for item in items)
+            # Walking the sorted array visits about (offset + wanted) / density entries;
+            # sorting the decoded matches costs about their count. Take the cheaper one.
+            elif count < (offset + wanted) * len(ordered) / count:
+                pick = heapq.nlargest if descending else heapq.nsmallest
+                page.extend(pick(offset + wanted, self._decode(segment_bits), key=key)[offset:])
+            else:
+                page.extend(self._walk(segment_bits, reversed(ordered) if descending else ordered, offset, wanted))
+
+            offset = 0
+            if len(page) >= limit:
+                break
+        return page
+
+    def _walk(self, bits, ordered, skip, wanted):
+        data = bits.to_bytes((len(self._records) + 7) // 8, 'little')
+        slots = []
+        for item in ordered:
+            slot = item[2]
+            if data[slot >> 3] >> (slot & 7) & 1:
+                if skip:
+                    skip -= 1
+                    continue
+                slots.append(slot)
+                if len(slots) == wanted:
+                    break
+        return slots
+
+    def _refresh(self):
+        if not self._loaded:
+            self._loaded = True
+            self._dirty.clear()
+            _, entries = self.cache.entries()
+            self._rebuild(entries)
+            return
+
+        if not self._dirty:
+            return
+
+        dirty, self._dirty = self._dirty, set()
+        present = {entry['id']: entry for entry in self.cache.get_entries(dirty)}
+        for vm_id in dirty:
+            self._unindex(vm_id)
+            if vm_id in present:
+                self._index(Record(present[vm_id]))
+
+    def _rebuild(self, entries):
+        """Index a whole inventory at once: sort once and build every bitmap from a byte buffer"""
+        self._records = [Record(entry) for entry in entries]
+        self._slots = {record.vm_id: slot for slot, record in enumerate(self._records)}
+        self._free = []
+
+        self._by_name = sorted((record.name, record.vm_id, slot) for slot, record in enumerate(self._records))
+        self._by_ip = sorted(
+            (record.ip, record.vm_id, slot) for slot, record in enumerate(self._records) if record.ip is not None
+        )
+
+        grams, power, guest = {}, {}, {}
+        for slot, record in enumerate(self._records):
+            for gram in ngrams(record.name):
+                grams.setdefault(gram, set()).add(slot)
+            power.setdefault(record.power_state, []).append(slot)
+            guest.setdefault(record.guest, []).append(slot)
+
+        self._grams = grams
+        self._all = (1 << len(self._records)) - 1
+        self._with_ip = self._bitmap(item[2] for item in self._by_ip)
+        self._power = {state: self._bitmap(slots) for state, slots in power.items()}
+        self._guest = {name: self._bitmap(slots) for name, slots in guest.items()}
+
+    def _index(self, record):
+        slot = self._free.pop() if self._free else len(self._records)
+        if slot == len(self._records):
+            self._records.append(record)
+        else:
+            self._records[slot] = record
+        self._slots[record.vm_id] = slot
+
+        bit = 1 << slot
+        self._all |= bit
+        self._power[record.power_state] = self._power.get(record.power_state, 0) | bit
+        self._guest[record.guest] = self._guest.get(record.guest, 0) | bit
+        bisect.insort(self._by_name, (record.name, record.vm_id, slot))
+        if record.ip is not None:
+            self._with_ip |= bit
+            bisect.insort(self._by_ip, (record.ip, record.vm_id, slot))
+        for gram in ngrams(record.name):
+            self._grams.setdefault(gram, set()).add(slot)
+
+    def _unindex(self, vm_id):
+        slot = self._slots.pop(vm_id, None)
+        if slot is None:
+            return
+        record = self._records[slot]
+        self._records[slot] = None
+        self._free.append(slot)
+
+        mask = ~(1 << slot)
+        self._all &= mask
+        self._with_ip &= mask
+        self._drop_bit(self._power, record.power_state, mask)
+        self._drop_bit(self._guest, record.guest, mask)
+        self._remove_key(self._by_name, (record.name, record.vm_id, slot))
+        if record.ip is not None:
+            self._remove_key(self._by_ip, (record.ip, record.vm_id, slot))
+        for gram in ngrams(record.name):
+            postings = self._grams.get(gram)
+            if postings is not None:
+                postings.discard(slot)
+                if not postings:
+                    del self._grams[gram]
+
+    @staticmethod
+    def _drop_bit(groups, value, mask):
+        bits = groups.get(value, 0) & mask
+        if bits:
+            groups[value] = bits
+        else:
+            groups.pop(value, None)
+
+    @staticmethod
+    def _remove_key(index, key):
+        position = bisect.bisect_left(index, key)
+        if position < len(index) and index[position] == key:
+            del index[position]
+
+    def _on_change(self, version, added, changed, removed):
+        with self._lock:
+            self._dirty.update(entry['id'] for entry in added)
+            self._dirty.update(entry['id'] for entry in changed)
+            self._dirty.update(removed)
@@ -0,0 +1,392 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# Backend holding API sessions: 'sqlite' shares them between workers, 'memory' is per process
+SESSION_STORE = os.environ.get('SESSION_STORE', 'sqlite')
+
+# SQLite file shared by all workers, next to the user database by default
+SESSION_DB_FILE = os.environ.get(
+    'SESSION_DB_FILE',
+    os.path.join(os.path.dirname(os.environ.get('DB_FILE', '/app/data/vm_captain.db')), 'sessions.db')
+)
+
+# Session lifetime in seconds
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 86400))
+
+# Seconds between purges of expired sessions
+PURGE_INTERVAL = 300
+
+# Seconds task batches stay queryable
+BATCH_TTL = int(os.environ.get('TASK_BATCH_TTL', 86400))
+
+# Per-VM fields of a task batch item
+BATCH_ITEM_FIELDS = ('task_id', 'state', 'progress', 'error', 'result')
+
+def batch_record(batch_id, host, operation, created_at, items):
+    """Return the public representation of a task batch"""
+    counts = {}
+    for item in items:
+        counts[item['state']] = counts.get(item['state'], 0) + 1
+    return {
+        'batch_id': batch_id,
+        'host': host,
+        'operation': operation,
+        'created_at': created_at,
+        'done': all(item['state'] in ('success', 'error') for item in items),
+        'counts': counts,
+        'items': items,
+    }
+
+class MemorySessionStore:
+    """Per-process session store; only correct with a single worker"""
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._sessions = {}
+        self._connections = {}
+        self._batches = {}
+        self._federations = {}
+        self._lock = threading.Lock()
+
+    def create(self, session_id, connection_id, host, ignore_ssl):
+        now = time.time()
+        with self._lock:
+            self._sessions[session_id] = {
+                'session_id': session_id,
+                'connection_id': connection_id,
+                'host': host,
+                'ignore_ssl': bool(ignore_ssl),
+                'created_at': now,
+                'expires_at': now + self.ttl,
+            }
+
+    def get(self, session_id):
+        """Return the session record, or None if unknown or expired"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session and session['expires_at'] <= time.time():
+                del self._sessions[session_id]
+                return None
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def save_connection(self, connection_id, host, cookie):
+        with self._lock:
+            self._connections[connection_id] = cookie
+
+    def get_connection_cookie(self, connection_id):
+        with self._lock:
+            return self._connections.get(connection_id)
+
+    def touch_connection(self, connection_id, used_at):
+        # A single process has no other users of a connection to record
+        pass
+
+    def connection_last_used(self, connection_id):
+        return None
+
+    def count(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def create_batch(self, batch_id, host, operation, vm_ids):
+        now = time.time()
+        with self._lock:
+            for expired in [key for key, batch in self._batches.items() if batch['created_at'] + BATCH_TTL <= now]:
+                del self._batches[expired]
+            self._batches[batch_id] = {
+                'host': host,
+                'operation': operation,
+                'created_at': now,
+                'items': {vm_id: dict(dict.fromkeys(BATCH_ITEM_FIELDS), vm_id=vm_id, state='pending') for vm_id in vm_ids},
+            }
+
+    def update_batch_item(self, batch_id, vm_id, fields):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch:
+                batch['items'][vm_id].update((k, v) for k, v in fields.items() if k in BATCH_ITEM_FIELDS)
+
+    def get_batch(self, batch_id):
+        """Return the batch with per-VM state, or None if unknown or expired"""
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if not batch:
+                return None
+            items = [dict(item) for item in batch['items'].values()]
+            return batch_record(batch_id, batch['host'], batch['operation'], batch['created_at'], items)
+
+    def create_federation(self, federation_id, members):
+        now = time.time()
+        with self._lock:
+            self._federations[federation_id] = {
+                'federation_id': federation_id,
+                'members': [dict(member) for member in members],
+                'created_at': now,
+                'expires_at': now + self.ttl,
+            }
+
+    def get_federation(self, federation_id):
+        """Return the federation with its member sessions, or None if unknown or expired"""
+        with self._lock:
+            federation = self._federations.get(federation_id)
+            if federation and federation['expires_at'] <= time.time():
+                del self._federations[federation_id]
+                return None
+            return federation
+
+    def delete_federation(self, federation_id):
+        with self._lock:
+            return self._federations.pop(federation_id, None) is not None
+
+class SQLiteSessionStore:
+    """Session store shared by every worker through one SQLite file.
+
+    Besides the sessions it records the current vCenter session cookie of
+    each pooled connection, so a worker that did not perform the login can
+    attach to the same vCenter session. Cookies are dropped with the last
+    session using them, and the file is only readable by its owner.
+    """
+
+    def __init__(self, path=SESSION_DB_FILE, ttl=SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_purge = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # The cookies are live vCenter sessions; SQLite gives its -wal and -shm
+        # files the mode of the database file
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        for name in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(name):
+                os.chmod(name, 0o600)
+
+        conn = self._connection()
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            connection_id TEXT NOT NULL,
+            host TEXT NOT NULL,
+            ignore_ssl INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS vcenter_connections (
+            connection_id TEXT PRIMARY KEY,
+            host TEXT NOT NULL,
+            cookie TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            used_at REAL NOT NULL DEFAULT 0
+        )
+        ''')
+        if 'used_at' not in {row['name'] for row in conn.execute('PRAGMA table_info(vcenter_connections)')}:
+            conn.execute('ALTER TABLE vcenter_connections ADD COLUMN used_at REAL NOT NULL DEFAULT 0')
+        # Cookies sealed by an earlier version are not usable as they are
+        conn.execute("DELETE FROM vcenter_connections WHERE cookie LIKE 's1.%'")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS task_batches (
+            batch_id TEXT PRIMARY KEY,
+            host TEXT NOT NULL,
+            operation TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS task_batch_items (
+            batch_id TEXT NOT NULL,
+            vm_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            task_id TEXT,
+            state TEXT NOT NULL,
+            progress INTEGER,
+            error TEXT,
+            result TEXT,
+            PRIMARY KEY (batch_id, vm_id)
+        ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS federations (
+            federation_id TEXT PRIMARY KEY,
+            members TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''')
+        conn.commit()
+
+    def _connection(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            # WAL lets every worker read while one writes
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def create(self, session_id, connection_id, host, ignore_ssl):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute('''
+            INSERT INTO sessions (session_id, connection_id, host, ignore_ssl, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (session_id, connection_id, host, int(bool(ignore_ssl)), now, now + self.ttl))
+
+            if now - self._last_purge > PURGE_INTERVAL:
+                conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (now,))
+                # Cookies no session uses any more; a login's cookie is published
+                # just before its session is created, hence the grace period
+                conn.execute('''
+                DELETE FROM vcenter_connections
+                WHERE MAX(updated_at, used_at) <= ? AND connection_id NOT IN (SELECT connection_id FROM sessions)
+                ''', (now - PURGE_INTERVAL,))
+                self._last_purge = now
+
+    def get(self, session_id):
+        """Return the session record, or None if unknown or expired"""
+        row = self._connection().execute(
+            'SELECT * FROM sessions WHERE session_id = ? AND expires_at > ?',
+            (session_id, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        session = dict(row)
+        session['ignore_ssl'] = bool(session['ignore_ssl'])
+        return session
+
+    def delete(self, session_id):
+        conn = self._connection()
+        with conn:
+            return conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,)).rowcount > 0
+
+    def save_connection(self, connection_id, host, cookie):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute('''
+            INSERT INTO vcenter_connections (connection_id, host, cookie, updated_at, used_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(connection_id) DO UPDATE SET
+                cookie = excluded.cookie,
+                updated_at = excluded.updated_at,
+                used_at = MAX(used_at, excluded.used_at)
+            ''', (connection_id, host, cookie, now, now))
+
+    def get_connection_cookie(self, connection_id):
+        row = self._connection().execute(
+            'SELECT cookie FROM vcenter_connections WHERE connection_id = ?', (connection_id,)
+        ).fetchone()
+        return row['cookie'] if row else None
+
+    def touch_connection(self, connection_id, used_at):
+        """Record that a worker used the connection at used_at, keeping the latest use of any worker"""
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'UPDATE vcenter_connections SET used_at = MAX(used_at, ?) WHERE connection_id = ?',
+                (used_at, connection_id)
+            )
+
+    def connection_last_used(self, connection_id):
+        """Return when any worker last used the connection, or None if it is unknown"""
+        row = self._connection().execute(
+            'SELECT used_at FROM vcenter_connections WHERE connection_id = ?', (connection_id,)
+        ).fetchone()
+        return row['used_at'] if row else None
+
+    def count(self):
+        row = self._connection().execute(
+            'SELECT COUNT(*) AS count FROM sessions WHERE expires_at > ?', (time.time(),)
+        ).fetchone()
+        return row['count']
+
+    def create_batch(self, batch_id, host, operation, vm_ids):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            expired = 'SELECT batch_id FROM task_batches WHERE created_at <= ?'
+            conn.execute(f'DELETE FROM task_batch_items WHERE batch_id IN ({expired})', (now - BATCH_TTL,))
+            conn.execute('DELETE FROM task_batches WHERE created_at <= ?', (now - BATCH_TTL,))
+
+            conn.execute(
+                'INSERT INTO task_batches (batch_id, host, operation, created_at) VALUES (?, ?, ?, ?)',
+                (batch_id, host, operation, now)
+            )
+            conn.executemany(
+                "INSERT INTO task_batch_items (batch_id, vm_id, position, state) VALUES (?, ?, ?, 'pending')",
+                [(batch_id, vm_id, position) for position, vm_id in enumerate(vm_ids)]
+            )
+
+    def update_batch_item(self, batch_id, vm_id, fields):
+        fields = {k: v for k, v in fields.items() if k in BATCH_ITEM_FIELDS}
+        if not fields:
+            return
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                f'UPDATE task_batch_items SET {assignments} WHERE batch_id = ? AND vm_id = ?',
+                (*fields.values(), batch_id, vm_id)
+            )
+
+    def get_batch(self, batch_id):
+        """Return the batch with per-VM state, or None if unknown or expired"""
+        conn = self._connection()
+        batch = conn.execute(
+            'SELECT * FROM task_batches WHERE batch_id = ? AND created_at > ?', (batch_id, time.time() - BATCH_TTL)
+        ).fetchone()
+        if batch is None:
+            return None
+        items = [
+            {field: row[field] for field in ('vm_id',) + BATCH_ITEM_FIELDS}
+            for row in conn.execute('SELECT * FROM task_batch_items WHERE batch_id = ? ORDER BY position', (batch_id,))
+        ]
+        return batch_record(batch_id, batch['host'], batch['operation'], batch['created_at'], items)
+
+    def create_federation(self, federation_id, members):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM federations WHERE expires_at <= ?', (now,))
+            conn.execute(
+                'INSERT INTO federations (federation_id, members, created_at, expires_at) VALUES (?, ?, ?, ?)',
+                (federation_id, json.dumps(members), now, now + self.ttl)
+            )
+
+    def get_federation(self, federation_id):
+        """Return the federation with its member sessions, or None if unknown or expired"""
+        row = self._connection().execute(
+            'SELECT * FROM federations WHERE federation_id = ? AND expires_at > ?',
+            (federation_id, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        federation = dict(row)
+        federation['members'] = json.loads(federation['members'])
+        return federation
+
+    def delete_federation(self, federation_id):
+        conn = self._connection()
+        with conn:
+            return conn.execute('DELETE FROM federations WHERE federation_id = ?', (federation_id,)).rowcount > 0
+
+def create_session_store(backend=SESSION_STORE):
+    """Return the configured session store"""
+    if backend == 'memory':
+        return MemorySessionStore()
+    if backend == 'sqlite':
+        return SQLiteSessionStore()
+    raise ValueError(f"Unknown SESSION_STORE backend: {backend}")
@@ -0,0 +1,95 @@
+import os
+import threading
+import admission
+import instrumentation
+
+# Seconds a caller waits for a shared call before giving up on it
+DEFAULT_TIMEOUT = float(os.environ.get('SINGLEFLIGHT_TIMEOUT', 30))
+
+class Timeout(Exception):
+    """Raised to a caller that stopped waiting; the shared call keeps running for the others"""
+
+class Flight:
+    """One upstream call and everything waiting on it"""
+
+    __slots__ = ('done', 'value', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.waiters = 0
+
+class Group:
+    """Runs at most one call per key at a time; concurrent callers share its result.
+
+    The call runs on its own thread, so every caller, including the one that
+    started it, can time out without cutting it short for the rest. A
+    forgotten key starts a fresh call for later callers, while those already
+    waiting still get the old one's result.
+    """
+
+    def __init__(self, name, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self.counters = {'calls': 0, 'shared': 0, 'timeouts': 0, 'errors': 0}
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None):
+        """Return fn()'s result, sharing one call among concurrent callers of key.
+
+        Raises what fn raised, or Timeout once timeout seconds passed.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight()
+                self.counters['calls'] += 1
+                threading.Thread(
+                    target=self._run, args=(key, flight, admission.carry_class(instrumentation.carry_profile(fn))), name=f"singleflight-{self.name}", daemon=True
+                ).start()
+            else:
+                self.counters['shared'] += 1
+            flight.waiters += 1
+
+        try:
+            if not flight.done.wait(self.timeout if timeout is None else timeout):
+                with self._lock:
+                    self.counters['timeouts'] += 1
+                raise Timeout(f"timed out waiting for {self.name} {key}")
+        finally:
+            with self._lock:
+                flight.waiters -= 1
+
+        if flight.error is not None:
+            # Raised on the flight's thread; let this caller's request see it was refused
+            admission.note_rejection(flight.error)
+            raise flight.error
+        return flight.value
+
+    def forget(self, key):
+        """Let later callers of key start a new call instead of joining the one in flight"""
+        with self._lock:
+            self._flights.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self.counters,
+                in_flight=len(self._flights),
+                waiting=sum(flight.waiters for flight in self._flights.values())
+            )
+
+    def _run(self, key, flight, fn):
+        try:
+            flight.value = fn()
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self.counters['errors'] += 1
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
@@ -0,0 +1,253 @@
+import re
+import bisect
+import threading
+import inventory
+
+# VM properties needed to index snapshot trees and their disk usage
+SNAPSHOT_PROPERTIES = [
+    'name',
+    'snapshot',
+    'layoutEx.file',
+    'layoutEx.disk',
+    'layoutEx.snapshot',
+]
+
+# Unit suffixes accepted by parse_age (seconds) and parse_size (bytes)
+AGE_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40}
+
+# Fields of a flattened snapshot that make up the nested tree served per VM
+TREE_FIELDS = ('id', 'name', 'description', 'create_time', 'state', 'size_bytes', 'is_current')
+
+def parse_quantity(value, units):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([a-z]?)b?\s*', value.lower())
+    if not match or match.group(2) not in units:
+        raise ValueError(f"invalid value: {value}")
+    return float(match.group(1)) * units[match.group(2)]
+
+def parse_age(value):
+    """Parse an age such as 3600, 90m, 12h or 7d into seconds"""
+    return parse_quantity(value, AGE_UNITS)
+
+def parse_size(value):
+    """Parse a size such as 1048576, 512M or 10G into bytes"""
+    return int(parse_quantity(value, SIZE_UNITS))
+
+def disk_chains(disk_layouts):
+    """Return {disk key: [file keys of each chain element]}"""
+    return {
+        disk.key: [list(unit.fileKey or []) for unit in disk.chain or []]
+        for disk in disk_layouts or []
+    }
+
+def flatten_snapshots(vm_id, props):
+    """Flatten a VM's snapshot tree into records in tree order, with their disk usage.
+
+    A snapshot owns its .vmsn and .vmem files plus the delta disks written
+    after it was taken: the chain elements its children (or the running VM,
+    for the current snapshot) have beyond its own chain.
+    """
+    info = props.get('snapshot')
+    if not info or not info.rootSnapshotList:
+        return []
+
+    file_sizes = {f.key: f.size or 0 for f in props.get('layoutEx.file') or []}
+    layouts = {layout.key._moId: layout for layout in props.get('layoutEx.snapshot') or [] if layout.key}
+    current_id = info.currentSnapshot._moId if info.currentSnapshot else None
+    current_chains = disk_chains(props.get('layoutEx.disk'))
+
+    def chains(snapshot_id):
+        layout = layouts.get(snapshot_id)
+        return disk_chains(layout.disk) if layout else {}
+
+    records = []
+    # Iterative walk: deep trees must not hit the recursion limit
+    stack = [(node, None, 0) for node in reversed(info.rootSnapshotList)]
+    while stack:
+        node, parent_id, depth = stack.pop()
+        snapshot_id = node.snapshot._moId
+        children = node.childSnapshotList or []
+
+        own_chains = chains(snapshot_id)
+        successors = [chains(child.snapshot._moId) for child in children]
+        if snapshot_id == current_id:
+            successors.append(current_chains)
+
+        owned = set()
+        layout = layouts.get(snapshot_id)
+        if layout is not None:
+            owned.update(key for key in (layout.dataKey, layout.memoryKey) if key is not None and key >= 0)
+        for disk_key, chain in own_chains.items():
+            for successor in successors:
+                successor_chain = successor.get(disk_key, [])
+                if len(successor_chain) > len(chain):
+                    owned.update(successor_chain[len(chain)])
+
+        create_time = node.createTime
+        records.append({
+            'id': snapshot_id,
+            'vm_id': vm_id,
+            'vm_name': props.get('name'),
+            'name': node.name,
+            'description': node.description or '',
+            'create_time': create_time.isoformat() if create_time else None,
+            'created_at': create_time.timestamp() if create_time else 0.0,
+            'state': str(node.state) if node.state else None,
+            'quiesced': bool(node.quiesced),
+            'parent_id': parent_id,
+            'depth': depth,
+            'size_bytes': sum(file_sizes.get(key, 0) for key in owned),
+            'is_current': snapshot_id == current_id,
+        })
+
+        stack.extend((child, snapshot_id, depth + 1) for child in reversed(children))
+
+    return records
+
+def vm_snapshot_entry(vm_id, props):
+    """Inventory entry holding the flattened snapshots of one VM"""
+    return {'id': vm_id, 'snapshots': flatten_snapshots(vm_id, props)}
+
+def snapshot_tree(records):
+    """Nest flattened snapshot records of one VM back into the tree the VM detail page renders"""
+    nodes = {}
+    roots = []
+    for record in records:
+        node = {field: record[field] for field in TREE_FIELDS}
+        node['children'] = []
+        nodes[record['id']] = node
+        parent = nodes.get(record['parent_id'])
+        (parent['children'] if parent else roots).append(node)
+    return roots
+
+def create_snapshot_cache(name, service_instance):
+    """Return an inventory cache following the snapshot trees of every VM"""
+    return inventory.InventoryCache(
+        name, service_instance, path_set=SNAPSHOT_PROPERTIES, entry_factory=vm_snapshot_entry
+    )
+
+class SnapshotIndex:
+    """Flattened snapshots of every VM of one vCenter, indexed by VM, age and size.
+
+    Fed by an inventory cache following the snapshot properties of all VMs
+    through one filter, so a fleet-wide query never walks a tree or calls
+    vCenter. Only VMs changed by the feed are re-indexed.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+        # snapshot id -> record
+        self._snapshots = {}
+        # vm_id -> records in tree order, for VMs with snapshots
+        self._by_vm = {}
+        # Every VM in the inventory, with or without snapshots
+        self._known_vms = set()
+        # Sorted (created_at, snapshot id) and (size_bytes, snapshot id)
+        self._by_age = []
+        self._by_size = []
+
+        self._loaded = False
+        # VM ids changed by the inventory feed and not yet re-indexed
+        self._dirty = set()
+        self._lock = threading.Lock()
+        cache.add_listener(self._on_change)
+
+    def close(self):
+        self.cache.remove_listener(self._on_change)
+
+    def vm_snapshots(self, vm_id):
+        """Return the flattened snapshots of a VM, or None if the VM is unknown"""
+        with self._lock:
+            self._refresh()
+            records = self._by_vm.get(vm_id)
+            if records is None and vm_id not in self._known_vms:
+                return None
+            return list(records or [])
+
+    def get(self, snapshot_id):
+        with self._lock:
+            self._refresh()
+            return self._snapshots.get(snapshot_id)
+
+    def query(self, created_before=None, min_size=None, vm_ids=None):
+        """Return snapshots created before an epoch time and at least min_size bytes, oldest first.
+
+        vm_ids, when given, restricts the result to those VMs.
+        """
+        with self._lock:
+            self._refresh()
+
+            candidates = None
+            if created_before is not None:
+                end = bisect.bisect_left(self._by_age, (created_before,))
+                candidates = [snapshot_id for _, snapshot_id in self._by_age[:end]]
+            if min_size is not None:
+                start = bisect.bisect_left(self._by_size, (min_size,))
+                if candidates is None or len(self._by_size) - start < len(candidates):
+                    # Scan the narrower index; the other condition is checked per record
+                    candidates = [snapshot_id for _, snapshot_id in self._by_size[start:]]
+            if candidates is None:
+                candidates = [snapshot_id for _, snapshot_id in self._by_age]
+
+            results = []
+            for snapshot_id in candidates:
+                record = self._snapshots[snapshot_id]
+                if created_before is not None and record['created_at'] >= created_before:
+                    continue
+                if min_size is not None and record['size_bytes'] < min_size:
+                    continue
+                if vm_ids is not None and record['vm_id'] not in vm_ids:
+                    continue
+                results.append(record)
+
+        results.sort(key=lambda record: record['created_at'])
+        return results
+
+    def _refresh(self):
+        if not self._loaded:
+            self._loaded = True
+            self._dirty.clear()
+            _, entries = self.cache.entries()
+            for entry in entries:
+                self._index_vm(entry['id'], entry['snapshots'])
+            return
+
+        if not self._dirty:
+            return
+
+        dirty, self._dirty = self._dirty, set()
+        present = {entry['id']: entry for entry in self.cache.get_entries(dirty)}
+        for vm_id in dirty:
+            self._unindex_vm(vm_id)
+            if vm_id in present:
+                self._index_vm(vm_id, present[vm_id]['snapshots'])
+
+    def _index_vm(self, vm_id, records):
+        self._known_vms.add(vm_id)
+        if not records:
+            return
+        self._by_vm[vm_id] = records
+        for record in records:
+            self._snapshots[record['id']] = record
+            bisect.insort(self._by_age, (record['created_at'], record['id']))
+            bisect.insort(self._by_size, (record['size_bytes'], record['id']))
+
+    def _unindex_vm(self, vm_id):
+        self._known_vms.discard(vm_id)
+        for record in self._by_vm.pop(vm_id, []):
+            del self._snapshots[record['id']]
+            self._remove_key(self._by_age, (record['created_at'], record['id']))
+            self._remove_key(self._by_size, (record['size_bytes'], record['id']))
+
+    @staticmethod
+    def _remove_key(index, key):
+        position = bisect.bisect_left(index, key)
+        if position < len(index) and index[position] == key:
+            del index[position]
+
+    def _on_change(self, version, added, changed, removed):
+        with self._lock:
+            self._dirty.update(entry['id'] for entry in added)
+            self._dirty.update(entry['id'] for entry in changed)
+            self._dirty.update(removed)
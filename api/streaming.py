@@ -0,0 +1,124 @@
+import os
+import json
+import zlib
+import base64
+
+try:
+    import zstandard
+except ImportError:  # optional; gzip is always available
+    zstandard = None
+
+# Serialized bytes gathered before a chunk is written to the client
+CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 64 * 1024))
+
+# VMs serialized at a time when a field selection is requested
+FIELDS_BATCH_SIZE = 500
+
+# Largest page a client may request with limit
+MAX_PAGE_SIZE = int(os.environ.get('VM_LIST_MAX_PAGE_SIZE', 10000))
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonl', 'application/ndjson')
+
+def negotiate_format(accept_mimetypes):
+    """Return 'ndjson' if the client prefers newline-delimited JSON, else 'json'"""
+    best = accept_mimetypes.best_match(('application/json',) + NDJSON_TYPES, default='application/json')
+    return 'ndjson' if best in NDJSON_TYPES else 'json'
+
+def negotiate_encoding(accept_encodings):
+    """Return 'zstd', 'gzip' or None for a request's Accept-Encoding"""
+    if zstandard is not None and accept_encodings['zstd']:
+        return 'zstd'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def encode_cursor(vm_id, position):
+    """Return an opaque cursor resuming after vm_id at position"""
+    raw = json.dumps([vm_id, position], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Return (vm_id, position) from a cursor; raises ValueError if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        vm_id, position = json.loads(raw)
+    except Exception:
+        raise ValueError('invalid cursor')
+    if not isinstance(vm_id, str) or not isinstance(position, int) or position < 0:
+        raise ValueError('invalid cursor')
+    return vm_id, position
+
+def page_bounds(ids, positions, cursor, limit):
+    """Return (start, end) of the page after cursor within ids.
+
+    The cursor's VM is looked up by id so pages stay contiguous while VMs
+    come and go; if it vanished, its old position is used instead.
+    """
+    start = 0
+    if cursor is not None:
+        vm_id, position = cursor
+        start = positions[vm_id] + 1 if vm_id in positions else min(position, len(ids))
+    end = len(ids) if limit is None else min(len(ids), start + limit)
+    return start, end
+
+def parse_fields(value):
+    """Return the tuple of requested fields, or None for all of them"""
+    if not value:
+        return None
+    fields = tuple(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    return fields or None
+
+def select_fragments(entries, fields):
+    """Serialize only the requested fields of full list entries"""
+    for entry in entries:
+        yield json.dumps({field: entry[field] for field in fields if field in entry}).encode()
+
+def frame(fragments, fmt):
+    """Yield the pieces of a JSON array or of NDJSON lines around serialized fragments"""
+    if fmt == 'ndjson':
+        for fragment in fragments:
+            yield fragment
+            yield b'\n'
+        return
+
+    yield b'['
+    first = True
+    for fragment in fragments:
+        if not first:
+            yield b', '
+        first = False
+        yield fragment
+    yield b']'
+
+def chunked(pieces, size=CHUNK_SIZE):
+    """Group small byte pieces into chunks of about size bytes"""
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield b''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield b''.join(buffer)
+
+def compressed(chunks, encoding):
+    """Compress a chunk stream, flushing after every chunk so the client can decode as it arrives"""
+    if encoding is None:
+        yield from chunks
+        return
+
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        flush_mode = zlib.Z_SYNC_FLUSH
+
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(flush_mode)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,308 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pyVmomi import vim, vmodl, VmomiSupport
+import admission
+import inventory
+
+logger = logging.getLogger(__name__)
+
+# Task.info properties followed for every tracked task
+TASK_PROPERTIES = ['info.state', 'info.progress', 'info.error', 'info.result']
+
+# Tasks a batch keeps in flight at once unless the request asks otherwise
+BATCH_PARALLELISM = int(os.environ.get('TASK_BATCH_PARALLELISM', 16))
+
+# Upper bound for a requested batch parallelism
+MAX_BATCH_PARALLELISM = int(os.environ.get('TASK_MAX_BATCH_PARALLELISM', 64))
+
+# How long a single WaitForUpdatesEx call may block in vCenter
+WAIT_SECONDS = 10
+
+# Seconds finished task states stay queryable
+TASK_RETENTION = 3600
+
+# Seconds a batch waits for one of its tasks before giving up its slot
+TASK_TIMEOUT = int(os.environ.get('TASK_TIMEOUT', 3600))
+
+FINISHED_STATES = ('success', 'error')
+
+def fault_message(error):
+    """Return a readable message for a LocalizedMethodFault or exception"""
+    if isinstance(error, vmodl.LocalizedMethodFault):
+        return error.localizedMessage or (error.fault and error.fault.msg) or type(error.fault).__name__
+    return getattr(error, 'msg', None) or str(error) or type(error).__name__
+
+def task_result(result):
+    """Return a JSON-friendly Task.info.result"""
+    if result is None:
+        return None
+    if isinstance(result, VmomiSupport.ManagedObject):
+        return result._moId
+    return str(result)
+
+class TaskTracker:
+    """Follows the Task.info of many vCenter tasks through one PropertyCollector filter.
+
+    Tracked tasks are added to a ListView; a single filter over that view
+    reports every state change, so no task is polled on its own.
+    """
+
+    def __init__(self, name, service_instance, wait_seconds=WAIT_SECONDS):
+        self.name = name
+        self.service_instance = service_instance
+        self.wait_seconds = wait_seconds
+        self.last_error = None
+
+        # task id -> {'task_id', 'state', 'progress', 'error', 'result', 'finished_at'}
+        self._tasks = {}
+        # task id -> callables invoked as callback(task_id, state) on every change
+        self._callbacks = {}
+        # Tasks created but not yet added to the view
+        self._pending = []
+        self._view = None
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # Held while the view is created, modified or destroyed
+        self._view_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def attach(self, service_instance):
+        """Use service_instance for future (re)connects"""
+        self.service_instance = service_instance
+
+    def stop(self):
+        self._stopping.set()
+
+    def track(self, tasks, callback=None):
+        """Start following tasks; callback(task_id, state) runs on every change"""
+        with self._lock:
+            for task in tasks:
+                self._tasks.setdefault(task._moId, {
+                    'task_id': task._moId,
+                    'state': 'queued',
+                    'progress': None,
+                    'error': None,
+                    'result': None,
+                    'finished_at': None,
+                })
+                if callback:
+                    self._callbacks.setdefault(task._moId, []).append(callback)
+            self._pending.extend(tasks)
+
+        self._flush_pending()
+        self._ensure_running()
+
+    def get(self, task_id):
+        """Return a copy of a task's last known state, or None if it is not tracked"""
+        with self._lock:
+            state = self._tasks.get(task_id)
+            return dict(state) if state else None
+
+    def wait(self, task_id, timeout=None):
+        """Block until a task finishes; returns its state, or None on timeout"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._changed:
+            while True:
+                state = self._tasks.get(task_id)
+                if state is None or state['state'] in FINISHED_STATES:
+                    return dict(state) if state else None
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+
+    def _flush_pending(self):
+        """Add pending tasks to the view, batching concurrent callers into one call"""
+        while True:
+            if not self._view_lock.acquire(blocking=False):
+                # The holder picks up our tasks before it lets go
+                return
+            try:
+                with self._lock:
+                    batch, self._pending = self._pending, []
+                if batch and self._view is not None:
+                    self._view.ModifyListView(add=batch)
+            except Exception as e:
+                # The feed fails too and re-adds every unfinished task when it restarts
+                logger.warning("Adding tasks to the %s task view failed: %s", self.name, e)
+            finally:
+                self._view_lock.release()
+
+            with self._lock:
+                if not self._pending:
+                    return
+
+    def _ensure_running(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name=f"tasks-{self.name}", daemon=True
+                )
+                self._thread.start()
+
+    def _unfinished(self):
+        return [task_id for task_id, state in self._tasks.items() if state['state'] not in FINISHED_STATES]
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self._follow_updates()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                logger.warning("Task feed for %s failed, restarting: %s", self.name, e)
+                self._stopping.wait(inventory.RETRY_DELAY)
+
+            with self._lock:
+                if not self._unfinished():
+                    # Next track() starts a new feed
+                    self._thread = None
+                    return
+
+    def _follow_updates(self):
+        """Follow tracked tasks until none is left unfinished"""
+        content = self.service_instance.RetrieveContent()
+        stub = content.propertyCollector._stub
+        collector = content.propertyCollector.CreatePropertyCollector()
+
+        with self._view_lock:
+            with self._lock:
+                unfinished = self._unfinished()
+                # Tasks tracked from here on stay pending until the view exists
+                created_with = set(unfinished)
+                self._pending = [task for task in self._pending if task._moId not in created_with]
+            self._view = content.viewManager.CreateListView(obj=[vim.Task(task_id, stub) for task_id in unfinished])
+        # track() calls that found the view lock taken left their tasks to us
+        self._flush_pending()
+
+        try:
+            filter_spec = inventory.build_view_filter_spec(self._view, vim.Task, TASK_PROPERTIES)
+            collector.CreateFilter(filter_spec, partialUpdates=True)
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.wait_seconds)
+
+            version = ''
+            while not self._stopping.is_set():
+                update_set = collector.WaitForUpdatesEx(version, options)
+                if update_set is not None:
+                    version = update_set.version
+                    finished = self._apply(update_set)
+                    if finished:
+                        # Finished tasks never change again; keep the view small
+                        with self._view_lock:
+                            self._view.ModifyListView(remove=[vim.Task(task_id, stub) for task_id in finished])
+                        # Tasks tracked while we held the view are still pending
+                        self._flush_pending()
+
+                with self._lock:
+                    self._expire()
+                    if not self._unfinished() and not self._pending:
+                        return
+        finally:
+            with self._view_lock:
+                view, self._view = self._view, None
+            try:
+                collector.Destroy()
+                view.Destroy()
+            except Exception:
+                pass
+
+    def _apply(self, update_set):
+        """Apply one UpdateSet; returns ids of tasks that finished"""
+        changed, finished = [], []
+
+        with self._lock:
+            for filter_update in update_set.filterSet or []:
+                for obj_update in filter_update.objectSet or []:
+                    state = self._tasks.get(obj_update.obj._moId)
+                    if state is None or obj_update.kind == 'leave':
+                        continue
+
+                    for change in obj_update.changeSet or []:
+                        field = change.name.split('.', 1)[1]
+                        value = None if change.op in ('remove', 'indirectRemove') else change.val
+                        if field == 'error':
+                            value = fault_message(value) if value is not None else None
+                        elif field == 'result':
+                            value = task_result(value)
+                        elif field == 'state' and value is not None:
+                            value = str(value)
+                        state[field] = value
+
+                    if state['state'] in FINISHED_STATES and state['finished_at'] is None:
+                        state['finished_at'] = time.time()
+                        finished.append(state['task_id'])
+                    changed.append((state['task_id'], dict(state)))
+
+            self._changed.notify_all()
+
+        for task_id, state in changed:
+            for callback in self._callbacks.get(task_id, ()):
+                try:
+                    callback(task_id, state)
+                except Exception as e:
+                    logger.error("Task callback for %s failed: %s", task_id, e)
+            if task_id in finished:
+                self._callbacks.pop(task_id, None)
+
+        return finished
+
+    def _expire(self):
+        cutoff = time.time() - TASK_RETENTION
+        for task_id in [task_id for task_id, state in self._tasks.items()
+                        if state['finished_at'] is not None and state['finished_at'] < cutoff]:
+            del self._tasks[task_id]
+
+def new_batch_id():
+    return f"batch-{uuid.uuid4().hex[:12]}"
+
+def run_batch(tracker, vm_ids, start_task, on_update, parallelism=BATCH_PARALLELISM):
+    """Run start_task(vm_id) for every VM in the background, with at most parallelism VMs in flight.
+
+    start_task returns a Task, or a list of callables each starting one Task
+    for VMs that need several tasks in sequence; a step starts only after
+    the previous one succeeded. on_update(vm_id, fields) receives every
+    state change of a VM's item. Returns immediately.
+    """
+    def follow(vm_id, task, last):
+        on_update(vm_id, {'state': 'queued', 'task_id': task._moId, 'progress': None, 'result': None})
+
+        def on_change(task_id, state):
+            # The item only succeeds with its last step
+            finished = 'running' if state['state'] == 'success' and not last else state['state']
+            on_update(vm_id, {
+                'state': finished,
+                'progress': state['progress'],
+                'error': state['error'],
+                'result': state['result'],
+            })
+
+        tracker.track([task], on_change)
+        # Holding the slot until the task finishes caps concurrent vCenter tasks
+        state = tracker.wait(task._moId, TASK_TIMEOUT)
+        return state is not None and state['state'] == 'success'
+
+    def run(vm_id):
+        # Batch threads queue behind interactive calls under admission control
+        admission.set_class('bulk')
+        try:
+            started = start_task(vm_id)
+            if isinstance(started, vim.Task):
+                follow(vm_id, started, True)
+                return
+            for position, step in enumerate(started):
+                if not follow(vm_id, step(), position == len(started) - 1):
+                    return
+        except Exception as e:
+            on_update(vm_id, {'state': 'error', 'error': fault_message(e)})
+
+    executor = ThreadPoolExecutor(max(1, min(parallelism, len(vm_ids))), thread_name_prefix=f"batch-{tracker.name}")
+    for vm_id in vm_ids:
+        executor.submit(run, vm_id)
+    executor.shutdown(wait=False)
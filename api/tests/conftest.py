@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+import tempfile
+import pytest
+
+# Everything the API writes (users, sessions, metrics, checkpoints) goes to a
+# scratch directory; must be set before the API modules are imported
+DATA_DIR = tempfile.mkdtemp(prefix='vmc-tests-')
+os.environ['DB_FILE'] = os.path.join(DATA_DIR, 'vm_captain.db')
+os.environ['SESSION_STORE'] = 'memory'
+os.environ['PASSWORD_HASH_ITERATIONS'] = '1000'
+os.environ['INVENTORY_CHECKPOINT_INTERVAL'] = '0'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_vcenter import FakeVCenter
+
+def wait_for(predicate, timeout=5.0):
+    """Poll predicate until it returns something truthy; fails the test on timeout"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.02)
+    pytest.fail('timed out waiting for condition')
+
+@pytest.fixture
+def fake():
+    return FakeVCenter(vm_count=20, task_duration=0.1)
+
+@pytest.fixture
+def service_instance(fake):
+    return fake.connect()
@@ -0,0 +1,61 @@
+import threading
+import pytest
+import auth
+import db_models
+from conftest import wait_for
+
+HASHING = (auth.verify_password, auth.hash_password, auth.waste_password_check)
+
+@pytest.fixture
+def hashed_on():
+    """run_hash recording which functions it ran"""
+    calls = []
+
+    def run_hash(fn, *args):
+        calls.append(fn)
+        return fn(*args)
+    run_hash.calls = calls
+    return run_hash
+
+def test_login_hands_only_hashing_to_the_pool(hashed_on):
+    user = db_models.get_user_by_credentials('admin', '123456', hashed_on)
+    assert user['id'] == 'admin-1'
+    assert hashed_on.calls and all(fn in HASHING for fn in hashed_on.calls)
+
+def test_wrong_password_and_unknown_user(hashed_on):
+    assert db_models.get_user_by_credentials('admin', 'wrong', hashed_on) is None
+    assert db_models.get_user_by_credentials('nobody', '123456', hashed_on) is None
+    assert hashed_on.calls[-1] is auth.waste_password_check
+
+def test_outdated_hash_is_upgraded(hashed_on):
+    with db_models.db_connection() as conn:
+        conn.execute('UPDATE users SET password = ? WHERE id = ?', (auth.hash_password('123456', 10), 'user-1'))
+
+    assert db_models.get_user_by_credentials('user', '123456', hashed_on)['id'] == 'user-1'
+    assert auth.hash_password in hashed_on.calls
+    stored = db_models.get_user_by_id('user-1')['password']
+    assert stored.split('$')[1] == str(auth.PASSWORD_HASH_ITERATIONS)
+
+def test_login_pool_rejects_beyond_its_queue():
+    pool = auth.LoginPool(workers=1, queue_size=1)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    threads = [threading.Thread(target=pool.run, args=(block,)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    # One running, one queued
+    wait_for(lambda: pool._slots._value == 0)
+    try:
+        with pytest.raises(auth.Busy):
+            pool.run(block)
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+    assert pool.run(lambda: 'free again') == 'free again'
@@ -0,0 +1,116 @@
+import pytest
+import app as api
+import db_models
+from conftest import FakeVCenter, wait_for
+
+# VMs assigned to the USER account on the connected vCenter
+ASSIGNED = ['vm-1', 'vm-2']
+
+@pytest.fixture(scope='module')
+def fake():
+    return FakeVCenter(vm_count=10, task_duration=0.05, snapshot_ratio=1.0)
+
+@pytest.fixture(scope='module')
+def client(fake):
+    pool = api.vcenter_pool
+    original = pool.connect, pool.attach
+    pool.connect, pool.attach = fake.connect, fake.attach
+    yield api.app.test_client()
+    pool.connect, pool.attach = original
+
+def login(client, username):
+    response = client.post('/api/auth/login', json={'username': username, 'password': '123456'})
+    assert response.status_code == 200
+    return response.get_json()['token']
+
+@pytest.fixture(scope='module')
+def admin_token(client):
+    return login(client, 'admin')
+
+@pytest.fixture(scope='module')
+def session(client, admin_token):
+    response = client.post('/vcenter/connect', json={'url': 'https://vc1', 'username': 'u', 'password': 'p'},
+                           headers={'X-User-Token': admin_token})
+    assert response.status_code == 200
+    session_id = response.get_json()['session_id']
+    return session_id, api.get_session(session_id)['host']
+
+@pytest.fixture(scope='module')
+def user_token(client, admin_token, session):
+    _, host = session
+    response = client.put('/api/users/user-1/vms', json={'vm_ids': ASSIGNED, 'vcenter': host},
+                          headers={'Authorization': f'Bearer {admin_token}'})
+    assert response.status_code == 200
+    # The same moref on another vCenter grants nothing here
+    response = client.put('/api/users/user-1/vms/vm-3?vcenter=other.example.com',
+                          headers={'Authorization': f'Bearer {admin_token}'})
+    assert response.status_code == 200
+    return login(client, 'user')
+
+def headers(session, token):
+    return {'Authorization': f'Bearer {session[0]}', 'X-User-Token': token}
+
+def vm_ids(entries):
+    return sorted(entry['id'] for entry in entries)
+
+def test_vcenter_routes_require_a_user_token(client, session):
+    assert client.get('/vcenter/vms', headers={'Authorization': f'Bearer {session[0]}'}).status_code == 401
+    assert client.get('/vcenter/vms', headers=headers(session, 'not-a-token')).status_code == 401
+
+def test_admin_sees_every_vm(client, fake, session, admin_token):
+    response = client.get('/vcenter/vms', headers=headers(session, admin_token))
+    assert response.status_code == 200
+    assert vm_ids(response.get_json()) == sorted(fake.vms)
+
+def test_user_sees_only_assigned_vms(client, session, user_token):
+    response = client.get('/vcenter/vms', headers=headers(session, user_token))
+    assert vm_ids(response.get_json()) == ASSIGNED
+
+    response = client.get('/vcenter/vms/search', headers=headers(session, user_token))
+    assert vm_ids(response.get_json()) == ASSIGNED
+    assert response.headers['X-Total-Count'] == str(len(ASSIGNED))
+
+def test_user_cannot_read_or_act_on_other_vms(client, session, user_token):
+    assert client.get('/vcenter/vms/vm-3', headers=headers(session, user_token)).status_code == 403
+    assert client.post('/vcenter/vms/vm-3/power/stop', headers=headers(session, user_token)).status_code == 403
+    response = client.post('/vcenter/vms/power', json={'vm_ids': ['vm-1', 'vm-3'], 'operation': 'stop'},
+                           headers=headers(session, user_token))
+    assert response.status_code == 403
+
+def test_user_can_act_on_assigned_vms(client, fake, session, user_token):
+    fake.vms['vm-1']['runtime.powerState'] = 'poweredOff'
+    response = client.post('/vcenter/vms/vm-1/power/start', headers=headers(session, user_token))
+    assert response.status_code == 200
+    assert fake.vms['vm-1']['runtime.powerState'] == 'poweredOn'
+
+def test_changes_are_filtered(client, fake, session, admin_token, user_token):
+    cache = api.inventory_caches[session[1]]
+    since = cache.version
+    added = fake.add_vm()
+    fake.set_vm_property('vm-2', 'name', 'renamed-2')
+    fake.set_vm_property('vm-4', 'name', 'renamed-4')
+    wait_for(lambda: len(cache.changes_since(since)['changed']) == 2)
+
+    changes = client.get(f'/vcenter/vms/changes?since={since}', headers=headers(session, admin_token)).get_json()
+    assert vm_ids(changes['added']) == [added]
+    assert vm_ids(changes['changed']) == ['vm-2', 'vm-4']
+
+    changes = client.get(f'/vcenter/vms/changes?since={since}', headers=headers(session, user_token)).get_json()
+    assert changes['added'] == []
+    assert vm_ids(changes['changed']) == ['vm-2']
+
+def test_snapshot_queries_are_filtered(client, session, user_token):
+    response = client.get('/vcenter/snapshots', headers=headers(session, user_token))
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['count'] == len(body['snapshots'])
+    assert {record['vm_id'] for record in body['snapshots']} == set(ASSIGNED)
+
+def test_assignments_are_per_vcenter(session):
+    assert db_models.get_assigned_vm_ids('user-1', session[1]) == set(ASSIGNED)
+    assert db_models.get_assigned_vm_ids('user-1', 'other.example.com') == {'vm-3'}
+
+def test_users_cannot_manage_users(client, user_token):
+    assert client.get('/api/users', headers={'Authorization': f'Bearer {user_token}'}).status_code == 403
+    response = client.put('/api/users/user-1/vms/vm-5', headers={'Authorization': f'Bearer {user_token}'})
+    assert response.status_code == 403
@@ -0,0 +1,39 @@
+import threading
+import pytest
+from pyVmomi import vmodl
+import connection_pool
+from conftest import FakeVCenter, wait_for
+
+@pytest.fixture
+def fake():
+    # Each long poll waits a second in vCenter
+    return FakeVCenter(vm_count=2, method_latency={'WaitForUpdatesEx': 1.0})
+
+@pytest.fixture
+def pool(fake):
+    pool = connection_pool.ConnectionPool(b'k' * 32, connect=fake.connect, attach=fake.attach, max_calls=2)
+    yield pool
+    pool.close_all()
+
+def test_long_polls_take_no_call_slot(fake, pool):
+    connection = pool.acquire('vc', 'user', 'password')
+    content = connection.service_instance.RetrieveContent()
+    collectors = [content.propertyCollector.CreatePropertyCollector() for _ in range(3)]
+    options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=1)
+
+    # More long polls than the connection has call slots, all waiting in vCenter
+    polls = [threading.Thread(target=collector.WaitForUpdatesEx, args=('', options)) for collector in collectors]
+    for poll in polls:
+        poll.start()
+    try:
+        wait_for(lambda: fake.calls['WaitForUpdatesEx'] == len(polls))
+        connection.service_instance.CurrentTime()
+        assert pool.counters['waits'] == 0
+        assert connection.semaphore._value == 2
+        assert connection.admission.stats()['in_flight'] == 0
+    finally:
+        for poll in polls:
+            poll.join()
+
+    # Only the short calls fed the admission limit's latency
+    assert connection.admission.latency < 0.5
@@ -0,0 +1,49 @@
+import pytest
+import inventory
+from conftest import wait_for
+
+@pytest.fixture
+def cache(service_instance):
+    cache = inventory.InventoryCache('vc', service_instance, wait_seconds=1)
+    cache.attach(service_instance)
+    assert cache.wait_ready(5)
+    yield cache
+    cache.stop()
+
+def ids(entries):
+    return sorted(entry['id'] for entry in entries)
+
+def test_changes_since_current_version_is_empty(cache):
+    changes = cache.changes_since(cache.version, cache.epoch)
+    assert changes == {'version': cache.version, 'epoch': cache.epoch, 'added': [], 'changed': [], 'removed': []}
+
+def test_changes_since_separates_added_changed_and_removed(fake, cache):
+    since = cache.version
+    new_vm = fake.add_vm()
+    fake.set_vm_property('vm-1', 'name', 'renamed')
+    fake.remove_vm('vm-2')
+    wait_for(lambda: not cache.get_entries(['vm-2']))
+
+    changes = cache.changes_since(since)
+    assert ids(changes['added']) == [new_vm]
+    assert ids(changes['changed']) == ['vm-1']
+    assert changes['changed'][0]['name'] == 'renamed'
+    assert changes['removed'] == ['vm-2']
+
+def test_vm_changed_after_it_was_added_stays_added_for_older_versions(fake, cache):
+    since = cache.version
+    new_vm = fake.add_vm()
+    wait_for(lambda: cache.get_entries([new_vm]))
+    added_at = cache.version
+
+    fake.set_vm_property(new_vm, 'name', 'renamed')
+    wait_for(lambda: cache.version > added_at)
+
+    assert ids(cache.changes_since(since)['added']) == [new_vm]
+    changes = cache.changes_since(added_at)
+    assert changes['added'] == []
+    assert ids(changes['changed']) == [new_vm]
+
+def test_changes_since_needs_a_full_resync_it_cannot_answer(cache):
+    assert cache.changes_since(cache.version, 'another-epoch') is None
+    assert cache.changes_since(cache.version + 1) is None
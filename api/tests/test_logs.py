@@ -0,0 +1,94 @@
+import queue
+import logging
+import pytest
+import app as api
+import logs
+
+@pytest.fixture
+def request_log():
+    request_id = logs.start_request('req-1')
+    yield request_id
+    logs._local.request = None
+
+def record(level, msg, *args, name='vmcaptain.test'):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+def dropped():
+    return logs.dropped_records.values().get((), 0)
+
+def test_request_id_is_echoed():
+    response = api.app.test_client().get('/health', headers={logs.REQUEST_ID_HEADER: 'abc-123'})
+    assert response.headers[logs.REQUEST_ID_HEADER] == 'abc-123'
+
+def test_request_id_is_generated_without_one():
+    response = api.app.test_client().get('/health')
+    assert len(response.headers[logs.REQUEST_ID_HEADER]) == 16
+
+@pytest.mark.parametrize('client_id', ['', 'x' * 129, 'bad\nid', 'tab\tid'])
+def test_bad_client_ids_are_replaced(client_id):
+    request_id = logs.start_request(client_id)
+    logs._local.request = None
+    assert request_id != client_id
+    assert len(request_id) == 16 and request_id.isalnum()
+
+def test_debug_records_are_tallied_not_queued(request_log):
+    handler = logs.BackgroundHandler(queue.Queue())
+    for i in range(3):
+        handler.emit(record(logging.DEBUG, 'fetched %s', i))
+    handler.emit(record(logging.DEBUG, 'other'))
+    handler.emit(record(logging.WARNING, 'slow call'))
+
+    queued = handler.queue.get_nowait()
+    assert queued.getMessage() == 'slow call'
+    assert queued.request_id == request_log
+    assert handler.queue.empty()
+
+    log = logs._local.request
+    assert log.debug_records == 4
+    assert [tally.summary() for tally in log.tallies.values()] == [
+        {'logger': 'vmcaptain.test', 'message': 'fetched 0', 'count': 3},
+        {'logger': 'vmcaptain.test', 'message': 'other', 'count': 1},
+    ]
+
+def test_tallies_are_capped(request_log, monkeypatch):
+    monkeypatch.setattr(logs, 'SUMMARY_MESSAGES', 2)
+    handler = logs.BackgroundHandler(queue.Queue())
+    for i in range(5):
+        handler.emit(record(logging.DEBUG, f'message {i}'))
+
+    log = logs._local.request
+    assert log.debug_records == 5
+    assert len(log.tallies) == 2
+
+def test_summary_line_carries_the_tallies(request_log, monkeypatch, caplog):
+    monkeypatch.setattr(logs, '_listener', object())
+    logs._local.request.tally(record(logging.DEBUG, 'fetched'))
+
+    with caplog.at_level(logging.INFO, logger='vmcaptain.request'):
+        logs.end_request('GET', '/vcenter/vms', '/vcenter/vms', 200, 0.0125)
+
+    summary = caplog.records[-1]
+    assert summary.request_id == request_log
+    assert summary.status == 200
+    assert summary.duration_ms == 12.5
+    assert summary.debug_records == 1
+    assert logs.current_request_id() is None
+
+def test_full_queue_drops_and_counts():
+    handler = logs.BackgroundHandler(queue.Queue(1))
+    before = dropped()
+    handler.emit(record(logging.INFO, 'kept'))
+    handler.emit(record(logging.INFO, 'dropped'))
+    handler.emit(record(logging.ERROR, 'dropped too'))
+
+    assert handler.queue.qsize() == 1
+    assert dropped() - before == 2
+
+def test_json_formatter_includes_extra_fields(request_log):
+    entry = record(logging.INFO, 'hello %s', 'world')
+    entry.request_id = request_log
+    entry.status = 200
+    formatted = logs.JsonFormatter().format(entry)
+    assert '"message": "hello world"' in formatted
+    assert '"request_id": "req-1"' in formatted
+    assert '"status": 200' in formatted
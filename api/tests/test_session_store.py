@@ -0,0 +1,38 @@
+import os
+import stat
+import time
+import session_store
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+def test_store_files_are_private(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    store = session_store.SQLiteSessionStore(path=path)
+    store.save_connection('conn-1', 'vc', 'vmware_soap_session="abc"')
+
+    assert mode(path) == 0o600
+    assert mode(path + '-wal') == 0o600
+
+def test_existing_store_is_made_private(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    open(path, 'w').close()
+    os.chmod(path, 0o644)
+
+    session_store.SQLiteSessionStore(path=path)
+    assert mode(path) == 0o600
+
+def test_unused_cookies_are_purged_with_expired_sessions(tmp_path, monkeypatch):
+    store = session_store.SQLiteSessionStore(path=str(tmp_path / 'sessions.db'), ttl=60)
+    store.save_connection('conn-used', 'vc', 'cookie-1')
+    store.save_connection('conn-unused', 'vc', 'cookie-2')
+    store.create('session-1', 'conn-used', 'vc', False)
+    assert store.get_connection_cookie('conn-unused') == 'cookie-2'
+
+    # Past the grace period for freshly published cookies
+    later = time.time() + session_store.PURGE_INTERVAL + 1
+    monkeypatch.setattr(session_store.time, 'time', lambda: later)
+    store.create('session-2', 'conn-used', 'vc', False)
+
+    assert store.get_connection_cookie('conn-used') == 'cookie-1'
+    assert store.get_connection_cookie('conn-unused') is None
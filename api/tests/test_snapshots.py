@@ -0,0 +1,64 @@
+import time
+import pytest
+import snapshots
+from conftest import FakeVCenter, wait_for
+
+@pytest.fixture
+def fake():
+    return FakeVCenter(vm_count=50, snapshot_ratio=0.5, max_snapshots=4)
+
+@pytest.fixture
+def index(service_instance):
+    cache = snapshots.create_snapshot_cache('vc', service_instance)
+    cache.wait_seconds = 1
+    cache.attach(service_instance)
+    assert cache.wait_ready(5)
+    index = snapshots.SnapshotIndex(cache)
+    yield index
+    index.close()
+    cache.stop()
+
+def all_snapshots(fake, index):
+    return [record for vm_id in fake.vms for record in index.vm_snapshots(vm_id)]
+
+def expected(records, created_before=None, min_size=None, vm_ids=None):
+    """What query should return, by brute force over every snapshot"""
+    return sorted(
+        (record for record in records
+         if (created_before is None or record['created_at'] < created_before)
+         and (min_size is None or record['size_bytes'] >= min_size)
+         and (vm_ids is None or record['vm_id'] in vm_ids)),
+        key=lambda record: (record['created_at'], record['id'])
+    )
+
+def test_fake_inventory_has_snapshots(fake, index):
+    assert len(all_snapshots(fake, index)) > 20
+
+@pytest.mark.parametrize('age_days, min_size', [
+    (None, None),
+    (30, None),
+    (None, 2**30),
+    (30, 2**30),
+    (1000, 2**40),
+])
+def test_query_matches_a_full_scan(fake, index, age_days, min_size):
+    created_before = time.time() - age_days * 86400 if age_days is not None else None
+    records = all_snapshots(fake, index)
+
+    result = index.query(created_before=created_before, min_size=min_size)
+    assert [r['id'] for r in result] == [r['id'] for r in expected(records, created_before, min_size)]
+
+def test_query_restricted_to_vms(fake, index):
+    records = all_snapshots(fake, index)
+    vm_ids = {records[0]['vm_id'], records[-1]['vm_id']}
+
+    result = index.query(min_size=0, vm_ids=vm_ids)
+    assert result
+    assert [r['id'] for r in result] == [r['id'] for r in expected(records, min_size=0, vm_ids=vm_ids)]
+
+def test_removed_vm_leaves_the_index(fake, index):
+    vm_id = next(vm_id for vm_id in fake.vms if index.vm_snapshots(vm_id))
+    fake.remove_vm(vm_id)
+
+    wait_for(lambda: index.vm_snapshots(vm_id) is None)
+    assert all(record['vm_id'] != vm_id for record in index.query())
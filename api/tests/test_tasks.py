@@ -0,0 +1,77 @@
+import time
+import pytest
+from pyVmomi import vim
+import tasks
+from conftest import FakeVCenter, wait_for
+
+@pytest.fixture
+def tracker(service_instance):
+    tracker = tasks.TaskTracker('vc', service_instance, wait_seconds=1)
+    yield tracker
+    tracker.stop()
+
+def vms_in_state(fake, power_state):
+    return [vm_id for vm_id, props in fake.vms.items() if props['runtime.powerState'] == power_state]
+
+def power_off(service_instance, vm_id):
+    return vim.VirtualMachine(vm_id, service_instance._stub).PowerOffVM_Task()
+
+def test_wait_returns_the_finished_state(fake, service_instance, tracker):
+    vm_id = vms_in_state(fake, 'poweredOn')[0]
+    task = power_off(service_instance, vm_id)
+    tracker.track([task])
+
+    state = tracker.wait(task._moId, timeout=5)
+    assert state['state'] == 'success'
+    assert state['error'] is None
+    assert fake.vms[vm_id]['runtime.powerState'] == 'poweredOff'
+    assert tracker.get(task._moId)['state'] == 'success'
+
+def test_failed_task_reports_its_fault(fake, service_instance, tracker):
+    vm_id = vms_in_state(fake, 'poweredOff')[0]
+    task = power_off(service_instance, vm_id)
+    tracker.track([task])
+
+    state = tracker.wait(task._moId, timeout=5)
+    assert state['state'] == 'error'
+    assert 'cannot be performed in the current state' in state['error']
+
+def test_callbacks_follow_every_task_of_a_batch(fake, service_instance, tracker):
+    vm_ids = vms_in_state(fake, 'poweredOn')[:5]
+    seen = {}
+    batch = [power_off(service_instance, vm_id) for vm_id in vm_ids]
+    tracker.track(batch, callback=lambda task_id, state: seen.setdefault(task_id, []).append(state['state']))
+
+    for task in batch:
+        assert tracker.wait(task._moId, timeout=5)['state'] == 'success'
+    wait_for(lambda: all(seen.get(task._moId, [None])[-1] == 'success' for task in batch))
+
+def test_tasks_tracked_while_the_view_is_created_are_followed():
+    fake = FakeVCenter(vm_count=4, powered_on_ratio=1.0, task_duration=2, method_latency={'CreateListView': 0.3})
+    service_instance = fake.connect()
+    tracker = tasks.TaskTracker('vc', service_instance, wait_seconds=1)
+    try:
+        slow = power_off(service_instance, 'vm-1')
+        tracker.track([slow])
+        # Tracked while the feed is still creating the view, and done long before the slow task
+        time.sleep(0.1)
+        fake.task_duration = 0.1
+        quick = power_off(service_instance, 'vm-2')
+        tracker.track([quick])
+
+        assert tracker.wait(quick._moId, timeout=0.8)['state'] == 'success'
+        assert tracker.get(slow._moId)['state'] != 'success'
+    finally:
+        tracker.stop()
+
+def test_wait_times_out_on_an_unfinished_task(service_instance, tracker, fake):
+    fake.task_duration = 2
+    task = power_off(service_instance, vms_in_state(fake, 'poweredOn')[0])
+    tracker.track([task])
+
+    assert tracker.wait(task._moId, timeout=0.2) is None
+    assert tracker.get(task._moId)['state'] in ('queued', 'running')
+
+def test_unknown_task(tracker):
+    assert tracker.get('task-unknown') is None
+    assert tracker.wait('task-unknown', timeout=0.1) is None
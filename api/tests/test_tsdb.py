@@ -0,0 +1,139 @@
+import time
+import pytest
+import tsdb
+
+# (step, segment window, retention): 10s samples rolled up into 30s ones
+RESOLUTIONS = [(10, 60, 3600), (30, 120, 7200)]
+
+# Samples written per VM, one per 10s step, ending now
+CYCLES = 60
+
+@pytest.fixture
+def start():
+    now = int(time.time())
+    return now - now % 60 - CYCLES * 10
+
+@pytest.fixture
+def store(tmp_path, start):
+    store = tsdb.MetricsStore(str(tmp_path), RESOLUTIONS)
+    assert store.lead()
+    for i in range(CYCLES):
+        store.append(start + i * 10, {'vm-1': (i, 2 * i, 3 * i), 'vm-2': (100, 100, 100)})
+    yield store
+    store.resign()
+
+def test_query_returns_raw_samples_across_segments_and_head(store, start):
+    result = store.query('vm-1', start, start + CYCLES * 10)
+
+    assert result['step'] == 10
+    assert result['timestamps'] == [start + i * 10 for i in range(CYCLES)]
+    assert result['cpu_usage'] == [float(i) for i in range(CYCLES)]
+    assert result['memory_usage'] == [float(2 * i) for i in range(CYCLES)]
+    assert result['disk_usage'] == [float(3 * i) for i in range(CYCLES)]
+
+def test_query_restricts_to_the_range_and_vm(store, start):
+    result = store.query('vm-2', start + 100, start + 200)
+    assert result['timestamps'] == [start + t for t in range(100, 201, 10)]
+    assert set(result['cpu_usage']) == {100.0}
+
+    assert store.query('vm-unknown', start, start + CYCLES * 10)['timestamps'] == []
+
+def test_query_uses_the_rollup_for_coarser_steps(store, start):
+    result = store.query('vm-1', start, start + CYCLES * 10, step=30)
+
+    assert result['step'] == 30
+    # The bucket still open in the rollup is not written yet
+    assert result['timestamps'] == [start + i * 30 for i in range(CYCLES // 3 - 1)]
+    assert result['cpu_usage'] == [float(3 * i + 1) for i in range(CYCLES // 3 - 1)]
+
+def test_query_downsamples_steps_between_resolutions(store, start):
+    result = store.query('vm-1', start, start + CYCLES * 10, step=60)
+
+    assert result['step'] == 60
+    buckets = len(result['timestamps'])
+    assert result['timestamps'] == [start + i * 60 for i in range(buckets)]
+    # Averages of two complete 30s rollups each
+    assert result['cpu_usage'][:-1] == [float(6 * i + 2.5) for i in range(buckets - 1)]
+
+@pytest.mark.parametrize('step', [1, 5, 10])
+def test_query_with_a_step_finer_than_any_resolution_uses_the_finest(store, start, step):
+    result = store.query('vm-1', start, start + CYCLES * 10, step=step)
+
+    assert result['step'] == 10
+    assert result['timestamps'] == [start + i * 10 for i in range(CYCLES)]
+
+def test_query_with_a_step_between_resolutions_uses_the_finer(store, start):
+    result = store.query('vm-1', start, start + CYCLES * 10, step=15)
+
+    assert result['step'] == 15
+    assert result['timestamps'][:2] == [start, start + 15]
+    # The second bucket only holds the sample at +20s
+    assert result['cpu_usage'][:2] == [0.5, 2.0]
+
+def test_downsample_averages_buckets():
+    columns = ([0, 10, 20, 60, 70], [1, 2, 3, 10, 20], [0, 0, 0, 0, 0], [3, 3, 3, 6, 6])
+    assert tsdb.downsample(columns, 60) == ([0, 60], [2.0, 15.0], [0.0, 0.0], [3.0, 6.0])
+    assert tsdb.downsample(([], [], [], []), 60) == ([], [], [], [])
+
+def test_readers_see_the_open_window_through_the_journal(store, tmp_path, start):
+    reader = tsdb.MetricsStore(str(tmp_path), RESOLUTIONS)
+    assert not reader.lead()
+    assert not reader.writing
+
+    written = store.query('vm-1', start, start + CYCLES * 10)
+    assert reader.query('vm-1', start, start + CYCLES * 10) == written
+
+    timestamp, samples = reader.latest()
+    assert timestamp == start + (CYCLES - 1) * 10
+    assert samples['vm-1'] == pytest.approx((CYCLES - 1, 2 * (CYCLES - 1), 3 * (CYCLES - 1)))
+
+def test_writer_takes_over_after_resign(store, tmp_path, start):
+    written = store.query('vm-1', start, start + CYCLES * 10)
+    store.resign()
+
+    successor = tsdb.MetricsStore(str(tmp_path), RESOLUTIONS)
+    assert successor.lead()
+    try:
+        assert successor.query('vm-1', start, start + CYCLES * 10) == written
+    finally:
+        successor.resign()
+
+def test_rollups_survive_a_change_of_writer(tmp_path, start):
+    first = tsdb.MetricsStore(str(tmp_path), RESOLUTIONS)
+    assert first.lead()
+    # Resign in the middle of a 30s bucket
+    for i in range(31):
+        first.append(start + i * 10, {'vm-1': (i, 2 * i, 3 * i)})
+    first.resign()
+
+    successor = tsdb.MetricsStore(str(tmp_path), RESOLUTIONS)
+    assert successor.lead()
+    try:
+        for i in range(31, CYCLES):
+            successor.append(start + i * 10, {'vm-1': (i, 2 * i, 3 * i)})
+        result = successor.query('vm-1', start, start + CYCLES * 10, step=30)
+    finally:
+        successor.resign()
+
+    assert result['timestamps'] == [start + i * 30 for i in range(CYCLES // 3 - 1)]
+    assert result['cpu_usage'] == [float(3 * i + 1) for i in range(CYCLES // 3 - 1)]
+
+def test_journal_replay_errors_are_not_masked(store, tmp_path, start, monkeypatch):
+    store.resign()
+    successor = tsdb.MetricsStore(str(tmp_path), RESOLUTIONS)
+    assert successor.lead()
+    # Leave a journal for the successor to take over
+    successor.resolutions[0].append(start + CYCLES * 10, {'vm-1': (1, 2, 3)})
+    successor.resolutions[0]._journal.close()
+    successor.resolutions[0]._journal = None
+    successor.resolutions[0].head_start = None
+
+    def fail(journal):
+        raise ValueError('corrupt journal')
+    monkeypatch.setattr(tsdb.Journal, 'cycles', fail)
+    try:
+        with pytest.raises(ValueError, match='corrupt journal'):
+            successor.append(start + CYCLES * 10 + 10, {'vm-1': (1, 2, 3)})
+    finally:
+        monkeypatch.undo()
+        successor.resign()
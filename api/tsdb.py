@@ -0,0 +1,581 @@
+import os
+import re
+import json
+import mmap
+import time
+import fcntl
+import struct
+import logging
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+logger = logging.getLogger(__name__)
+
+# Root directory for metric segments, next to the SQLite database by default
+METRICS_DIR = os.environ.get(
+    'METRICS_DIR',
+    os.path.join(os.path.dirname(os.environ.get('DB_FILE', '/app/data/vm_captain.db')), 'metrics')
+)
+
+# (step, segment window, retention) in seconds, finest first. Samples are
+# written at the first resolution and averaged into the coarser ones.
+RESOLUTIONS = [
+    (20, 3600, 86400),
+    (300, 6 * 3600, 7 * 86400),
+    (3600, 86400, 90 * 86400),
+]
+
+# Segment layout (little endian):
+#   header   magic, step, window start, window end, vm count, sample count
+#   index    vm count entries of (vm id, first sample, sample count), sorted by id
+#   columns  timestamps uint32[n], cpu float32[n], memory float32[n], disk float32[n]
+MAGIC = b'VMCTS1'
+HEADER = struct.Struct('<6sIQQII')
+INDEX_ENTRY = struct.Struct('<32sII')
+COLUMNS = 3
+
+# The open window of a resolution is also appended to a journal, so workers
+# that do not write the store can read it. One record per append:
+#   header   timestamp, vm count
+#   keys     vm count vm ids, sorted
+#   columns  cpu float32[n], memory float32[n], disk float32[n]
+RECORD_HEADER = struct.Struct('<II')
+KEY = struct.Struct('<32s')
+
+# File in a store's directory locked by the one process writing the store
+WRITER_LOCK = 'writer.lock'
+
+# File a resigning writer leaves its unfinished rollup buckets in for the next one
+ROLLUP_STATE = 'rollups.json'
+
+class Segment:
+    """Read-only view of one memory-mapped segment file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.step, self.start, self.end, self.vm_count, self.sample_count = \
+            HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a metrics segment")
+
+        self._index_offset = HEADER.size
+        self._columns_offset = self._index_offset + self.vm_count * INDEX_ENTRY.size
+
+    def close(self):
+        self._mmap.close()
+
+    def _find(self, vm_key):
+        """Binary search the fixed-width index for a VM"""
+        lo, hi = 0, self.vm_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, first, count = INDEX_ENTRY.unpack_from(self._mmap, self._index_offset + mid * INDEX_ENTRY.size)
+            if key < vm_key:
+                lo = mid + 1
+            elif key > vm_key:
+                hi = mid
+            else:
+                return first, count
+        return None
+
+    def read(self, vm_key, start, end):
+        """Return (timestamps, cpu, memory, disk) for a VM within [start, end]"""
+        found = self._find(vm_key)
+        if not found:
+            return None
+
+        first, count = found
+        n = self.sample_count
+
+        # Copy only this VM's slice of each column out of the mapping
+        timestamps = self._column(0, n, 'I', first, first + count)
+        lo = bisect_left(timestamps, start)
+        hi = bisect_right(timestamps, end)
+        if lo >= hi:
+            return None
+
+        columns = [timestamps[lo:hi].tolist()]
+        for column in range(1, COLUMNS + 1):
+            columns.append(self._column(column, n, 'f', first + lo, first + hi).tolist())
+        return columns
+
+    def _column(self, column, n, typecode, lo, hi):
+        offset = self._columns_offset + 4 * n * column
+        values = array(typecode)
+        values.frombytes(self._mmap[offset + 4 * lo:offset + 4 * hi])
+        return values
+
+class Journal:
+    """Read-only view of the complete records of one journal file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+
+    def records(self):
+        """Yield (offset, timestamp, vm count) of every complete record"""
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(self._mmap):
+            timestamp, count = RECORD_HEADER.unpack_from(self._mmap, offset)
+            end = offset + record_size(count)
+            if end > len(self._mmap):
+                # Torn by a writer that died mid-append
+                break
+            yield offset, timestamp, count
+            offset = end
+
+    def read(self, vm_key, start, end):
+        """Return (timestamps, cpu, memory, disk) lists for a VM within [start, end]"""
+        result = ([], [], [], [])
+        for offset, timestamp, count in self.records():
+            if not start <= timestamp <= end:
+                continue
+            keys = offset + RECORD_HEADER.size
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                key, = KEY.unpack_from(self._mmap, keys + mid * KEY.size)
+                if key < vm_key:
+                    lo = mid + 1
+                elif key > vm_key:
+                    hi = mid
+                else:
+                    result[0].append(timestamp)
+                    values = keys + count * KEY.size
+                    for column in range(COLUMNS):
+                        result[column + 1].append(struct.unpack_from('<f', self._mmap, values + 4 * (column * count + mid))[0])
+                    break
+        return result
+
+    def cycles(self):
+        """Yield (timestamp, {vm_id: (cpu, memory, disk)}) for every complete record, oldest first"""
+        for offset, timestamp, count in self.records():
+            yield timestamp, self._decode(offset, count)
+
+    def last(self):
+        """Return (timestamp, {vm_id: (cpu, memory, disk)}) of the newest record, or None"""
+        newest = None
+        for newest in self.records():
+            pass
+        if newest is None:
+            return None
+        offset, timestamp, count = newest
+        return timestamp, self._decode(offset, count)
+
+    def _decode(self, offset, count):
+        keys = offset + RECORD_HEADER.size
+        ids = [key.rstrip(b'\0').decode() for key, in KEY.iter_unpack(self._mmap[keys:keys + count * KEY.size])]
+        values = array('f')
+        values.frombytes(self._mmap[keys + count * KEY.size:keys + count * (KEY.size + 4 * COLUMNS)])
+        return {
+            vm_id: tuple(values[column * count + i] for column in range(COLUMNS)) for i, vm_id in enumerate(ids)
+        }
+
+    def valid_size(self):
+        """Return the length of the journal up to its last complete record"""
+        size = 0
+        for offset, _, count in self.records():
+            size = offset + record_size(count)
+        return size
+
+def record_size(count):
+    return RECORD_HEADER.size + count * (KEY.size + 4 * COLUMNS)
+
+def encode_record(timestamp, samples):
+    """Encode samples {vm_id: (cpu, memory, disk)} as one journal record"""
+    keys = sorted(samples)
+    values = [array('f') for _ in range(COLUMNS)]
+    for vm_id in keys:
+        for column, value in zip(values, samples[vm_id]):
+            column.append(value)
+    return b''.join(
+        [RECORD_HEADER.pack(timestamp, len(keys))]
+        + [encode_key(vm_id) for vm_id in keys]
+        + [column.tobytes() for column in values]
+    )
+
+def sort_unique(columns):
+    """Sort (timestamps, cpu, memory, disk) columns by time, keeping one sample per timestamp"""
+    timestamps = columns[0]
+    if all(a < b for a, b in zip(timestamps, timestamps[1:])):
+        return columns
+    order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+    keep = [i for n, i in enumerate(order) if n == 0 or timestamps[i] != timestamps[order[n - 1]]]
+    return tuple([column[i] for i in keep] for column in columns)
+
+def write_segment(path, step, start, end, series):
+    """Atomically write series {vm_id: (timestamps, cpu, memory, disk)} as a segment file"""
+    keys = sorted(series)
+    timestamps, values = array('I'), [array('f') for _ in range(COLUMNS)]
+    index = []
+
+    for vm_id in keys:
+        vm_timestamps, *vm_values = series[vm_id]
+        index.append(INDEX_ENTRY.pack(encode_key(vm_id), len(timestamps), len(vm_timestamps)))
+        timestamps.extend(vm_timestamps)
+        for column, column_values in zip(values, vm_values):
+            column.extend(column_values)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, step, start, end, len(keys), len(timestamps)))
+        f.write(b''.join(index))
+        f.write(timestamps.tobytes())
+        for column in values:
+            f.write(column.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def encode_key(vm_id):
+    return vm_id.encode()[:INDEX_ENTRY.size - 8].ljust(INDEX_ENTRY.size - 8, b'\0')
+
+class Resolution:
+    """Open head window, its journal and the on-disk segments for one step size"""
+
+    def __init__(self, directory, step, window, retention):
+        self.directory = directory
+        self.step = step
+        self.window = window
+        self.retention = retention
+        self.head_start = None
+        # vm_id -> (timestamps, cpu, memory, disk) arrays for the open window
+        self.head = {}
+        self._journal = None
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, timestamp, samples):
+        """Add one sample per VM, flushing the head when its window has passed"""
+        window_start = timestamp - timestamp % self.window
+        if self.head_start is not None and window_start != self.head_start:
+            self.flush()
+        if self.head_start is None:
+            self.head_start = window_start
+            self._open_journal()
+
+        for vm_id, values in samples.items():
+            self._extend(vm_id, [timestamp], [[value] for value in values])
+        self._journal.write(encode_record(timestamp, samples))
+        self._journal.flush()
+
+    def _extend(self, vm_id, timestamps, values):
+        columns = self.head.get(vm_id)
+        if columns is None:
+            columns = self.head[vm_id] = (array('I'), array('f'), array('f'), array('f'))
+        columns[0].extend(timestamps)
+        for column, column_values in zip(columns[1:], values):
+            column.extend(column_values)
+
+    def _open_journal(self):
+        """Open the head window's journal, taking over the records a previous writer left in it"""
+        path = self.journal_path(self.head_start)
+        if os.path.exists(path):
+            tmp_path = path + '.tmp'
+            journal = Journal(path)
+            try:
+                for timestamp, samples in journal.cycles():
+                    for vm_id, values in samples.items():
+                        self._extend(vm_id, [timestamp], [[value] for value in values])
+                # Drop a record torn by a writer that died mid-append; replaced
+                # rather than truncated, as readers may have the file mapped
+                with open(tmp_path, 'wb') as f:
+                    f.write(journal._mmap[:journal.valid_size()])
+            finally:
+                journal.close()
+            os.replace(tmp_path, path)
+        self._journal = open(path, 'ab')
+
+    def flush(self):
+        """Write the open window to a segment file, drop its journal and apply retention"""
+        if self.head:
+            path = os.path.join(self.directory, f"{self.head_start:010d}-{int(time.time() * 1000)}.seg")
+            write_segment(path, self.step, self.head_start, self.head_start + self.window, self.head)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            try:
+                os.remove(self.journal_path(self.head_start))
+            except OSError:
+                pass
+        self.head = {}
+        self.head_start = None
+        self.expire()
+
+    def expire(self, now=None):
+        cutoff = (now or time.time()) - self.retention
+        for name, start in self.segment_files() + self.journal_files():
+            if start + self.window < cutoff:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def segment_files(self):
+        """Return (file name, window start) for every segment, oldest first"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.seg'):
+                files.append((name, int(name.split('-', 1)[0])))
+        return sorted(files)
+
+    def journal_files(self):
+        """Return (file name, window start) for every journal, oldest first"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.journal'):
+                files.append((name, int(name[:-len('.journal')])))
+        return sorted(files)
+
+    def journal_path(self, window_start):
+        return os.path.join(self.directory, f"{window_start:010d}.journal")
+
+    def read(self, vm_id, start, end):
+        """Return (timestamps, cpu, memory, disk) lists for a VM within [start, end].
+
+        Journals are read too, as the window they hold may be open in another
+        process. A journal can briefly coexist with the segment written from
+        it, so samples are sorted and deduplicated by timestamp.
+        """
+        result = ([], [], [], [])
+        vm_key = encode_key(vm_id)
+
+        for name, window_start in self.segment_files():
+            if window_start > end or window_start + self.window < start:
+                continue
+            try:
+                segment = Segment(os.path.join(self.directory, name))
+            except (OSError, ValueError) as e:
+                logger.warning("Skipping unreadable metrics segment %s: %s", name, e)
+                continue
+            try:
+                columns = segment.read(vm_key, start, end)
+            finally:
+                segment.close()
+            if columns:
+                for merged, column in zip(result, columns):
+                    merged.extend(column)
+
+        for name, window_start in self.journal_files():
+            # The window this process writes is read from memory below
+            if window_start > end or window_start + self.window < start or window_start == self.head_start:
+                continue
+            try:
+                journal = Journal(os.path.join(self.directory, name))
+            except OSError:
+                # Removed after its segment was written
+                continue
+            try:
+                columns = journal.read(vm_key, start, end)
+            finally:
+                journal.close()
+            for merged, column in zip(result, columns):
+                merged.extend(column)
+
+        head = self.head.get(vm_id)
+        if head:
+            lo = bisect_left(head[0], start)
+            hi = bisect_right(head[0], end)
+            for merged, column in zip(result, head):
+                merged.extend(column[lo:hi])
+
+        return sort_unique(result)
+
+    def latest(self):
+        """Return (timestamp, {vm_id: (cpu, memory, disk)}) of the newest journal record, or None"""
+        for name, _ in reversed(self.journal_files()):
+            try:
+                journal = Journal(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            try:
+                last = journal.last()
+            finally:
+                journal.close()
+            if last is not None:
+                return last
+        return None
+
+class MetricsStore:
+    """Append-only columnar time-series store for the VM metrics of one vCenter.
+
+    Every worker process opens the store, but only the one holding its writer
+    lock (see lead) appends; the others read what it wrote, including the
+    open windows through their journals.
+    """
+
+    def __init__(self, directory, resolutions=RESOLUTIONS):
+        self.directory = directory
+        self.resolutions = [
+            Resolution(os.path.join(directory, f"{step}s"), step, window, retention)
+            for step, window, retention in resolutions
+        ]
+        # Per rollup resolution: vm_id -> [bucket start, cpu sum, memory sum, disk sum, samples]
+        self._rollups = [{} for _ in self.resolutions[1:]]
+        # Open writer lock file while this process writes the store
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def lead(self):
+        """Become the store's writer unless another process is; returns whether this process writes it"""
+        with self._lock:
+            if self._writer is None:
+                lock_file = open(os.path.join(self.directory, WRITER_LOCK), 'a')
+                try:
+                    # Released by the kernel when the writer exits, however it exits
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    return False
+                self._writer = lock_file
+                self._rollups = self._load_rollups()
+            return True
+
+    def resign(self):
+        """Write out the open windows and let another process become the writer"""
+        with self._lock:
+            if self._writer is None:
+                return
+            for resolution in self.resolutions:
+                resolution.flush()
+            self._save_rollups()
+            self._rollups = [{} for _ in self.resolutions[1:]]
+            self._writer.close()
+            self._writer = None
+
+    def _save_rollups(self):
+        """Hand the rollup buckets still filling to the next writer, which completes them"""
+        state = {
+            str(resolution.step): buckets
+            for resolution, buckets in zip(self.resolutions[1:], self._rollups) if buckets
+        }
+        path = os.path.join(self.directory, ROLLUP_STATE)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not save the open rollups of %s: %s", self.directory, e)
+
+    def _load_rollups(self):
+        """Take over the rollup buckets a resigned writer left, dropping those past retention"""
+        path = os.path.join(self.directory, ROLLUP_STATE)
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            os.remove(path)
+        except FileNotFoundError:
+            state = {}
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable rollup state %s: %s", path, e)
+            state = {}
+
+        cutoff = time.time()
+        return [
+            {
+                vm_id: bucket for vm_id, bucket in state.get(str(resolution.step), {}).items()
+                if bucket[0] >= cutoff - resolution.retention
+            }
+            for resolution in self.resolutions[1:]
+        ]
+
+    @property
+    def writing(self):
+        return self._writer is not None
+
+    def latest(self):
+        """Return (timestamp, {vm_id: (cpu, memory, disk)}) of the newest stored cycle, or None"""
+        with self._lock:
+            return self.resolutions[0].latest()
+
+    def append(self, timestamp, samples):
+        """Store one collection cycle of samples {vm_id: (cpu, memory, disk)}; only the writer may append"""
+        timestamp = int(timestamp)
+        with self._lock:
+            self.resolutions[0].append(timestamp, samples)
+            for resolution, buckets in zip(self.resolutions[1:], self._rollups):
+                self._roll_up(resolution, buckets, timestamp, samples)
+
+    def _roll_up(self, resolution, buckets, timestamp, samples):
+        """Average raw samples into resolution, emitting each bucket once it is complete"""
+        bucket_start = timestamp - timestamp % resolution.step
+        completed = {}
+
+        # Buckets from an earlier step are complete, including those of VMs
+        # that stopped reporting
+        for vm_id in [vm_id for vm_id, bucket in buckets.items() if bucket[0] != bucket_start]:
+            bucket = buckets.pop(vm_id)
+            completed.setdefault(bucket[0], {})[vm_id] = tuple(total / bucket[4] for total in bucket[1:4])
+
+        for vm_id, values in samples.items():
+            bucket = buckets.get(vm_id)
+            if bucket is None:
+                bucket = buckets[vm_id] = [bucket_start, 0.0, 0.0, 0.0, 0]
+            for i, value in enumerate(values):
+                bucket[i + 1] += value
+            bucket[4] += 1
+
+        for start in sorted(completed):
+            resolution.append(start, completed[start])
+
+    def query(self, vm_id, start, end, step=None):
+        """Return {'step', 'timestamps', 'cpu_usage', 'memory_usage', 'disk_usage'} for a VM.
+
+        Uses the coarsest resolution that still retains start and is no
+        coarser than step, or the finest retaining start when step is finer
+        than all of them; coarser steps are averaged from it on the fly.
+        """
+        now = time.time()
+        retained = [
+            resolution for resolution in self.resolutions
+            if start >= now - resolution.retention - resolution.step
+        ] or self.resolutions[-1:]
+        chosen = retained[0]
+        if step is not None:
+            for resolution in retained:
+                if resolution.step <= step:
+                    chosen = resolution
+
+        with self._lock:
+            columns = chosen.read(vm_id, start, end)
+
+        step = max(step or chosen.step, chosen.step)
+        if step != chosen.step:
+            columns = downsample(columns, step)
+
+        timestamps, cpu, memory, disk = columns
+        return {
+            'step': step,
+            'timestamps': timestamps,
+            'cpu_usage': [round(value, 2) for value in cpu],
+            'memory_usage': [round(value, 2) for value in memory],
+            'disk_usage': [round(value, 2) for value in disk],
+        }
+
+def downsample(columns, step):
+    """Average (timestamps, cpu, memory, disk) columns into step-sized buckets"""
+    result = ([], [], [], [])
+    timestamps = columns[0]
+    i = 0
+    while i < len(timestamps):
+        bucket_start = timestamps[i] - timestamps[i] % step
+        j = i
+        while j < len(timestamps) and timestamps[j] < bucket_start + step:
+            j += 1
+        result[0].append(bucket_start)
+        for merged, column in zip(result[1:], columns[1:]):
+            merged.append(sum(column[i:j]) / (j - i))
+        i = j
+    return result
+
+def store_directory(name):
+    """Return the directory holding the metrics of a vCenter"""
+    return os.path.join(METRICS_DIR, re.sub(r'[^A-Za-z0-9_.-]', '_', name))
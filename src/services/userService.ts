@@ -1,6 +1,7 @@
 
 import { UserType, UserRole, VMType } from '@/types/vm';
 import { toast } from 'sonner';
+import { configService } from '@/services/configService';
 
 class UserService {
   private currentUser: UserType | null = null;
@@ -16,7 +17,10 @@ class UserService {
     try {
       const storedCurrentUser = localStorage.getItem('currentUser');
       if (storedCurrentUser) {
-        this.currentUser = JSON.parse(storedCurrentUser);
+        const user: UserType = JSON.parse(storedCurrentUser);
+        // Sessions saved before tokens were issued, or whose token expired, must sign in again
+        const expired = !user.token || (user.tokenExpiresAt !== undefined && user.tokenExpiresAt * 1000 <= Date.now());
+        this.currentUser = expired ? null : user;
       }
     } catch (error) {
       console.error('Error loading user session:', error);
@@ -57,8 +61,8 @@ class UserService {
         return false;
       }
 
-      const user = await response.json();
-      this.currentUser = user;
+      const { token, token_expires_at, ...user } = await response.json();
+      this.currentUser = { ...user, token, tokenExpiresAt: token_expires_at };
       this.saveSession();
       return true;
     } catch (error) {
@@ -102,7 +106,7 @@ class UserService {
         method: 'PUT',
         headers: {
           'Content-Type': 'application/json',
-          'Authorization': `Bearer ${this.currentUser.id}`,
+          'Authorization': `Bearer ${this.currentUser.token}`,
         },
         body: JSON.stringify({ currentPassword, newPassword }),
       });
@@ -145,7 +149,7 @@ class UserService {
     try {
       const response = await fetch(`${this.baseUrl}/users`, {
         headers: {
-          'Authorization': `Bearer ${this.currentUser.id}`,
+          'Authorization': `Bearer ${this.currentUser.token}`,
         },
       });
 
@@ -192,16 +196,25 @@ class UserService {
     }
   }
 
+  // Assignments name the vCenter of the VM, as morefs are only unique within one vCenter
+  private vCenterHost(): string {
+    try {
+      return new URL(configService.getVCenterConfig().url).host;
+    } catch (error) {
+      return '';
+    }
+  }
+
   async assignVMToUser(userId: string, vmId: string): Promise<boolean> {
     if (!this.isAdmin() || !this.currentUser) {
       return false;
     }
 
     try {
-      const response = await fetch(`${this.baseUrl}/users/${userId}/vms/${vmId}`, {
+      const response = await fetch(`${this.baseUrl}/users/${userId}/vms/${vmId}?vcenter=${encodeURIComponent(this.vCenterHost())}`, {
         method: 'PUT',
         headers: {
-          'Authorization': `Bearer ${this.currentUser.id}`,
+          'Authorization': `Bearer ${this.currentUser.token}`,
         },
       });
 
@@ -225,10 +238,10 @@ class UserService {
     }
 
     try {
-      const response = await fetch(`${this.baseUrl}/users/${userId}/vms/${vmId}`, {
+      const response = await fetch(`${this.baseUrl}/users/${userId}/vms/${vmId}?vcenter=${encodeURIComponent(this.vCenterHost())}`, {
         method: 'DELETE',
         headers: {
-          'Authorization': `Bearer ${this.currentUser.id}`,
+          'Authorization': `Bearer ${this.currentUser.token}`,
         },
       });
 
@@ -246,6 +259,43 @@ class UserService {
     }
   }
 
+  async assignVMsToUser(userId: string, vmIds: string[]): Promise<boolean> {
+    return this.updateVMAssignments(userId, vmIds, 'PUT');
+  }
+
+  async removeVMsFromUser(userId: string, vmIds: string[]): Promise<boolean> {
+    return this.updateVMAssignments(userId, vmIds, 'DELETE');
+  }
+
+  private async updateVMAssignments(userId: string, vmIds: string[], method: 'PUT' | 'DELETE'): Promise<boolean> {
+    if (!this.isAdmin() || !this.currentUser) {
+      return false;
+    }
+
+    try {
+      const response = await fetch(`${this.baseUrl}/users/${userId}/vms`, {
+        method,
+        headers: {
+          'Authorization': `Bearer ${this.currentUser.token}`,
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ vcenter: this.vCenterHost(), vm_ids: vmIds }),
+      });
+
+      if (!response.ok) {
+        const errorData = await response.json();
+        console.error('Update VM assignments failed:', errorData.error);
+        return false;
+      }
+
+      this.cachedUsers = null;
+      return true;
+    } catch (error) {
+      console.error('Update VM assignments error:', error);
+      return false;
+    }
+  }
+
   getAssignedVMs(vms: VMType[]): VMType[] {
     if (!this.currentUser) {
       return [];
@@ -272,7 +322,7 @@ class UserService {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
-          'Authorization': `Bearer ${this.currentUser.id}`,
+          'Authorization': `Bearer ${this.currentUser.token}`,
         },
         body: JSON.stringify({ username, password, role }),
       });
@@ -328,7 +378,7 @@ class UserService {
       const response = await fetch(`${this.baseUrl}/users/${userId}`, {
         method: 'DELETE',
         headers: {
-          'Authorization': `Bearer ${this.currentUser.id}`,
+          'Authorization': `Bearer ${this.currentUser.token}`,
         },
       });
 
@@ -1,6 +1,7 @@
 
 import { VMType, VMStatus } from '@/types/vm';
 import { SnapshotType } from '@/types/snapshot';
+import { userService } from '@/services/userService';
 
 export class VCenterConnectionError extends Error {
   constructor(message: string) {
@@ -26,6 +27,24 @@ export class VCenterService {
     console.log(`VCenterService initialized with URL: ${this.credentials.url}`);
   }
 
+  /**
+   * Token of the signed-in user; every /vcenter route requires it so the API can apply VM assignments
+   */
+  private userHeaders(): Record<string, string> {
+    const currentUser = userService.getCurrentUser();
+    return currentUser?.token ? { 'X-User-Token': currentUser.token } : {};
+  }
+
+  /**
+   * Headers authenticating a request with the vCenter session and the signed-in user
+   */
+  private authHeaders(): Record<string, string> {
+    return {
+      'Authorization': `Bearer ${this.sessionId}`,
+      ...this.userHeaders(),
+    };
+  }
+
   /**
    * Connect to the vCenter API through our backend service
    */
@@ -51,6 +70,7 @@ export class VCenterService {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          ...this.userHeaders(),
         },
         body: JSON.stringify({
           url: this.credentials.url,
@@ -90,11 +110,10 @@ export class VCenterService {
     }
     
     try {
+      // The API only returns the VMs assigned to the signed-in user
       const response = await fetch(`${this.apiBaseUrl}/vcenter/vms`, {
         method: 'GET',
-        headers: {
-          'Authorization': `Bearer ${this.sessionId}`,
-        },
+        headers: this.authHeaders(),
       });
 
       if (!response.ok) {
@@ -128,9 +147,7 @@ export class VCenterService {
     try {
       const response = await fetch(`${this.apiBaseUrl}/vcenter/vms/${id}`, {
         method: 'GET',
-        headers: {
-          'Authorization': `Bearer ${this.sessionId}`,
-        },
+        headers: this.authHeaders(),
       });
 
       if (!response.ok) {
@@ -167,9 +184,7 @@ export class VCenterService {
     try {
       const response = await fetch(`${this.apiBaseUrl}/vcenter/vms/${id}/snapshots`, {
         method: 'GET',
-        headers: {
-          'Authorization': `Bearer ${this.sessionId}`,
-        },
+        headers: this.authHeaders(),
       });
 
       if (!response.ok) {
@@ -204,7 +219,7 @@ export class VCenterService {
       const response = await fetch(`${this.apiBaseUrl}/vcenter/vms/${id}/snapshots`, {
         method: 'POST',
         headers: {
-          'Authorization': `Bearer ${this.sessionId}`,
+          ...this.authHeaders(),
           'Content-Type': 'application/json',
         },
         body: JSON.stringify({
@@ -246,7 +261,7 @@ export class VCenterService {
       const response = await fetch(`${this.apiBaseUrl}/vcenter/vms/${id}/power/${operation}`, {
         method: 'POST',
         headers: {
-          'Authorization': `Bearer ${this.sessionId}`,
+          ...this.authHeaders(),
           'Content-Type': 'application/json',
         },
       });
@@ -278,9 +293,7 @@ export class VCenterService {
       try {
         await fetch(`${this.apiBaseUrl}/vcenter/disconnect`, {
           method: 'POST',
-          headers: {
-            'Authorization': `Bearer ${this.sessionId}`,
-          },
+          headers: this.authHeaders(),
         });
         
         console.log('Disconnecting from vCenter');
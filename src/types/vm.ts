@@ -25,6 +25,8 @@ export interface UserType {
   password?: string; // Keep this optional for security reasons
   role: UserRole;
   assignedVMs?: string[]; // Array of VM IDs assigned to this user
+  token?: string; // Signed API token issued at login
+  tokenExpiresAt?: number; // Token expiry, epoch seconds
 }
 
 export interface VMType {